@@ -0,0 +1,579 @@
+#!/usr/bin/env python3
+#
+# This file is part of asafw.
+# Copyright (c) 2017, Aaron Adams <aaron.adams(at)nccgroup(dot)trust>
+# Copyright (c) 2017, Cedric Halbronn <cedric.halbronn(at)nccgroup(dot)trust>
+#
+# Build service around unpack_repack_bin.sh.
+#
+# Running unpack_repack_bin.sh for each variant of a firmware means parsing
+# the JSON database and extracting the rootfs again every time. asafwd.py
+# stays running and:
+# - accepts build requests over a Unix socket (one JSON object per line) and
+#   from a drop folder (*.json build requests or *.bin firmware to build with
+#   the default options)
+# - queues them by priority (lower value first) and runs them on a pool of
+#   worker threads
+# - keeps the JSON database loaded (reloaded when it changes on disk) to
+#   reject builds that can't succeed before doing any work, e.g. a debug shell
+#   for a firmware whose symbols are not in the database yet
+# - keeps the pristine rootfs of the recently built firmware extracted in a
+#   cache folder (a tmpfs by default) which unpack_repack_bin.sh copies with
+#   --pristine-rootfs instead of running bin.py, gunzip and cpio again
+# - optionally (--gz-cache) shares a cache of compressed rootfs segments
+#   between the builds (see cpiogz.py) so variant builds of a firmware only
+#   recompress what changed. The result is a bit bigger than with gzip -9 so
+#   it is not the default
+#
+# Each build runs in its own job folder so builds of the same firmware can run
+# in parallel. The output .bin is then moved to the output folder.
+#
+# Requests:
+# {"cmd": "build", "fw": "/path/asa924-k8.bin", "options": ["-f", "-g", "-b"],
+#  "priority": 10, "out_dir": "/path/out"}   -> {"status": "ok", "id": 1}
+# {"cmd": "status", "id": 1}                 -> {"status": "ok", "job": {...}}
+# {"cmd": "wait", "id": 1}                   -> same as status once finished
+# {"cmd": "list"}                            -> {"status": "ok", "jobs": [...]}
+# {"cmd": "shutdown"}
+#
+# Requires env.sh to be sourced and to be run as root (see unpack_repack_bin.sh)
+
+import argparse
+import collections
+import glob
+import itertools
+import json
+import os
+import queue
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+from helper import *
+from tracelog import stage
+import hunt
+import cpiogz
+import newc
+import uncpio
+
+def logmsg(s, end=None):
+    if type(s) == str:
+        if end != None:
+            print("[asafwd] " + s, end=end)
+        else:
+            print("[asafwd] " + s)
+    else:
+        print(s)
+    sys.stdout.flush()
+
+def default_socket():
+    return os.path.join(os.environ.get("WORKDIR", "/tmp"), "asafwd.sock")
+
+def default_cache_dir():
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm/asafwd"
+    return os.path.join(os.environ.get("WORKDIR", "/tmp"), "asafwd-cache")
+
+# unpack_repack_bin.sh options a build request can use and whether they take
+# an argument. Input/output and unpack-only options are handled by asafwd.py
+BUILD_OPTIONS = {
+    "-f": False, "--free-space": False,
+    "-g": False, "--enable-gdb": False,
+    "-G": False, "--disable-gdb": False,
+    "-a": False, "--enable-aslr": False,
+    "-A": False, "--disable-aslr": False,
+    "-m": False, "--inject-gdb": False,
+    "-b": False, "--debug-shell": False,
+    "-B": False, "--serial-shell": False,
+    "-H": True, "--lina-hook": True,
+    "-r": False, "--root": False,
+    "-c": False, "--custom": False,
+    "-s": False, "--simple-name": False,
+    "-v": False, "--verbose": False,
+    "--replace-linamonitor": True,
+    "--bin-with-asa-to-inject": True,
+    "--delta": False,
+    "--deterministic": False,
+    "--gdb-tcp": True,
+}
+
+class BuildError(Exception):
+    pass
+
+# The JSON database, reloaded when the file changes
+class Database(object):
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self.mtime = None
+        self.targets = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.dbname == None or not os.path.isfile(self.dbname):
+                return self.targets
+            mtime = os.stat(self.dbname).st_mtime
+            if mtime != self.mtime:
+                with stage("asafwd.load_targets", inputs=[self.dbname]):
+                    self.targets = load_targets(self.dbname)
+                self.mtime = mtime
+            return self.targets
+
+    # Fail early for builds lina.py would reject after the extraction
+    def check(self, bin_name, options):
+        if "-b" not in options and "--debug-shell" not in options:
+            return
+        for opt in ["--bin-with-asa-to-inject"]:
+            if opt in options:
+                bin_name = os.path.basename(options[options.index(opt)+1])
+        if self.dbname == None:
+            return
+        targets = self.get()
+        index = get_target_index(targets, bin_name)
+        if index == None:
+            raise BuildError("%s not in %s, needed for the debug shell" % (bin_name, self.dbname))
+        target = targets[index]
+        required = [("addresses", hunt.LINA_REQUIRED)]
+        if bin_name.startswith("asav"):
+            required.append(("lm_addresses", hunt.LM_REQUIRED))
+        for key, symbols in required:
+            missing = hunt.missing(target.get(key, {}), symbols)
+            if len(missing) != 0:
+                raise BuildError("%s: missing %s in %s, use hunt.py first" %
+                        (bin_name, " or ".join(missing[0]), self.dbname))
+
+# Pristine rootfs trees extracted from the firmware, indexed by sha256 and
+# evicted in LRU order. Trees used by a running build are never evicted
+class RootfsCache(object):
+    def __init__(self, cache_dir, max_entries):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.users = collections.Counter()
+        self.digests = {}
+        self.lock = threading.Lock()
+        self.filling = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        for d in sorted(glob.glob(os.path.join(cache_dir, "*", "rootfs")), key=os.path.getmtime):
+            entry = os.path.dirname(d)
+            # left by a build that was interrupted while extracting
+            if entry.endswith(".tmp"):
+                shutil.rmtree(entry, ignore_errors=True)
+                continue
+            self.entries[os.path.basename(entry)] = d
+
+    # Hashing a firmware takes a while so it is only done again if the file
+    # changed. The key is the path of the firmware the build was requested
+    # for, not its copy in the job folder which is new for every build
+    def digest(self, path):
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        with self.lock:
+            if key in self.digests:
+                return self.digests[key]
+        digest = hunt.sha256_file(path)
+        with self.lock:
+            self.digests[key] = digest
+        return digest
+
+    # fw is the firmware copy in job_dir to extract, src the original one
+    def acquire(self, src, fw, job_dir):
+        digest = self.digest(src)
+        while True:
+            with self.lock:
+                if digest in self.entries:
+                    self.entries.move_to_end(digest)
+                    self.users[digest] += 1
+                    logmsg("%s: using cached rootfs %s" % (os.path.basename(fw), self.entries[digest]))
+                    return digest, self.entries[digest]
+                event = self.filling.get(digest)
+                if event == None:
+                    event = self.filling[digest] = threading.Event()
+                    break
+            # another worker is extracting the same firmware
+            event.wait()
+        rootfs = None
+        try:
+            rootfs = self.fill(fw, digest, job_dir)
+        finally:
+            with self.lock:
+                if rootfs != None:
+                    self.entries[digest] = rootfs
+                    self.users[digest] += 1
+                    self.evict()
+                del self.filling[digest]
+            event.set()
+        return digest, rootfs
+
+    def release(self, digest):
+        with self.lock:
+            self.users[digest] -= 1
+            self.evict()
+
+    def evict(self):
+        for digest in list(self.entries):
+            if len(self.entries) <= self.max_entries:
+                break
+            if self.users[digest] > 0:
+                continue
+            logmsg("Evicting cached rootfs %s" % self.entries[digest])
+            shutil.rmtree(os.path.dirname(self.entries[digest]), ignore_errors=True)
+            del self.entries[digest]
+
+    # Same as unpack_bin() in unpack_repack_bin.sh (with --extract-jobs), from
+    # a copy of the firmware in the job folder
+    def fill(self, fw, digest, job_dir):
+        logmsg("%s: extracting rootfs into cache" % os.path.basename(fw))
+        bin_name = os.path.basename(fw)
+        base = os.path.join(job_dir, os.path.splitext(bin_name)[0])
+        entry = os.path.join(self.cache_dir, digest)
+        tmp = entry + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(os.path.join(tmp, "rootfs"))
+        try:
+            with stage("asafwd.cache_rootfs", inputs=[fw]):
+                subprocess.check_call([os.environ["FWTOOL"], "-u", "-f", os.path.join(job_dir, bin_name)],
+                                      cwd=job_dir, stdout=subprocess.DEVNULL)
+                # files written from a pool of threads, see uncpio.py
+                try:
+                    uncpio.extract_file(base + "-initrd-original.gz", os.path.join(tmp, "rootfs"))
+                except (newc.NewcError, OSError) as e:
+                    raise BuildError("%s: failed to extract the rootfs: %s" % (bin_name, e))
+        except:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        for f in glob.glob(base + "-initrd-original.gz") + glob.glob(base + "-vmlinuz"):
+            os.remove(f)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.rename(tmp, entry)
+        return os.path.join(entry, "rootfs")
+
+class Job(object):
+    def __init__(self, id, fw, options, priority, out_dir, source):
+        self.id = id
+        self.fw = os.path.abspath(fw)
+        self.options = options
+        self.priority = priority
+        self.out_dir = out_dir
+        self.source = source
+        self.state = "queued"
+        self.error = None
+        self.output = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            "id":        self.id,
+            "fw":        self.fw,
+            "options":   self.options,
+            "priority":  self.priority,
+            "out_dir":   self.out_dir,
+            "source":    self.source,
+            "state":     self.state,
+            "error":     self.error,
+            "output":    self.output,
+            "submitted": self.submitted,
+            "started":   self.started,
+            "finished":  self.finished,
+        }
+
+class Daemon(object):
+    def __init__(self, args):
+        self.spool = os.path.abspath(args.spool)
+        self.out_dir = os.path.abspath(args.out_dir)
+        self.drop_dir = args.drop_dir
+        self.drop_options = args.drop_options.split() if args.drop_options else []
+        self.poll = args.poll
+        self.keep_jobs = args.keep_jobs
+        self.gz_cache = os.path.abspath(args.gz_cache) if args.gz_cache else None
+        self.db = Database(args.target_file)
+        self.cache = RootfsCache(os.path.abspath(args.cache_dir), args.cache_size)
+        self.queue = queue.PriorityQueue()
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        os.makedirs(os.path.join(self.spool, "jobs"), exist_ok=True)
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.workers = []
+        for i in range(args.jobs):
+            t = threading.Thread(target=self.worker, name="worker-%d" % i, daemon=True)
+            t.start()
+            self.workers.append(t)
+        # warm up the database now rather than in the first build
+        self.db.get()
+
+    def submit(self, fw, options=None, priority=10, out_dir=None, source="socket"):
+        if options == None:
+            options = []
+        if not os.path.isfile(fw):
+            raise BuildError("%s not found" % fw)
+        i = 0
+        while i < len(options):
+            if options[i] not in BUILD_OPTIONS:
+                raise BuildError("Unsupported option: %s" % options[i])
+            if BUILD_OPTIONS[options[i]]:
+                i += 1
+                if i == len(options):
+                    raise BuildError("Missing argument for %s" % options[i-1])
+            i += 1
+        self.db.check(os.path.basename(fw), options)
+        with self.lock:
+            job = Job(next(self.ids), fw, options, int(priority), out_dir or self.out_dir, source)
+            self.jobs[job.id] = job
+        logmsg("Job %d queued: %s %s (priority %d)" % (job.id, fw, " ".join(options), job.priority))
+        self.queue.put((job.priority, job.id))
+        return job
+
+    def worker(self):
+        while True:
+            priority, id = self.queue.get()
+            job = self.jobs[id]
+            job.state = "running"
+            job.started = time.time()
+            try:
+                job.output = self.build(job)
+                job.state = "done"
+                logmsg("Job %d done in %.1f s: %s" % (job.id, time.time() - job.started, job.output))
+            except (BuildError, OSError, subprocess.CalledProcessError) as e:
+                job.state = "failed"
+                job.error = str(e)
+                logmsg("Job %d failed: %s" % (job.id, e))
+            except Exception as e:
+                # anything else must not kill the worker or leave "wait"
+                # clients hanging
+                job.state = "failed"
+                job.error = "%s: %s" % (type(e).__name__, e)
+                logmsg("Job %d failed: %s" % (job.id, job.error))
+            finally:
+                job.finished = time.time()
+                job.done.set()
+                self.queue.task_done()
+
+    def build(self, job):
+        job_dir = os.path.join(self.spool, "jobs", "%d" % job.id)
+        shutil.rmtree(job_dir, ignore_errors=True)
+        os.makedirs(job_dir)
+        bin_name = os.path.basename(job.fw)
+        fw = os.path.join(job_dir, bin_name)
+        try:
+            os.link(job.fw, fw)
+        except OSError:
+            shutil.copyfile(job.fw, fw)
+        digest, rootfs = self.cache.acquire(job.fw, fw, job_dir)
+        try:
+            env = dict(os.environ)
+            if env.get("ASAFW_TRACE"):
+                env["ASAFW_TRACE_BATCH"] = "asafwd-%d" % job.id
+            cmd = [os.environ["UNPACK_REPACK_BIN"], "-i", fw, "--pristine-rootfs", rootfs]
+            if self.gz_cache:
+                cmd += ["--gz-cache", self.gz_cache]
+            cmd += job.options
+            with open(os.path.join(job_dir, "build.log"), "w") as log:
+                ret = subprocess.call(cmd, cwd=job_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        finally:
+            self.cache.release(digest)
+        if ret != 0:
+            raise BuildError("unpack_repack_bin.sh failed (%d), see %s" % (ret, os.path.join(job_dir, "build.log")))
+        outputs = [f for f in glob.glob(os.path.join(job_dir, "*.bin")) if f != fw]
+        if len(outputs) != 1:
+            raise BuildError("Expected one output .bin in %s, found %d" % (job_dir, len(outputs)))
+        os.makedirs(job.out_dir, exist_ok=True)
+        output = os.path.join(job.out_dir, os.path.basename(outputs[0]))
+        shutil.move(outputs[0], output)
+        if os.path.isfile(outputs[0] + ".delta"):
+            shutil.move(outputs[0] + ".delta", output + ".delta")
+        if not self.keep_jobs:
+            shutil.rmtree(job_dir, ignore_errors=True)
+        return output
+
+    def handle(self, req):
+        cmd = req.get("cmd")
+        if cmd == "build":
+            job = self.submit(req.get("fw", ""), req.get("options"), req.get("priority", 10),
+                              req.get("out_dir"))
+            return {"status": "ok", "id": job.id}
+        if cmd in ["status", "wait"]:
+            job = self.jobs.get(req.get("id"))
+            if job == None:
+                raise BuildError("Unknown job: %s" % req.get("id"))
+            if cmd == "wait":
+                job.done.wait()
+            return {"status": "ok", "job": job.to_dict()}
+        if cmd == "list":
+            return {"status": "ok", "jobs": [j.to_dict() for j in self.jobs.values()]}
+        if cmd == "shutdown":
+            self.stopping.set()
+            return {"status": "ok"}
+        raise BuildError("Unknown command: %s" % cmd)
+
+    # Pick up build requests from the drop folder. Files are only taken once
+    # they have not been modified for a poll interval so we don't read a
+    # firmware still being copied
+    def poll_drop_dir(self, pending):
+        for d in ["queued", "done", "failed"]:
+            os.makedirs(os.path.join(self.drop_dir, d), exist_ok=True)
+        for name in sorted(os.listdir(self.drop_dir)):
+            path = os.path.join(self.drop_dir, name)
+            if not os.path.isfile(path) or not (name.endswith(".json") or name.endswith(".bin")):
+                continue
+            if time.time() - os.stat(path).st_mtime < self.poll:
+                continue
+            queued = os.path.join(self.drop_dir, "queued", name)
+            os.rename(path, queued)
+            try:
+                if name.endswith(".json"):
+                    with open(queued, "r") as tmp:
+                        req = json.loads(tmp.read())
+                    job = self.submit(req.get("fw", ""), req.get("options"), req.get("priority", 10),
+                                      req.get("out_dir"), source="drop")
+                else:
+                    job = self.submit(queued, self.drop_options, source="drop")
+            except (BuildError, ValueError) as e:
+                logmsg("Rejected %s: %s" % (name, e))
+                os.rename(queued, os.path.join(self.drop_dir, "failed", name))
+                open(os.path.join(self.drop_dir, "failed", name + ".result.json"), "w").write(
+                        json.dumps({"error": str(e)}, indent=4))
+                continue
+            pending.append((queued, job))
+        for queued, job in list(pending):
+            if not job.done.is_set():
+                continue
+            pending.remove((queued, job))
+            name = os.path.basename(queued)
+            d = "done" if job.state == "done" else "failed"
+            os.rename(queued, os.path.join(self.drop_dir, d, name))
+            open(os.path.join(self.drop_dir, d, name + ".result.json"), "w").write(
+                    json.dumps(job.to_dict(), indent=4))
+
+    def run(self, sock_path):
+        daemon = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        resp = daemon.handle(json.loads(line.decode("UTF-8")))
+                    except (BuildError, ValueError) as e:
+                        resp = {"status": "error", "error": str(e)}
+                    self.wfile.write(bytes(json.dumps(resp) + "\n", encoding="UTF-8"))
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(sock_path):
+            os.remove(sock_path)
+        server = Server(sock_path, Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logmsg("Listening on %s with %d workers" % (sock_path, len(self.workers)))
+        if self.drop_dir:
+            logmsg("Watching %s" % self.drop_dir)
+        pending = []
+        try:
+            while not self.stopping.wait(self.poll):
+                if self.drop_dir:
+                    self.poll_drop_dir(pending)
+        except KeyboardInterrupt:
+            pass
+        logmsg("Shutting down")
+        server.shutdown()
+        server.server_close()
+        os.remove(sock_path)
+
+# Send one request to a running asafwd.py and return its response
+def request(sock_path, req):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(sock_path)
+        s.sendall(bytes(json.dumps(req) + "\n", encoding="UTF-8"))
+        f = s.makefile("rb")
+        return json.loads(f.readline().decode("UTF-8"))
+    finally:
+        s.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-S', dest='socket', default=default_socket(),
+                        help="Unix socket path (default: %(default)s)")
+    parser.add_argument('--serve', dest='serve', action="store_true",
+                        help="Run the build service")
+    parser.add_argument('-d', dest='target_file', default=os.environ.get("ASADBG_DB"),
+                        help="JSON db name (default: $ASADBG_DB)")
+    parser.add_argument('-j', dest='jobs', type=int, default=os.cpu_count(),
+                        help="Number of workers (default: number of CPUs)")
+    parser.add_argument('-o', dest='out_dir', default=os.environ.get("OUTDIR", "/tmp"),
+                        help="Default output folder (default: $OUTDIR)")
+    parser.add_argument('-w', dest='drop_dir', default=None,
+                        help="Drop folder to watch for *.json build requests and *.bin firmware")
+    parser.add_argument('--drop-options', dest='drop_options', default="-f -g",
+                        help="unpack_repack_bin.sh options for *.bin dropped (default: %(default)s)")
+    parser.add_argument('--poll', dest='poll', type=float, default=2,
+                        help="Drop folder poll interval in seconds")
+    parser.add_argument('--spool', dest='spool', default=os.path.join(os.environ.get("WORKDIR", "/tmp"), "asafwd"),
+                        help="Folder for the job folders (default: %(default)s)")
+    parser.add_argument('--cache-dir', dest='cache_dir', default=default_cache_dir(),
+                        help="Pristine rootfs cache folder (default: %(default)s)")
+    parser.add_argument('--cache-size', dest='cache_size', type=int, default=8,
+                        help="Number of pristine rootfs to keep (default: %(default)s)")
+    parser.add_argument('--gz-cache', dest='gz_cache', default=None,
+                        help="Compress the rootfs with cpiogz.py, caching the segments in this folder (e.g. %s). The rootfs is a bit bigger than with gzip -9 (default: gzip -9)" % cpiogz.default_cache_dir())
+    parser.add_argument('--keep-jobs', dest='keep_jobs', action="store_true",
+                        help="Don't delete the job folders of successful builds")
+    parser.add_argument('-b', dest='build', default=None,
+                        help="Client: firmware to build, options after --")
+    parser.add_argument('-p', dest='priority', type=int, default=10,
+                        help="Client: priority of the build, lower first (default: %(default)s)")
+    parser.add_argument('-O', dest='build_out_dir', default=None,
+                        help="Client: output folder of the build")
+    parser.add_argument('-s', dest='status', type=int, default=None,
+                        help="Client: show a job")
+    parser.add_argument('-W', dest='wait', action="store_true",
+                        help="Client: wait for the build/job to finish")
+    parser.add_argument('-l', dest='list', action="store_true",
+                        help="Client: list all jobs")
+    parser.add_argument('--shutdown', dest='shutdown', action="store_true",
+                        help="Client: stop the build service")
+    parser.add_argument('options', nargs=argparse.REMAINDER,
+                        help="unpack_repack_bin.sh options for -b")
+    args = parser.parse_args()
+
+    if args.serve:
+        if "ASATOOLS" not in os.environ:
+            logmsg("This tool relies on env.sh which has not been sourced")
+            logmsg("NOTE: Use sudo -E if you already sourced env.sh")
+            sys.exit(1)
+        if os.geteuid() != 0:
+            logmsg("You need to be root so repacked versions have the right uid/gid")
+            sys.exit(1)
+        Daemon(args).run(args.socket)
+        sys.exit()
+
+    options = args.options
+    if len(options) > 0 and options[0] == "--":
+        options = options[1:]
+    try:
+        if args.build != None:
+            resp = request(args.socket, {"cmd": "build", "fw": os.path.abspath(args.build),
+                "options": options, "priority": args.priority, "out_dir": args.build_out_dir})
+            if resp["status"] == "ok" and args.wait:
+                resp = request(args.socket, {"cmd": "wait", "id": resp["id"]})
+        elif args.status != None:
+            resp = request(args.socket, {"cmd": "wait" if args.wait else "status", "id": args.status})
+        elif args.list:
+            resp = request(args.socket, {"cmd": "list"})
+        elif args.shutdown:
+            resp = request(args.socket, {"cmd": "shutdown"})
+        else:
+            parser.print_help()
+            sys.exit(1)
+    except OSError as e:
+        logmsg("Error: can't talk to asafwd.py on %s: %s" % (args.socket, e))
+        sys.exit(1)
+    print(json.dumps(resp, indent=4))
+    if resp["status"] != "ok" or resp.get("job", {}).get("state") == "failed":
+        sys.exit(1)
@@ -19,6 +19,16 @@ import struct
 import binascii
 import argparse
 import re, os
+import mmap
+import zlib
+import shutil
+import socket
+from tracelog import stage
+import newc
+import zran
+import delta
+import json
+import bisect
 
 def logmsg(s, end=None):
     if type(s) == str:
@@ -29,6 +39,15 @@ def logmsg(s, end=None):
     else:
         print(s)
 
+# Start of the kernel command lines, which follow the vmlinuz and rootfs sizes
+KERNEL_CMDLINES = [
+    b"quiet loglevel=0 auto",
+    b"auto quiet loglevel=0", # e.g. for 8.0.3
+    b"quiet loglevel=0 ide1=noprobe", # e.g. for 8.0.4
+    b"rdinit=/bin/sh", # after root()
+    b"norandmaps quiet", # after disable_aslr()
+]
+
 def find_offsets(bin_data):
     """Find specific offsets in the asa*.bin file that are useful for unpacking
     and repacking.
@@ -38,11 +57,7 @@ def find_offsets(bin_data):
 
     # extract previous gz size from firmware
     # string is not far from the end so quicker to look for it from the end
-    cmdlines = [
-        b"quiet loglevel=0 auto",
-        b"auto quiet loglevel=0", # e.g. for 8.0.3
-        b"quiet loglevel=0 ide1=noprobe", # e.g. for 8.0.4
-    ]
+    cmdlines = KERNEL_CMDLINES
     i = 0
     while i < len(cmdlines):
         idx = bin_data.rfind(cmdlines[i])
@@ -217,6 +232,226 @@ def disable_aslr(firmwarefile, out_bin_name=None):
     logmsg("disable_aslr: Writing %s (%d bytes)..." % (out_bin_name, len(bin_data)))
     open(out_bin_name, 'wb').write(bin_data)
 
+# Set the IP (and port) the debug shell connects back to (see
+# binfs/asafw_cb.sh) by adding or replacing "asafw_cb=IP:PORT" at the end of
+# the kernel command line. The command line grows into the NUL bytes following
+# it so this is done in place without repacking the rootfs
+CALLBACK_ARG = b"asafw_cb="
+def set_callback(firmwarefile, callback, out_bin_name=None):
+    host, _, port = callback.partition(":")
+    try:
+        if len(host.split(".")) != 4:
+            raise OSError
+        socket.inet_aton(host)
+        if port != "" and not 0 < int(port) < 65536:
+            raise ValueError
+    except (OSError, ValueError):
+        logmsg("Error: Bad callback %s, expected IP or IP:PORT" % callback)
+        sys.exit(1)
+    if out_bin_name != None and out_bin_name != firmwarefile:
+        shutil.copyfile(firmwarefile, out_bin_name)
+    else:
+        out_bin_name = firmwarefile
+
+    with open(out_bin_name, 'r+b') as f:
+        bin_data = mmap.mmap(f.fileno(), 0)
+        try:
+            _, idx_gz_size, _, _ = find_offsets(bin_data)
+            idx_cmdline = idx_gz_size+4
+            end_cmdline = bin_data.find(b"\x00", idx_cmdline)
+            old_cmdline = bin_data[idx_cmdline:end_cmdline]
+            room = len(old_cmdline)
+            while end_cmdline+room-len(old_cmdline) < len(bin_data) and \
+                  bin_data[end_cmdline+room-len(old_cmdline)] == 0 and room < 2048:
+                room += 1
+            new_cmdline = re.sub(rb" ?" + CALLBACK_ARG + rb"\S*", b"", old_cmdline)
+            new_cmdline += b" " + CALLBACK_ARG + callback.encode()
+            # keep at least one NUL
+            if len(new_cmdline) >= room:
+                logmsg("Error: Not enough room after the kernel command line (%d > %d)" % (len(new_cmdline), room - 1))
+                logmsg("Error: Use asafw_cb.conf in the rootfs instead")
+                sys.exit(1)
+            if len(new_cmdline) > 255:
+                logmsg("Warning: Kernel command line longer than 255 bytes, old kernels may truncate it")
+            bin_data[idx_cmdline:idx_cmdline+len(old_cmdline)] = b"\x00" * len(old_cmdline)
+            bin_data[idx_cmdline:idx_cmdline+len(new_cmdline)] = new_cmdline
+            bin_data.flush()
+        finally:
+            bin_data.close()
+    logmsg("Kernel command line: '%s'" % new_cmdline.decode())
+    logmsg("callback: Wrote %s" % out_bin_name)
+
+# Random access index over the rootfs gzip (see zran.py), saved as JSON next
+# to the firmware. It also maps every path of the rootfs to the offset of its
+# data in the uncompressed cpio, so reading one file only decompresses from
+# the closest access point instead of the whole rootfs
+INDEX_VERSION = 1
+
+def default_index_file(firmwarefile):
+    return os.path.splitext(firmwarefile)[0] + '-rootfs-index.json'
+
+# What the index is valid for. The gzip trailer has the crc32 and size of the
+# uncompressed rootfs
+def gz_identity(bin_data):
+    old_gz_size, _, idx_gz, _ = find_offsets(bin_data)
+    return {
+        "bin_size":   len(bin_data),
+        "gz_offset":  idx_gz,
+        "gz_size":    old_gz_size,
+        "gz_trailer": binascii.hexlify(bin_data[idx_gz+old_gz_size-8:idx_gz+old_gz_size]).decode(),
+    }
+
+# inspect is called with each entry of the rootfs, including its data, so
+# other indexes can be built in the same pass (see donors.py)
+def build_index(firmwarefile, index_file=None, span=512*1024, inspect=None):
+    if index_file == None:
+        index_file = default_index_file(firmwarefile)
+    with open(firmwarefile, 'rb') as f:
+        bin_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        index = {"version": INDEX_VERSION, "span": span}
+        index.update(gz_identity(bin_data))
+        reader = zran.IndexingReader(bin_data, index["gz_offset"], index["gz_size"], span)
+        files = {}
+        for e in newc.entries(reader, keep_data=inspect != None):
+            if inspect != None:
+                inspect(e)
+            files[e["name"]] = {
+                "offset": e["offset"],
+                "size":   e["filesize"],
+                "mode":   e["mode"],
+                "uid":    e["uid"],
+                "gid":    e["gid"],
+                "sha256": e["sha256"],
+            }
+        reader.finish()
+        index["points"] = zran.points_to_json(reader.points)
+        index["files"] = files
+    finally:
+        bin_data.close()
+    open(index_file, 'w').write(json.dumps(index, indent=4))
+    logmsg("index: Wrote %s (%d files, %d access points)" % (index_file, len(files), len(index["points"])))
+    return index
+
+# Load the index of a firmware, building it if it is missing or stale
+def load_index(firmwarefile, index_file=None, bin_data=None):
+    if index_file == None:
+        index_file = default_index_file(firmwarefile)
+    if os.path.isfile(index_file):
+        index = json.loads(open(index_file, 'r').read())
+        if index.get("version") == INDEX_VERSION:
+            if bin_data == None:
+                with open(firmwarefile, 'rb') as f:
+                    bin_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            ident = gz_identity(bin_data)
+            if all(index[k] == v for k, v in ident.items()):
+                return index
+        logmsg("Warning: %s is stale, rebuilding it" % index_file)
+    return build_index(firmwarefile, index_file)
+
+# Read one file of the rootfs using the index
+def read_rootfs_file(firmwarefile, path, index_file=None):
+    with open(firmwarefile, 'rb') as f:
+        bin_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        index = load_index(firmwarefile, index_file, bin_data)
+        entry = index["files"].get(newc.normalize_name(path.lstrip("/")))
+        if entry == None:
+            logmsg("Error: %s not found in the rootfs of %s" % (path, firmwarefile))
+            sys.exit(1)
+        if entry["size"] == 0:
+            return b""
+        outs = [p["out"] for p in index["points"]]
+        point = index["points"][bisect.bisect_right(outs, entry["offset"]) - 1]
+        return zran.extract(bin_data, index["gz_offset"], index["gz_size"],
+                            zran.points_from_json([point]), entry["offset"], entry["size"])
+    finally:
+        bin_data.close()
+
+def list_rootfs(firmwarefile, index_file=None):
+    index = load_index(firmwarefile, index_file)
+    for name in sorted(index["files"]):
+        e = index["files"][name]
+        print("%06o %5d %5d %10d /%s" % (e["mode"], e["uid"], e["gid"], e["size"], name))
+
+def first_difference(a, b, start, end, chunk_size=1024*1024):
+    for off in range(start, end, chunk_size):
+        chunk_end = min(off+chunk_size, end)
+        if a[off:chunk_end] != b[off:chunk_end]:
+            for i in range(off, chunk_end):
+                if a[i] != b[i]:
+                    return i
+    return -1
+
+# Check what changed in a repacked asa*.bin compared to its original without
+# extracting anything. The two rootfs gzip are decompressed in lockstep and
+# their cpio entries compared (header and sha256 of the content). Everything
+# outside the gzip slot, the gzip size and the kernel command line must be
+# identical. Returns the number of unexpected differences
+def verify(firmwarefile, repackedfile):
+    logmsg("Verifying %s against %s" % (repackedfile, firmwarefile))
+    with open(firmwarefile, 'rb') as f:
+        bin_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with open(repackedfile, 'rb') as f:
+        repacked_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if len(bin_data) != len(repacked_data):
+            logmsg("Error: Size are different (%d != %d)" % (len(bin_data), len(repacked_data)))
+            return 1
+        # the gzip slot is at the same offset in both files as it is what
+        # repack() relies on
+        old_gz_size, idx_gz_size, idx_gz, _ = find_offsets(bin_data)
+        new_gz_size = struct.unpack("<I", repacked_data[idx_gz_size:idx_gz_size+4])[0]
+        idx_cmdline = idx_gz_size+4
+        # the command line may have grown into the NUL padding (set_callback())
+        end_cmdline = max(bin_data.find(b"\x00", idx_cmdline), repacked_data.find(b"\x00", idx_cmdline))
+        slot_end = min(idx_gz + max(old_gz_size, new_gz_size), idx_gz_size)
+        errors = 0
+
+        logmsg("Gzip size: 0x%x -> 0x%x bytes" % (old_gz_size, new_gz_size))
+        if new_gz_size > idx_gz_size - idx_gz:
+            logmsg("Error: New gzip size overflows its slot")
+            errors += 1
+        old_cmdline = bin_data[idx_cmdline:end_cmdline].rstrip(b"\x00")
+        new_cmdline = repacked_data[idx_cmdline:end_cmdline].rstrip(b"\x00")
+        if old_cmdline != new_cmdline:
+            logmsg("Kernel command line: '%s' -> '%s'" % (old_cmdline.decode(), new_cmdline.decode()))
+        for start, end in [(0, idx_gz), (slot_end, idx_gz_size), (end_cmdline, len(bin_data))]:
+            off = first_difference(bin_data, repacked_data, start, end)
+            if off != -1:
+                logmsg("Error: Unexpected difference outside of the gzip slot at 0x%x" % off)
+                errors += 1
+
+        counts = {"A": 0, "D": 0, "M": 0}
+        try:
+            for status, name, changes in newc.diff(newc.GzipStream(bin_data, idx_gz, old_gz_size),
+                                                   newc.GzipStream(repacked_data, idx_gz, new_gz_size)):
+                counts[status] += 1
+                if changes:
+                    logmsg("%s /%s (%s)" % (status, name, ", ".join(changes)))
+                else:
+                    logmsg("%s /%s" % (status, name))
+        except (newc.NewcError, zlib.error) as e:
+            logmsg("Error: Could not walk the rootfs: %s" % e)
+            errors += 1
+        logmsg("rootfs: %d added, %d removed, %d modified" % (counts["A"], counts["D"], counts["M"]))
+        if errors == 0:
+            logmsg("OK: Only the rootfs, its size and the kernel command line changed")
+        return errors
+    finally:
+        bin_data.close()
+        repacked_data.close()
+
+# Save what changed between an original firmware and a repacked one so the
+# repacked one can be rebuilt with "delta.py -a" (see delta.py)
+def make_delta(firmwarefile, repackedfile, deltafile):
+    bin_data = open(firmwarefile, 'rb').read()
+    old_gz_size, idx_gz_size, idx_gz, _ = find_offsets(bin_data)
+    with open(repackedfile, 'rb') as f:
+        f.seek(idx_gz_size)
+        new_gz_size = struct.unpack("<I", f.read(4))[0]
+    return delta.create(firmwarefile, repackedfile, deltafile, (idx_gz, old_gz_size, new_gz_size))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--firmware-file', dest='firmware_file', default=None)
@@ -227,34 +462,104 @@ if __name__ == '__main__':
     parser.add_argument('-T', '--unroot', dest='unroot', default=False, action="store_true")
     parser.add_argument('-A', '--disable-aslr', dest='disable_aslr', default=False, action="store_true")
     parser.add_argument('-o', '--output-file', dest='outputfile', default=None)
+    parser.add_argument('-V', '--verify', dest='verify', default=None,
+                        help="Original firmware to compare the -f repacked firmware with")
+    parser.add_argument('-c', '--callback', dest='callback', default=None,
+                        help="Set the debug shell callback IP[:PORT] in the kernel command line (in place without -o)")
+    parser.add_argument('-D', '--delta', dest='delta', default=None,
+                        help="With -r, also save the delta from the firmware to the repacked one in this file")
+    parser.add_argument('--index', dest='index', default=False, action="store_true",
+                        help="Build the random access index of the rootfs")
+    parser.add_argument('--ls', dest='ls', default=False, action="store_true",
+                        help="List the rootfs files using the index")
+    parser.add_argument('--cat', dest='cat', default=None,
+                        help="Read one rootfs file using the index, to -o or stdout")
+    parser.add_argument('-x', '--index-file', dest='index_file', default=None,
+                        help="Index file (default: <firmware>-rootfs-index.json)")
+    parser.add_argument('--span', dest='span', type=int, default=512*1024,
+                        help="Uncompressed bytes between index access points")
     args = parser.parse_args()
 
-    if args.unpack == False and args.repack == False and args.root == False and args.unroot == False:
-        parser.error("[bin] Error: You need to provide at one of the following options: -u or -r or -t or -T")
+    if args.unpack == False and args.repack == False and args.root == False and args.unroot == False \
+       and args.verify == None and args.callback == None and args.index == False and args.ls == False \
+       and args.cat == None:
+        parser.error("[bin] Error: You need to provide at one of the following options: -u or -r or -t or -T or -V or -c or --index or --ls or --cat")
+
+    if args.index or args.ls or args.cat:
+        if not args.firmware_file:
+            parser.error("[bin] Error: Provide a firmware file")
+        try:
+            if args.index:
+                with stage("bin.index", inputs=[args.firmware_file]):
+                    build_index(args.firmware_file, args.index_file, args.span)
+            if args.ls:
+                list_rootfs(args.firmware_file, args.index_file)
+            if args.cat:
+                data = read_rootfs_file(args.firmware_file, args.cat, args.index_file)
+                if args.outputfile:
+                    open(args.outputfile, 'wb').write(data)
+                else:
+                    sys.stdout.buffer.write(data)
+        except (newc.NewcError, zran.ZranError) as e:
+            logmsg("Error: %s" % e)
+            sys.exit(1)
+        sys.exit()
+
+    if args.callback:
+        if not args.firmware_file:
+            parser.error("[bin] Error: Provide a firmware file to set the callback in")
+        with stage("bin.callback", inputs=[args.firmware_file], outputs=[args.outputfile or args.firmware_file]):
+            set_callback(args.firmware_file, args.callback, args.outputfile)
+        sys.exit()
+
+    if args.verify:
+        if not args.firmware_file:
+            parser.error("[bin] Error: Provide a repacked firmware file to verify")
+        with stage("bin.verify", inputs=[args.verify, args.firmware_file]):
+            errors = verify(args.verify, args.firmware_file)
+        if errors != 0:
+            sys.exit(1)
+        sys.exit()
 
     if args.repack:
         if not args.firmware_file or not args.gzip_file:
             parser.error("[bin] Error: Provide a firmware and a gzip file for repacking")
-        repack(args.firmware_file, args.gzip_file, args.outputfile)
+        with stage("bin.repack", inputs=[args.firmware_file, args.gzip_file], outputs=[args.outputfile]):
+            repack(args.firmware_file, args.gzip_file, args.outputfile)
         if args.disable_aslr:
-            disable_aslr(args.outputfile, args.outputfile)
+            with stage("bin.disable_aslr", inputs=[args.outputfile], outputs=[args.outputfile]):
+                disable_aslr(args.outputfile, args.outputfile)
             if args.root:
                 logmsg("Warning: Ignore '--root' option for we have to disable ASLR using kernel parameter 'norandmaps'")
         elif args.root:
-            root(args.outputfile, args.outputfile)
+            with stage("bin.root", inputs=[args.outputfile], outputs=[args.outputfile]):
+                root(args.outputfile, args.outputfile)
+        if args.delta:
+            outputfile = args.outputfile
+            if outputfile == None:
+                fileinfo = os.path.splitext(args.firmware_file)
+                outputfile = fileinfo[0] + '-repacked' + fileinfo[1]
+            try:
+                with stage("bin.delta", inputs=[args.firmware_file, outputfile], outputs=[args.delta]):
+                    make_delta(args.firmware_file, outputfile, args.delta)
+            except (delta.DeltaError, zran.ZranError, newc.NewcError, zlib.error) as e:
+                logmsg("Error: Could not create the delta: %s" % e)
+                sys.exit(1)
         sys.exit()
 
     if args.unpack:
         if not args.firmware_file:
             parser.error("[bin] Error: Provide a firmware file for unpacking")
-        unpack(args.firmware_file)
+        with stage("bin.unpack", inputs=[args.firmware_file]):
+            unpack(args.firmware_file)
         sys.exit()
 
     # For option args.disable_aslr has conflict with option args.root, just give preference to the former.
     if args.disable_aslr:
         if not args.firmware_file:
             parser.error("[bin] Error: Provide a firmware file for disabling ASLR")
-        disable_aslr(args.firmware_file, args.outputfile)
+        with stage("bin.disable_aslr", inputs=[args.firmware_file], outputs=[args.outputfile]):
+            disable_aslr(args.firmware_file, args.outputfile)
         if args.root:
             logmsg("Warning: Ignore '--root' option for we have to disable ASLR using kernel parameter 'norandmaps'")
         sys.exit()
@@ -262,11 +567,13 @@ if __name__ == '__main__':
     if args.root:
         if not args.firmware_file:
             parser.error("[bin] Error: Provide a firmware file for rooting")
-        root(args.firmware_file, args.outputfile)
+        with stage("bin.root", inputs=[args.firmware_file], outputs=[args.outputfile]):
+            root(args.firmware_file, args.outputfile)
         sys.exit()
 
     if args.unroot:
         if not args.firmware_file:
             parser.error("[bin] Error: Provide a firmware file for unrooting")
-        unroot(args.firmware_file, args.outputfile)
+        with stage("bin.unroot", inputs=[args.firmware_file], outputs=[args.outputfile]):
+            unroot(args.firmware_file, args.outputfile)
         sys.exit()
@@ -0,0 +1,53 @@
+#!/bin/sh
+#
+# Set the IP/port the debug shell connects back to before lina starts, so the
+# same image can be used with different debugger hosts.
+#
+# The offsets of the IP/port in lina are saved by lina.py in asafw_cb.conf,
+# along with the values used when the image was built. They are overridden by
+# asafw_cb=IP or asafw_cb=IP:PORT in the kernel command line (see
+# bin.py --callback) or by editing asafw_cb.conf.
+
+CONF=/asa/scripts/asafw_cb.conf
+if [ ! -f $CONF ]
+then
+	echo "[asafw_cb] No $CONF, nothing to do" >&2
+	exit 0
+fi
+. $CONF
+
+for ARG in $(cat /proc/cmdline 2>/dev/null)
+do
+	case $ARG in
+	asafw_cb=*:*)
+		CB_HOST=${ARG#asafw_cb=}
+		CB_PORT=${CB_HOST##*:}
+		CB_HOST=${CB_HOST%:*}
+		;;
+	asafw_cb=*)
+		CB_HOST=${ARG#asafw_cb=}
+		;;
+	esac
+done
+
+# prints a byte as an octal escape for printf
+octal()
+{
+	printf '\\%03o' $1
+}
+
+OLDIFS=$IFS
+IFS=.
+set -- $CB_HOST
+IFS=$OLDIFS
+if [ $# != 4 ]
+then
+	echo "[asafw_cb] Bad IP address: $CB_HOST" >&2
+	exit 1
+fi
+printf "$(octal $1)$(octal $2)$(octal $3)$(octal $4)" | \
+	dd of=$CB_LINA bs=1 seek=$CB_IP_OFFSET conv=notrunc 2>/dev/null
+printf "$(octal $((CB_PORT >> 8)))$(octal $((CB_PORT & 255)))" | \
+	dd of=$CB_LINA bs=1 seek=$CB_PORT_OFFSET conv=notrunc 2>/dev/null
+
+echo "[asafw_cb] Debug shell connects back to $CB_HOST:$CB_PORT" >&2
@@ -1,8 +1,27 @@
 #!/bin/sh
 #
 # Attach gdbserver to already started lina userland process
+#
+# Usage: lattach.sh [<tcp_port>|<serial_device>]
 
-if [ -e /dev/ttyUSB0 ]
+# gdbserver listens on the TCP port (or serial device) given as argument, or
+# on the TCP port saved in asafw_gdb.conf (unpack_repack_bin.sh --gdb-tcp),
+# else on the serial port
+if [ ! -z "$1" ]
+then
+	case $1 in
+	/dev/*)
+		DEBUG_PORT=$1
+		;;
+	*)
+		DEBUG_PORT=:$1
+		;;
+	esac
+elif [ -f /asa/scripts/asafw_gdb.conf ]
+then
+	. /asa/scripts/asafw_gdb.conf
+	DEBUG_PORT=:$GDB_TCP_PORT
+elif [ -e /dev/ttyUSB0 ]
 then
 	# Real ASA
 	DEBUG_PORT=/dev/ttyUSB0
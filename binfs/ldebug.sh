@@ -1,14 +1,39 @@
 #!/bin/sh
 #
 # Start lina userland process under gdbserver without reboot the whole Linux OS
+#
+# Usage: ldebug.sh [<tcp_port>|<serial_device>]
 
 /asa/scripts/lkill.sh
 /asa/scripts/lclean.sh
 
+# debug shell callback from the kernel command line or asafw_cb.conf
+if [ -x /asa/scripts/asafw_cb.sh ]
+then
+	/asa/scripts/asafw_cb.sh
+fi
+
 # we don't use lina_monitor to keep it simple and also so it does not reboot
 # when lina exits. Also we run it in the background so we can issue other
 # commands like killing stale gdbserver or lina after it exits/crashes...
-if [ -e /dev/ttyUSB0 ]
+# gdbserver listens on the TCP port (or serial device) given as argument, or
+# on the TCP port saved in asafw_gdb.conf (unpack_repack_bin.sh --gdb-tcp),
+# else on the serial port
+if [ ! -z "$1" ]
+then
+	case $1 in
+	/dev/*)
+		DEBUG_PORT=$1
+		;;
+	*)
+		DEBUG_PORT=:$1
+		;;
+	esac
+elif [ -f /asa/scripts/asafw_gdb.conf ]
+then
+	. /asa/scripts/asafw_gdb.conf
+	DEBUG_PORT=:$GDB_TCP_PORT
+elif [ -e /dev/ttyUSB0 ]
 then
 	# Real ASA
 	DEBUG_PORT=/dev/ttyUSB0
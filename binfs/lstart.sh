@@ -9,6 +9,12 @@
 /asa/scripts/lkill.sh
 /asa/scripts/lclean.sh
 
+# debug shell callback from the kernel command line or asafw_cb.conf
+if [ -x /asa/scripts/asafw_cb.sh ]
+then
+	/asa/scripts/asafw_cb.sh
+fi
+
 # we don't use lina_monitor to keep it simple and also so it does not reboot
 # when lina exits
 
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+#
+# This file is part of asafw.
+# Copyright (c) 2017, Aaron Adams <aaron.adams(at)nccgroup(dot)trust>
+# Copyright (c) 2017, Cedric Halbronn <cedric.halbronn(at)nccgroup(dot)trust>
+#
+# Create the gzip compressed cpio rootfs of a firmware from a directory, like
+# "find . | cpio -o -H newc | gzip -9", but reusing the compressed data of the
+# previous builds.
+#
+# The cpio archive is cut into segments at file boundaries and each segment is
+# compressed as raw deflate ending with a full flush. A full flush ends on a
+# byte boundary and resets the dictionary, so compressed segments can be
+# concatenated in any combination and still form a valid deflate stream. They
+# are saved in a cache folder, named by the sha256 of their uncompressed data.
+# Repacking a rootfs where only lina and a few scripts changed then only
+# compresses the segments holding them and copies the others from the cache.
+# The gzip CRC is updated segment by segment as the archive is created.
+#
+# A segment ends before a file bigger than --segment-size, so big binaries
+# get a segment of their own, and after a file whose name hashes to 0 modulo
+# 8 once the segment is bigger than --segment-size. Using the names rather
+# than the sizes means a file growing only changes the segments around it.
+# Segments are never bigger than 4 x --segment-size unless they hold a single
+# big file.
+#
+# The cached segments are compressed at level 9, which is what cpio.sh and
+# unpack_repack_bin.sh use. The compressed rootfs is still bigger than with
+# gzip -9: the full flushes reset the dictionary, so the start of each segment
+# is compressed without any history. Expect several hundred bytes per segment
+# (about 110 KB, or 0.4%, for a 90 MB rootfs cut into 60 segments). As bin.py
+# can't repack a rootfs bigger than the original one, -f gives the firmware
+# the rootfs is for and, if the output does not fit, it is compressed again as
+# a single deflate stream without the cache.
+#
+# The entries are sorted by name, their inode numbers derived from the names
+# and the gzip header has no name nor timestamp. With --mtime, the entries
+# also get a fixed modification time, so the same rootfs content always gives
+# the same bytes (with the same zlib version), wherever and whenever it is
+# built. This is what unpack_repack_bin.sh --deterministic uses.
+
+import argparse
+import collections
+import fcntl
+import hashlib
+import multiprocessing
+import os
+import struct
+import sys
+import zlib
+import mmap
+
+from tracelog import stage
+import bin
+import newc
+
+def logmsg(s, end=None):
+    if type(s) == str:
+        if end != None:
+            print("[cpiogz] " + s, end=end)
+        else:
+            print("[cpiogz] " + s)
+    else:
+        print(s)
+    sys.stdout.flush()
+
+def default_cache_dir():
+    return os.path.join(os.environ.get("WORKDIR", "/tmp"), "asafw-gzcache")
+
+# gzip header without name and timestamp, "maximum compression" flag and Unix
+# as OS, like gzip -9 reading from a pipe
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\x03"
+# empty final block ending the deflate stream
+DEFLATE_END = b"\x03\x00"
+
+# Cut the archive of "root" in segments. Yields the uncompressed data of each
+# segment
+def segments(root, segment_size, mtime=None):
+    seg = []
+    seglen = 0
+    for header, data, path in newc.archive_entries(root, mtime):
+        size = len(data)
+        if path != None:
+            size = os.path.getsize(path)
+        if size >= segment_size and seglen != 0:
+            yield b"".join(seg)
+            seg = []
+            seglen = 0
+        seg.append(header)
+        seg.append(data)
+        if path != None:
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) != size:
+                raise newc.NewcError("%s changed while being archived" % path)
+            seg.append(data)
+        seg.append(newc.padding(len(data)))
+        seglen += len(header) + len(data)
+        name = header[newc.NEWC_HEADER_SIZE:].split(b"\x00")[0]
+        if seglen >= 4 * segment_size or size >= segment_size or \
+           (seglen >= segment_size and zlib.crc32(name) % 8 == 0):
+            yield b"".join(seg)
+            seg = []
+            seglen = 0
+    seg.append(newc.trailer())
+    yield b"".join(seg)
+
+def cache_path(cache_dir, digest):
+    return os.path.join(cache_dir, digest[:2], digest + ".deflate")
+
+# Compress one segment and return it, saving it into the cache too unless
+# path is None. Runs in a worker process
+def compress_segment(job):
+    data, path, level = job
+    c = zlib.compressobj(level, zlib.DEFLATED, -15, 9)
+    out = c.compress(data) + c.flush(zlib.Z_FULL_FLUSH)
+    if path == None:
+        return out
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    open(tmp, 'wb').write(out)
+    os.rename(tmp, path)
+    return out
+
+# Open a cached segment, or return None if it is not in the cache. The file is
+# kept open until it is copied so another build pruning the cache (asafwd.py
+# runs several builds sharing one) can't remove it from under us
+def open_cached(path):
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    os.utime(f.fileno())
+    return f
+
+# Remove the least recently used segments until the cache is smaller than
+# max_size bytes. Only one build prunes at a time, the others skip it, and
+# segments removed by someone else in the meantime are ignored
+def prune_cache(cache_dir, max_size):
+    with open(os.path.join(cache_dir, "prune.lock"), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        files = []
+        for d, _, names in os.walk(cache_dir):
+            for name in names:
+                if name.endswith(".deflate"):
+                    path = os.path.join(d, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, path))
+        total = sum(f[1] for f in files)
+        for mtime, size, path in sorted(files):
+            if total <= max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+# Without cache_dir, all the segments are compressed
+def create(root, outfile, cache_dir=None, segment_size=1024*1024, level=9, jobs=None,
+           max_cache_size=None, mtime=None):
+    if cache_dir != None:
+        os.makedirs(cache_dir, exist_ok=True)
+    pool = multiprocessing.Pool(jobs)
+    # segments still being compressed, written in order as soon as possible
+    pending = collections.deque()
+    window = 2 * (jobs or os.cpu_count())
+    crc = 0
+    total = 0
+    count = 0
+    hits = 0
+    hit_bytes = 0
+    try:
+        with open(outfile, 'wb') as out:
+            out.write(GZIP_HEADER)
+
+            def write_segment(cached, result):
+                if cached != None:
+                    with cached:
+                        out.write(cached.read())
+                else:
+                    out.write(result.get())
+
+            for seg in segments(root, segment_size, mtime):
+                crc = zlib.crc32(seg, crc)
+                total += len(seg)
+                count += 1
+                path = None
+                if cache_dir != None:
+                    h = hashlib.sha256(seg)
+                    h.update(b"level %d" % level)
+                    path = cache_path(cache_dir, h.hexdigest())
+                cached = None
+                if path != None:
+                    cached = open_cached(path)
+                if cached != None:
+                    hits += 1
+                    hit_bytes += len(seg)
+                    pending.append((cached, None))
+                else:
+                    pending.append((None, pool.apply_async(compress_segment, ((seg, path, level),))))
+                while len(pending) != 0 and (pending[0][1] == None or pending[0][1].ready() or
+                                             len(pending) > window):
+                    write_segment(*pending.popleft())
+            while len(pending) != 0:
+                write_segment(*pending.popleft())
+            out.write(DEFLATE_END)
+            out.write(struct.pack("<II", crc, total & 0xffffffff))
+        pool.close()
+    finally:
+        pool.terminate()
+    logmsg("Wrote %s: %d segments, %d from cache (%d/%d MB not recompressed)" % \
+           (outfile, count, hits, hit_bytes // (1024*1024), total // (1024*1024)))
+    if cache_dir != None and max_cache_size != None:
+        prune_cache(cache_dir, max_cache_size)
+    return count, hits
+
+# Compress the whole archive as one deflate stream, like gzip -9. Slower as
+# nothing comes from the cache but as small as it gets
+def create_single(root, outfile, level=9, mtime=None):
+    c = zlib.compressobj(level, zlib.DEFLATED, -15, 9)
+    crc = 0
+    total = 0
+    with open(outfile, 'wb') as out:
+        out.write(GZIP_HEADER)
+        for seg in segments(root, 1024*1024, mtime):
+            crc = zlib.crc32(seg, crc)
+            total += len(seg)
+            out.write(c.compress(seg))
+        out.write(c.flush())
+        out.write(struct.pack("<II", crc, total & 0xffffffff))
+    logmsg("Wrote %s as a single stream (%d MB)" % (outfile, total // (1024*1024)))
+
+# Size of the gzip rootfs slot of a firmware, which the new rootfs must fit in
+def slot_size(firmwarefile):
+    with open(firmwarefile, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        gz_size, _, _, _ = bin.find_offsets(data)
+    finally:
+        data.close()
+    return gz_size
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', dest='rootfs', required=True,
+                        help="Directory to turn into the gzip cpio rootfs")
+    parser.add_argument('-o', dest='outfile', required=True,
+                        help="Output .gz file")
+    parser.add_argument('-C', '--cache', dest='cache_dir', default=default_cache_dir(),
+                        help="Compressed segments cache folder (default: %(default)s)")
+    parser.add_argument('--no-cache', dest='no_cache', default=False, action="store_true",
+                        help="Compress everything without using the cache")
+    parser.add_argument('--mtime', dest='mtime', type=int, default=None,
+                        help="Use this modification time (seconds since the epoch) for all the entries, for reproducible output")
+    parser.add_argument('--cache-size', dest='cache_size', type=int, default=2048,
+                        help="Maximum size of the cache in MB (default: %(default)s)")
+    parser.add_argument('--segment-size', dest='segment_size', type=int, default=1024,
+                        help="Minimum segment size in KB (default: %(default)s)")
+    parser.add_argument('-j', dest='jobs', type=int, default=None,
+                        help="Number of compression workers (default: number of CPUs)")
+    parser.add_argument('-f', dest='firmwarefile', default=None,
+                        help="asa*.bin the rootfs is for: compress again as a single stream if the output is bigger than its rootfs")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.rootfs):
+        logmsg("Error: %s is not a directory" % args.rootfs)
+        sys.exit(1)
+    max_size = None
+    if args.firmwarefile != None:
+        max_size = slot_size(args.firmwarefile)
+    with stage("cpiogz.create", outputs=[args.outfile]):
+        create(args.rootfs, args.outfile, None if args.no_cache else args.cache_dir,
+               args.segment_size * 1024, jobs=args.jobs, max_cache_size=args.cache_size * 1024 * 1024,
+               mtime=args.mtime)
+    if max_size == None or os.path.getsize(args.outfile) <= max_size:
+        return
+    logmsg("%s is bigger than the rootfs of %s (%d > %d bytes), compressing it again as a single stream" %
+           (args.outfile, args.firmwarefile, os.path.getsize(args.outfile), max_size))
+    with stage("cpiogz.create_single", outputs=[args.outfile]):
+        create_single(args.rootfs, args.outfile, mtime=args.mtime)
+    if os.path.getsize(args.outfile) > max_size:
+        logmsg("Error: %s is still bigger than the rootfs of %s (%d > %d bytes), free some space (unpack_repack_bin.sh --free-space)" %
+               (args.outfile, args.firmwarefile, os.path.getsize(args.outfile), max_size))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+#
+# This file is part of asafw.
+# Copyright (c) 2017, Aaron Adams <aaron.adams(at)nccgroup(dot)trust>
+# Copyright (c) 2017, Cedric Halbronn <cedric.halbronn(at)nccgroup(dot)trust>
+#
+# Compact deltas between an original asa*.bin/qcow2 and a repacked one, so
+# only the delta needs to be copied to hosts that already have the original.
+#
+# A delta is a list of the ranges that changed, with their new content. For an
+# asa*.bin created by bin.py -r (see bin.py -D), the gzip rootfs is not saved
+# as is as it would be almost entirely new. Instead we save:
+# - how to rebuild the uncompressed rootfs (cpio archive) from the original
+#   one: the content of the files that did not change is copied from it
+# - how it was compressed: the offsets of the full flushes (see cpiogz.py) and
+#   the compression level
+# When applying the delta, the rootfs is compressed again and the result
+# checked. This only works if the compression can be reproduced with zlib,
+# which is the case for rootfs created by cpiogz.py (unpack_repack_bin.sh
+# --delta uses it) but not with gzip -9. Otherwise the whole gzip slot is saved
+# as is, and the delta is about as big as the rootfs.
+#
+# The sha256 of the original and of the output are saved in the delta and
+# checked when applying it.
+#
+# Format: "ASAFWDLT" + version (1 byte) + JSON header length (4 bytes, little
+# endian) + JSON header + the zlib compressed "ranges" and "cpio" data.
+
+import argparse
+import hashlib
+import io
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import zlib
+
+from tracelog import stage
+import newc
+import zran
+
+DELTA_MAGIC = b"ASAFWDLT"
+DELTA_VERSION = 1
+# compare the files by blocks of that size before looking for the exact
+# changed bytes
+BLOCK_SIZE = 4096
+# changed ranges closer than this are merged
+MERGE_GAP = 32
+
+class DeltaError(Exception):
+    pass
+
+def logmsg(s, end=None):
+    if type(s) == str:
+        if end != None:
+            print("[delta] " + s, end=end)
+        else:
+            print("[delta] " + s)
+    else:
+        print(s)
+    sys.stdout.flush()
+
+def sha256(data):
+    h = hashlib.sha256()
+    mv = memoryview(data)
+    for i in range(0, len(mv), 16*1024*1024):
+        h.update(mv[i:i+16*1024*1024])
+    return h.hexdigest()
+
+# Ranges of "target" that differ from "source" between start and end, as a
+# list of [offset, length]. "target" can be bigger than "source"
+def changed_ranges(source, target, start, end):
+    ranges = []
+    src = memoryview(source)
+    tgt = memoryview(target)
+    for blk in range(start, end, BLOCK_SIZE):
+        blk_end = min(blk + BLOCK_SIZE, end)
+        if blk_end <= len(src) and src[blk:blk_end] == tgt[blk:blk_end]:
+            continue
+        # one range from the first to the last changed byte of the block
+        i = blk
+        while i < blk_end and i < len(src) and src[i] == tgt[i]:
+            i += 1
+        j = blk_end
+        while j > i and j <= len(src) and src[j-1] == tgt[j-1]:
+            j -= 1
+        if len(ranges) != 0 and i - (ranges[-1][0] + ranges[-1][1]) <= MERGE_GAP:
+            ranges[-1][1] = j - ranges[-1][0]
+        else:
+            ranges.append([i, j - i])
+    return ranges
+
+def gzip_header_size(data, off):
+    if data[off:off+3] != b"\x1f\x8b\x08":
+        raise DeltaError("No gzip stream at 0x%x" % off)
+    flags = data[off+3]
+    pos = off + 10
+    if flags & 4:
+        pos += 2 + struct.unpack("<H", data[pos:pos+2])[0]
+    for flag in [8, 16]:
+        if flags & flag:
+            while data[pos] != 0:
+                pos += 1
+            pos += 1
+    if flags & 2:
+        pos += 2
+    return pos - off
+
+def compress_segment(job):
+    data, level, last = job
+    c = zlib.compressobj(level, zlib.DEFLATED, -15, 9)
+    if last:
+        return c.compress(data) + c.flush(zlib.Z_FINISH)
+    return c.compress(data) + c.flush(zlib.Z_FULL_FLUSH)
+
+# Compress the cpio archive as described in "rootfs" (see rootfs_recipe())
+def recompress(cpio, rootfs, jobs=None):
+    offsets = [0] + rootfs["flushes"] + [len(cpio)]
+    work = []
+    for i in range(len(offsets) - 1):
+        work.append((cpio[offsets[i]:offsets[i+1]], rootfs["level"], i == len(offsets) - 2))
+    if len(work) == 1:
+        deflated = [compress_segment(work[0])]
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            deflated = pool.map(compress_segment, work)
+            pool.close()
+        finally:
+            pool.terminate()
+    return bytes.fromhex(rootfs["header"]) + b"".join(deflated) + \
+           struct.pack("<II", zlib.crc32(cpio), len(cpio) & 0xffffffff)
+
+# Describe how to rebuild the uncompressed rootfs of the target from the one
+# of the source. Returns the operations and the data they need
+def cpio_ops(source_cpio, target_cpio):
+    known = {}
+    for e in newc.entries(io.BytesIO(source_cpio)):
+        if e["filesize"] != 0:
+            known.setdefault(e["sha256"], e["offset"])
+    ops = []
+    literal = []
+    pos = 0
+
+    def add(op, off, size):
+        if size == 0:
+            return
+        if op == "data":
+            literal.append(target_cpio[off:off+size])
+            if len(ops) != 0 and ops[-1][0] == "data":
+                ops[-1][1] += size
+                return
+            ops.append(["data", size])
+        else:
+            if len(ops) != 0 and ops[-1][0] == "copy" and ops[-1][1] + ops[-1][2] == off:
+                ops[-1][2] += size
+                return
+            ops.append(["copy", off, size])
+
+    for e in newc.entries(io.BytesIO(target_cpio)):
+        if e["filesize"] == 0 or e["sha256"] not in known:
+            continue
+        add("data", pos, e["offset"] - pos)
+        add("copy", known[e["sha256"]], e["filesize"])
+        pos = e["offset"] + e["filesize"]
+    add("data", pos, len(target_cpio) - pos)
+    return ops, b"".join(literal)
+
+def apply_cpio_ops(source_cpio, ops, literal):
+    out = []
+    pos = 0
+    for op in ops:
+        if op[0] == "copy":
+            out.append(source_cpio[op[1]:op[1]+op[2]])
+        else:
+            out.append(literal[pos:pos+op[1]])
+            pos += op[1]
+    return b"".join(out)
+
+# Try to describe the gzip slot of the target as a rebuild of the rootfs of
+# the source. Returns (rootfs, cpio literal data) or (None, None) if the
+# compression can't be reproduced
+def rootfs_recipe(source, target, gz_offset, source_gz_size, target_gz_size, jobs=None):
+    header_size = gzip_header_size(target, gz_offset)
+    target_cpio = zlib.decompress(target[gz_offset:gz_offset+target_gz_size], 31)
+    rootfs = {
+        "offset":      gz_offset,
+        "source_size": source_gz_size,
+        "size":        target_gz_size,
+        "header":      target[gz_offset:gz_offset+header_size].hex(),
+        "flushes":     zran.flush_offsets(target, gz_offset, target_gz_size),
+        "level":       9,
+    }
+    if recompress(target_cpio, rootfs, jobs) != target[gz_offset:gz_offset+target_gz_size]:
+        return None, None
+    source_cpio = zlib.decompress(source[gz_offset:gz_offset+source_gz_size], 31)
+    rootfs["ops"], literal = cpio_ops(source_cpio, target_cpio)
+    return rootfs, literal
+
+# Create a delta from "sourcefile" to "targetfile". For an asa*.bin, "slot"
+# is (gz_offset, source_gz_size, target_gz_size)
+def create(sourcefile, targetfile, deltafile, slot=None, jobs=None):
+    with open(sourcefile, 'rb') as f:
+        source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with open(targetfile, 'rb') as f:
+        target = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        header = {
+            "source": {"size": len(source), "sha256": sha256(source)},
+            "target": {"size": len(target), "sha256": sha256(target)},
+            "rootfs": None,
+        }
+        literal = b""
+        skip = None
+        if slot != None:
+            rootfs, literal = rootfs_recipe(source, target, slot[0], slot[1], slot[2], jobs)
+            if rootfs == None:
+                logmsg("Warning: Can't reproduce the rootfs compression with zlib, saving the whole rootfs (%d bytes)" % slot[2])
+                logmsg("Warning: Compress the rootfs with cpiogz.py for a small delta")
+                literal = b""
+            else:
+                header["rootfs"] = rootfs
+                skip = (slot[0], slot[0] + slot[2])
+        if skip != None:
+            ranges = changed_ranges(source, target, 0, skip[0]) + \
+                     changed_ranges(source, target, skip[1], len(target))
+        else:
+            ranges = changed_ranges(source, target, 0, len(target))
+        header["ranges"] = ranges
+        ranges_data = zlib.compress(b"".join(target[off:off+size] for off, size in ranges), 9)
+        cpio_data = zlib.compress(literal, 9)
+        header["ranges_size"] = len(ranges_data)
+        header["cpio_size"] = len(cpio_data)
+    finally:
+        source.close()
+        target.close()
+    hdr = json.dumps(header).encode()
+    with open(deltafile, 'wb') as f:
+        f.write(DELTA_MAGIC + bytes([DELTA_VERSION]) + struct.pack("<I", len(hdr)))
+        f.write(hdr)
+        f.write(ranges_data)
+        f.write(cpio_data)
+    logmsg("Wrote %s (%d bytes for %d bytes, %d ranges%s)" % \
+           (deltafile, os.path.getsize(deltafile), header["target"]["size"], len(ranges),
+            ", rootfs rebuilt" if header["rootfs"] else ""))
+    return header
+
+def read_delta(deltafile):
+    data = open(deltafile, 'rb').read()
+    if data[:len(DELTA_MAGIC)] != DELTA_MAGIC:
+        raise DeltaError("%s is not a delta" % deltafile)
+    pos = len(DELTA_MAGIC)
+    if data[pos] != DELTA_VERSION:
+        raise DeltaError("Unsupported delta version: %d" % data[pos])
+    hdr_size = struct.unpack("<I", data[pos+1:pos+5])[0]
+    pos += 5
+    header = json.loads(data[pos:pos+hdr_size].decode())
+    pos += hdr_size
+    ranges_data = zlib.decompress(data[pos:pos+header["ranges_size"]])
+    pos += header["ranges_size"]
+    cpio_data = zlib.decompress(data[pos:pos+header["cpio_size"]])
+    return header, ranges_data, cpio_data
+
+# Rebuild the target of "deltafile" from "sourcefile" into "outfile"
+def apply(sourcefile, deltafile, outfile, jobs=None):
+    header, ranges_data, cpio_data = read_delta(deltafile)
+    with open(sourcefile, 'rb') as f:
+        source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if len(source) != header["source"]["size"] or sha256(source) != header["source"]["sha256"]:
+            raise DeltaError("%s is not the original file of %s" % (sourcefile, deltafile))
+        gz = None
+        rootfs = header["rootfs"]
+        if rootfs != None:
+            off = rootfs["offset"]
+            source_cpio = zlib.decompress(source[off:off+rootfs["source_size"]], 31)
+            cpio = apply_cpio_ops(source_cpio, rootfs["ops"], cpio_data)
+            del source_cpio
+            gz = recompress(cpio, rootfs, jobs)
+            if len(gz) != rootfs["size"]:
+                raise DeltaError("Rebuilt rootfs size differs (%d != %d)" % (len(gz), rootfs["size"]))
+    finally:
+        source.close()
+    # the output starts as a copy of the source so multi-GB qcow2 are not
+    # loaded in memory
+    tmpfile = outfile + ".tmp"
+    shutil.copyfile(sourcefile, tmpfile)
+    try:
+        with open(tmpfile, 'r+b') as f:
+            f.truncate(header["target"]["size"])
+            if gz != None:
+                f.seek(rootfs["offset"])
+                f.write(gz)
+            pos = 0
+            for off, size in header["ranges"]:
+                f.seek(off)
+                f.write(ranges_data[pos:pos+size])
+                pos += size
+        with open(tmpfile, 'rb') as f:
+            out = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                digest = sha256(out)
+            finally:
+                out.close()
+        if digest != header["target"]["sha256"]:
+            raise DeltaError("The rebuilt file does not match the delta (sha256 differs)")
+        os.rename(tmpfile, outfile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+    logmsg("Wrote %s (%d bytes)" % (outfile, header["target"]["size"]))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--create', dest='create', default=False, action="store_true",
+                        help="Create a delta from -i to -t")
+    parser.add_argument('-a', '--apply', dest='apply', default=False, action="store_true",
+                        help="Apply the -d delta to -i")
+    parser.add_argument('-i', dest='source', required=True,
+                        help="Original asa*.bin/qcow2")
+    parser.add_argument('-t', dest='target', default=None,
+                        help="Repacked asa*.bin/qcow2 (with -c)")
+    parser.add_argument('-d', dest='delta', required=True,
+                        help="Delta file")
+    parser.add_argument('-o', dest='outfile', default=None,
+                        help="Rebuilt file (with -a)")
+    parser.add_argument('-j', dest='jobs', type=int, default=None,
+                        help="Number of compression workers (default: number of CPUs)")
+    args = parser.parse_args()
+
+    try:
+        if args.create:
+            if not args.target:
+                parser.error("[delta] Error: -c requires -t")
+            with stage("delta.create", inputs=[args.source, args.target], outputs=[args.delta]):
+                create(args.source, args.target, args.delta, jobs=args.jobs)
+        elif args.apply:
+            if not args.outfile:
+                parser.error("[delta] Error: -a requires -o")
+            with stage("delta.apply", inputs=[args.source, args.delta], outputs=[args.outfile]):
+                apply(args.source, args.delta, args.outfile, args.jobs)
+        else:
+            parser.error("[delta] Error: You need to provide -c or -a")
+    except (DeltaError, zran.ZranError, newc.NewcError, zlib.error) as e:
+        logmsg("Error: %s" % e)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+#
+# This file is part of asafw.
+# Copyright (c) 2017, Aaron Adams <aaron.adams(at)nccgroup(dot)trust>
+# Copyright (c) 2017, Cedric Halbronn <cedric.halbronn(at)nccgroup(dot)trust>
+#
+# Index of the files of all the firmware in FIRMWAREDIR, used to take files
+# (e.g. gdbserver) from another firmware without extracting it.
+#
+# For each firmware we save the path, size, mode and sha256 of every file of
+# its rootfs, the target of symlinks and, for ELF files, their architecture
+# and the most recent glibc symbol version they need. The firmware itself gets
+# the architecture of lina and the glibc version of its libc. The index is
+# built with bin.py's rootfs index (in the same decompression pass) so the
+# files can then be read straight from the gzip of the donor firmware.
+#
+# Only the firmware added or changed since the last update are indexed.
+#
+# When taking files for a target rootfs, the donor is the firmware holding
+# all of them with the same architecture as the target and not needing a more
+# recent glibc than the one of the target. The closest glibc wins, then the
+# most recent firmware.
+
+import argparse
+import glob
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import stat
+import struct
+import sys
+
+from tracelog import stage
+import bin
+import helper
+import newc
+
+def logmsg(s, end=None):
+    if type(s) == str:
+        if end != None:
+            print("[donors] " + s, end=end)
+        else:
+            print("[donors] " + s)
+    else:
+        print(s)
+    sys.stdout.flush()
+
+DONORS_VERSION = 1
+
+ELF_MACHINES = {
+    3:   "x86",
+    8:   "mips",
+    40:  "arm",
+    62:  "x86_64",
+    183: "aarch64",
+}
+
+SHT_GNU_VERNEED = 0x6ffffffe
+SHT_GNU_VERDEF = 0x6ffffffd
+
+# Names of the symbol versions an ELF needs (SHT_GNU_VERNEED) or defines
+# (SHT_GNU_VERDEF)
+def elf_versions(data, section_type):
+    elfclass = data[4]
+    endian = "<" if data[5] == 1 else ">"
+    if elfclass == 2:
+        shoff, = struct.unpack_from(endian + "Q", data, 0x28)
+        shentsize, shnum = struct.unpack_from(endian + "HH", data, 0x3a)
+        shdr = endian + "IIQQQQIIQQ"
+    else:
+        shoff, = struct.unpack_from(endian + "I", data, 0x20)
+        shentsize, shnum = struct.unpack_from(endian + "HH", data, 0x2e)
+        shdr = endian + "IIIIIIIIII"
+    sections = []
+    for i in range(shnum):
+        sections.append(struct.unpack_from(shdr, data, shoff + i * shentsize))
+    names = []
+    for _, sh_type, _, _, sh_offset, _, sh_link, sh_info, _, _ in sections:
+        if sh_type != section_type:
+            continue
+        strtab = sections[sh_link][4]
+        off = sh_offset
+        for _ in range(sh_info):
+            if section_type == SHT_GNU_VERNEED:
+                _, cnt, _, aux, nxt = struct.unpack_from(endian + "HHIII", data, off)
+                aoff = off + aux
+                for _ in range(cnt):
+                    _, _, _, name, anext = struct.unpack_from(endian + "IHHII", data, aoff)
+                    names.append(data[strtab+name:data.index(b"\x00", strtab+name)].decode())
+                    aoff += anext
+            else:
+                _, _, _, cnt, _, aux, nxt = struct.unpack_from(endian + "HHHHIII", data, off)
+                if cnt != 0:
+                    name, _ = struct.unpack_from(endian + "II", data, off + aux)
+                    names.append(data[strtab+name:data.index(b"\x00", strtab+name)].decode())
+            if nxt == 0:
+                break
+            off += nxt
+    return names
+
+def max_glibc(names):
+    versions = [n[6:] for n in names if re.match(r"GLIBC_\d", n)]
+    if len(versions) == 0:
+        return None
+    return max(versions, key=helper.version_key)
+
+# Architecture and glibc needed by an ELF file, or None if it is not an ELF
+# we can parse
+def elf_info(data):
+    if data[:4] != b"\x7fELF" or len(data) < 0x40:
+        return None
+    endian = "<" if data[5] == 1 else ">"
+    machine, = struct.unpack_from(endian + "H", data, 0x12)
+    info = {"arch": ELF_MACHINES.get(machine, "machine-%d" % machine)}
+    try:
+        info["glibc"] = max_glibc(elf_versions(data, SHT_GNU_VERNEED))
+    except (struct.error, IndexError, ValueError, UnicodeDecodeError):
+        info["glibc"] = None
+    return info
+
+def is_libc(name):
+    return re.match(r"^lib(64)?/libc(-[\d.]+)?\.so(\.6)?$", name) != None
+
+# glibc version defined by a libc
+def libc_version(name, data):
+    match = re.match(r"^lib(64)?/libc-([\d.]+)\.so$", name)
+    if match:
+        return match.group(2)
+    try:
+        return max_glibc(elf_versions(data, SHT_GNU_VERDEF))
+    except (struct.error, IndexError, ValueError, UnicodeDecodeError):
+        return None
+
+# Index one firmware. Runs in a worker process
+def index_firmware(firmwarefile):
+    st = os.stat(firmwarefile)
+    fw = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "arch": None, "glibc": None,
+          "files": {}}
+    # hard links waiting for their data, which comes with the last name
+    links = {}
+
+    def inspect(e):
+        f = {"size": e["filesize"], "mode": e["mode"], "sha256": e["sha256"]}
+        fw["files"][e["name"]] = f
+        if stat.S_ISLNK(e["mode"]):
+            f["link"] = e["data"].decode("UTF-8", "surrogateescape")
+            return
+        if not stat.S_ISREG(e["mode"]):
+            return
+        names = [e["name"]]
+        if e["nlink"] > 1:
+            if e["filesize"] == 0:
+                links.setdefault(e["ino"], []).append(e["name"])
+                return
+            for name in links.pop(e["ino"], []):
+                fw["files"][name] = dict(f, data=e["name"])
+                names.append(name)
+        info = elf_info(e["data"])
+        if info == None:
+            return
+        for name in names:
+            fw["files"][name]["elf"] = info
+            if name == "asa/bin/lina":
+                fw["arch"] = info["arch"]
+            if is_libc(name):
+                version = libc_version(name, e["data"])
+                if version != None and (fw["glibc"] == None or
+                   helper.version_key(version) > helper.version_key(fw["glibc"])):
+                    fw["glibc"] = version
+
+    error = None
+    try:
+        bin.build_index(firmwarefile, inspect=inspect)
+    # find_offsets() exits when the firmware is not a supported .bin
+    except SystemExit:
+        error = "rootfs not found"
+    except Exception as e:
+        error = str(e)
+    if error != None:
+        # kept so it is not indexed again until it changes
+        fw = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "error": error}
+    return os.path.basename(firmwarefile), fw
+
+def load_donors(donors_file):
+    if os.path.isfile(donors_file):
+        donors = json.loads(open(donors_file, 'r').read())
+        if donors.get("version") == DONORS_VERSION:
+            return donors
+    return {"version": DONORS_VERSION, "firmware": {}}
+
+# Index the firmware of firmware_dir that are new or changed, and forget the
+# ones that are gone
+def update(firmware_dir, donors_file, jobs=None):
+    donors = load_donors(donors_file)
+    known = donors["firmware"]
+    present = {}
+    for path in sorted(glob.glob(os.path.join(firmware_dir, "*.bin"))):
+        present[os.path.basename(path)] = path
+    removed = [name for name in known if name not in present]
+    for name in removed:
+        logmsg("Removing %s" % name)
+        del known[name]
+    todo = []
+    for name, path in present.items():
+        st = os.stat(path)
+        if name not in known or known[name]["size"] != st.st_size or \
+           known[name]["mtime_ns"] != st.st_mtime_ns:
+            todo.append(path)
+    logmsg("%d firmware to index, %d up to date" % (len(todo), len(present) - len(todo)))
+    if len(todo) != 0:
+        with multiprocessing.Pool(jobs) as pool:
+            for name, fw in pool.imap_unordered(index_firmware, todo):
+                if "error" in fw:
+                    logmsg("Warning: Skipping %s: %s" % (name, fw["error"]))
+                else:
+                    logmsg("Indexed %s (%s, glibc %s, %d files)" % (name, fw["arch"], fw["glibc"],
+                                                                    len(fw["files"])))
+                known[name] = fw
+    if len(todo) != 0 or len(removed) != 0:
+        open(donors_file, 'w').write(json.dumps(donors, indent=4))
+        logmsg("Wrote %s" % donors_file)
+    return donors
+
+# Architecture and glibc version of an extracted rootfs
+def rootfs_info(rootfs):
+    arch = None
+    glibc = None
+    path = os.path.join(rootfs, "asa/bin/lina")
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            info = elf_info(f.read(0x40))
+        if info != None:
+            arch = info["arch"]
+    for path in glob.glob(os.path.join(rootfs, "lib*", "libc*.so*")):
+        name = os.path.relpath(path, rootfs)
+        if not is_libc(name) or os.path.islink(path):
+            continue
+        version = libc_version(name, open(path, 'rb').read())
+        if version != None and (glibc == None or helper.version_key(version) > helper.version_key(glibc)):
+            glibc = version
+    return arch, glibc
+
+def firmware_version(name):
+    if re.search(r'asa([^\\/.]+)\.bin', name):
+        return helper.version_key(helper.build_version(name))
+    return ()
+
+# glibc needed by the files (following symlinks in the donor)
+def required_glibc(fw, paths):
+    versions = []
+    for path in paths:
+        f = fw["files"][path]
+        if "link" in f:
+            target = os.path.normpath(os.path.join(os.path.dirname(path), f["link"])).lstrip("/")
+            f = fw["files"].get(target, f)
+        if "elf" in f and f["elf"]["glibc"] != None:
+            versions.append(f["elf"]["glibc"])
+    if len(versions) == 0:
+        return None
+    return max(versions, key=helper.version_key)
+
+def compatible(fw, paths, arch, glibc):
+    if arch != None and fw["arch"] != arch:
+        return False
+    need = required_glibc(fw, paths)
+    return need == None or glibc == None or helper.version_key(need) <= helper.version_key(glibc)
+
+# Best donor holding all the paths. Returns its name or None
+def find_donor(donors, paths, arch, glibc, exclude=[]):
+    candidates = [name for name, fw in donors["firmware"].items()
+                  if "error" not in fw and name not in exclude and
+                  all(path in fw["files"] for path in paths)]
+    if len(candidates) == 0:
+        return None
+    matching = [name for name in candidates if compatible(donors["firmware"][name], paths, arch, glibc)]
+    if len(matching) == 0:
+        matching = [name for name in candidates if arch == None or donors["firmware"][name]["arch"] == arch]
+        if len(matching) == 0:
+            return None
+        logmsg("Warning: No firmware with %s needs glibc %s or older" % (", ".join(paths), glibc))
+
+    def key(name):
+        need = required_glibc(donors["firmware"][name], paths)
+        return (helper.version_key(need or "0"), firmware_version(name))
+    return max(matching, key=key)
+
+# Copy files of firmware "donor" to the target rootfs. Each path is
+# "path[:dest]", dest being relative to outdir and defaulting to path
+def get_files(firmware_dir, donors, donor, paths, outdir):
+    firmwarefile = os.path.join(firmware_dir, donor)
+    fw = donors["firmware"][donor]
+    for spec in paths:
+        path, _, dest = spec.partition(":")
+        path = path.lstrip("/")
+        dest = os.path.join(outdir, (dest or path).lstrip("/"))
+        if os.path.isdir(dest) or dest.endswith("/"):
+            dest = os.path.join(dest, os.path.basename(path))
+        f = fw["files"][path]
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+        if "link" in f:
+            os.symlink(f["link"], dest)
+            logmsg("Created %s -> %s" % (dest, f["link"]))
+            continue
+        open(dest, 'wb').write(bin.read_rootfs_file(firmwarefile, f.get("data", path)))
+        os.chmod(dest, stat.S_IMODE(f["mode"]))
+        logmsg("Copied /%s from %s to %s" % (path, donor, dest))
+
+# Extract the files under "prefix" in the rootfs of a firmware to outdir,
+# without extracting the rest
+def extract_folder(firmwarefile, prefix, outdir):
+    prefix = prefix.strip("/")
+    with open(firmwarefile, 'rb') as f:
+        bin_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        gz_size, _, idx_gz, _ = bin.find_offsets(bin_data)
+        count, _ = newc.extract(newc.GzipStream(bin_data, idx_gz, gz_size), outdir,
+                             lambda name: name == prefix or name.startswith(prefix + "/"))
+    finally:
+        bin_data.close()
+    if count == 0:
+        logmsg("Error: /%s not found in %s" % (prefix, firmwarefile))
+        sys.exit(1)
+    logmsg("Extracted %d entries of /%s from %s to %s" % (count, prefix, firmwarefile, outdir))
+
+def list_donors(donors, paths):
+    for name in sorted(donors["firmware"], key=firmware_version):
+        fw = donors["firmware"][name]
+        if "error" in fw:
+            continue
+        if not all(path.lstrip("/") in fw["files"] for path in paths):
+            continue
+        s = "%-32s %-8s glibc %-6s" % (name, fw["arch"], fw["glibc"])
+        if len(paths) != 0:
+            s += " needs glibc %s" % required_glibc(fw, [p.lstrip("/") for p in paths])
+        print(s)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', dest='update', default=False, action="store_true",
+                        help="Index the new or changed firmware of the firmware folder")
+    parser.add_argument('-l', dest='list', default=False, action="store_true",
+                        help="List the indexed firmware (holding the -g files if any)")
+    parser.add_argument('-g', dest='get', action="append", default=[],
+                        help="File to take from a donor firmware as path[:dest] (can be repeated)")
+    parser.add_argument('-r', dest='rootfs', default=None,
+                        help="Extracted rootfs of the target firmware, to pick a compatible donor")
+    parser.add_argument('-o', dest='outdir', default=".",
+                        help="Where to write the files (default: current folder)")
+    parser.add_argument('--fw', dest='donor', default=None,
+                        help="Donor firmware to use instead of picking one")
+    parser.add_argument('-X', '--exclude', dest='exclude', action="append", default=[],
+                        help="Firmware not to use as donor (can be repeated)")
+    parser.add_argument('-F', dest='firmwarefile', default=None,
+                        help="Firmware to extract a folder from (with -e)")
+    parser.add_argument('-e', dest='prefix', default=None,
+                        help="Folder of the rootfs to extract from the -F firmware")
+    parser.add_argument('-d', dest='firmware_dir', default=os.environ.get("FIRMWAREDIR", "."),
+                        help="Firmware folder (default: $FIRMWAREDIR)")
+    parser.add_argument('-x', dest='donors_file', default=None,
+                        help="Index file (default: <firmware folder>/asafw-donors.json)")
+    parser.add_argument('-j', dest='jobs', type=int, default=None,
+                        help="Number of indexing workers (default: number of CPUs)")
+    args = parser.parse_args()
+
+    if args.donors_file == None:
+        args.donors_file = os.path.join(args.firmware_dir, "asafw-donors.json")
+
+    if args.firmwarefile != None:
+        if args.prefix == None:
+            logmsg("Error: -F requires -e")
+            sys.exit(1)
+        with stage("donors.extract", inputs=[args.firmwarefile]):
+            extract_folder(args.firmwarefile, args.prefix, args.outdir)
+        return
+
+    if args.update or len(args.get) != 0:
+        with stage("donors.update", outputs=[args.donors_file]):
+            donors = update(args.firmware_dir, args.donors_file, args.jobs)
+    else:
+        donors = load_donors(args.donors_file)
+
+    if args.list:
+        list_donors(donors, [spec.partition(":")[0] for spec in args.get])
+        return
+
+    if len(args.get) != 0:
+        paths = [spec.partition(":")[0].lstrip("/") for spec in args.get]
+        arch, glibc = None, None
+        if args.rootfs != None:
+            arch, glibc = rootfs_info(args.rootfs)
+            logmsg("Target rootfs: %s, glibc %s" % (arch, glibc))
+        if args.donor != None:
+            donor = os.path.basename(args.donor)
+            fw = donors["firmware"].get(donor)
+            if fw == None or "error" in fw:
+                logmsg("Error: %s is not an indexed firmware of %s" % (donor, args.firmware_dir))
+                sys.exit(1)
+            missing = [path for path in paths if path not in fw["files"]]
+            if len(missing) != 0:
+                logmsg("Error: %s does not have /%s" % (donor, ", /".join(missing)))
+                sys.exit(1)
+        else:
+            donor = find_donor(donors, paths, arch, glibc, [os.path.basename(x) for x in args.exclude])
+            if donor == None:
+                logmsg("Error: No firmware in %s has /%s" % (args.firmware_dir, ", /".join(paths)))
+                sys.exit(1)
+        fw = donors["firmware"][donor]
+        logmsg("Using %s (%s, glibc %s, needs glibc %s)" % (donor, fw["arch"], fw["glibc"],
+                                                            required_glibc(fw, paths)))
+        with stage("donors.get", inputs=[os.path.join(args.firmware_dir, donor)]):
+            get_files(args.firmware_dir, donors, donor, args.get, args.outdir)
+
+if __name__ == '__main__':
+    main()
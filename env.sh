@@ -21,6 +21,12 @@ export FIRMWAREDIR="/tmp" # where clean firmware files live
 export FWTOOL="${TOOLDIR}/bin.py"
 export UNPACK_REPACK_BIN="${TOOLDIR}/unpack_repack_bin.sh"
 export LINA_LINUXSHELL="${TOOLDIR}/lina.py"
+export TRACETOOL="${TOOLDIR}/tracelog.py"
+export CPIOGZTOOL="${TOOLDIR}/cpiogz.py"
+export DELTATOOL="${TOOLDIR}/delta.py"
+export DONORTOOL="${TOOLDIR}/donors.py"
+export UNCPIOTOOL="${TOOLDIR}/uncpio.py"
+export FINGERPRINTTOOL="${TOOLDIR}/fingerprint.py"
 export WORKDIR="/tmp" # a directory for temporary files
 export OUTDIR="/tmp" # a directory for generated files
 export QCOW2MNT="/mnt/qcow2" # where we mount qcow2 files using qemu-nbd
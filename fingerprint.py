@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+#
+# This file is part of asafw.
+# Copyright (c) 2017, Aaron Adams <aaron.adams(at)nccgroup(dot)trust>
+# Copyright (c) 2017, Cedric Halbronn <cedric.halbronn(at)nccgroup(dot)trust>
+#
+# Identify a firmware image from its content rather than from its name, so
+# renamed images can still be found in the database.
+#
+# - format: "qcow2" (QFI magic) or "bin" (kernel command line of bin.py
+#   followed by the gzip rootfs). The .SPA images with the same layout as the
+#   asa*.bin are reported as "bin"
+# - layout: what bin.py relies on, i.e. which kernel command line is used and
+#   how the rootfs was found, plus the qcow2 version and cluster size
+# - version and build: from the "PIX (9.2.4) #0: Tue Jul 14 22:19:35 PDT 2015"
+#   string of lina. Only the rootfs up to lina is decompressed
+# - arch: 32 or 64, from the ELF class of lina (like the "arch" of the
+#   database)
+# - sha256 of the whole image
+#
+# For a qcow2, the asa*.bin is looked for in the image file directly. This
+# works as long as the clusters holding it are stored in order, which is the
+# case for the Cisco images.
+#
+# Results are cached by path (with size and mtime) and by sha256, so a renamed
+# or copied image is only hashed again.
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import struct
+import sys
+import zlib
+
+import bin
+import helper
+import newc
+
+def logmsg(s, end=None):
+    if type(s) == str:
+        if end != None:
+            print("[fingerprint] " + s, end=end)
+        else:
+            print("[fingerprint] " + s)
+    else:
+        print(s)
+    sys.stdout.flush()
+
+FINGERPRINT_VERSION = 1
+
+QCOW2_MAGIC = b"QFI\xfb"
+# "PIX (9.2.4) #0: Tue Jul 14 22:19:35 PDT 2015" or "PIX (9.6(2)7) #0: ..."
+BUILD_RE = re.compile(rb"PIX \(([ -~]{1,32}?)\) #\d+: [ -~]{1,64}")
+LINA = "asa/bin/lina"
+
+CMDLINE_LAYOUTS = {
+    b"quiet loglevel=0 auto":          "auto",
+    b"auto quiet loglevel=0":          "auto-8.0.3",
+    b"quiet loglevel=0 ide1=noprobe":  "ide1-noprobe",
+    b"rdinit=/bin/sh":                 "rooted",
+    b"norandmaps quiet":               "noaslr",
+}
+
+def default_cache_file():
+    return os.path.join(os.environ.get("WORKDIR", "/tmp"), "asafw-fingerprints.json")
+
+# "9.6(2)7" -> "9.6.2.7", like helper.build_version() gives for asa962-7-*.bin
+def normalize_version(version):
+    return ".".join(part for part in re.split(r"[.()]", version) if part != "")
+
+# Read the rootfs cpio until lina and return (arch, build string)
+def inspect_lina(f, chunk_size=1024*1024):
+    while True:
+        entry = newc.read_header(f)
+        if entry["name"] == newc.NEWC_TRAILER:
+            return None, None
+        size = entry["filesize"]
+        pad = (4 - size % 4) % 4
+        if newc.normalize_name(entry["name"]) != LINA or size == 0:
+            while size > 0:
+                n = len(f.read(min(size, chunk_size)))
+                if n == 0:
+                    raise newc.NewcError("Truncated cpio archive")
+                size -= n
+            f.read(pad)
+            continue
+        arch = None
+        tail = b""
+        first = True
+        while size > 0:
+            buf = f.read(min(size, chunk_size))
+            if len(buf) == 0:
+                raise newc.NewcError("Truncated cpio archive")
+            size -= len(buf)
+            if first and buf[:4] == b"\x7fELF":
+                arch = 64 if buf[4] == 2 else 32
+            first = False
+            match = BUILD_RE.search(tail + buf)
+            if match:
+                return arch, match.group(0).decode()
+            tail = buf[-128:]
+        return arch, None
+
+def inspect_bin(data):
+    fp = {}
+    for cmdline in bin.KERNEL_CMDLINES:
+        if data.rfind(cmdline) != -1:
+            fp["layout"] = "bin:" + CMDLINE_LAYOUTS[cmdline]
+            break
+    else:
+        return None
+    # find_offsets() exits on error, and its messages would get mixed with
+    # the --json output
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            gz_size, _, idx_gz, _ = bin.find_offsets(data)
+    except SystemExit:
+        return fp
+    fp["layout"] += ":" + ("rootfs.img" if data.find(b"rootfs.img") != -1 else "gzip")
+    fp["rootfs_offset"] = idx_gz
+    fp["rootfs_size"] = gz_size
+    try:
+        arch, build = inspect_lina(newc.GzipStream(data, idx_gz, gz_size))
+    except (newc.NewcError, zlib.error):
+        arch, build = None, None
+    if arch != None:
+        fp["arch"] = arch
+    if build != None:
+        fp["build"] = build
+        fp["version"] = normalize_version(BUILD_RE.match(build.encode()).group(1).decode())
+    return fp
+
+def inspect_qcow2(data):
+    version, = struct.unpack(">I", data[4:8])
+    cluster_bits, = struct.unpack(">I", data[20:24])
+    fp = {"format": "qcow2", "layout": "qcow2:v%d:%dK" % (version, (1 << cluster_bits) // 1024)}
+    inner = inspect_bin(data)
+    if inner != None:
+        for k in ["arch", "build", "version"]:
+            if k in inner:
+                fp[k] = inner[k]
+    return fp
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(1024*1024)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+# Fingerprint one image, without the cache. Runs in a worker process
+def fingerprint_file(path):
+    st = os.stat(path)
+    fp = {"format": "unknown", "size": st.st_size}
+    if st.st_size != 0:
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if data[:4] == QCOW2_MAGIC:
+                fp.update(inspect_qcow2(data))
+            else:
+                inner = inspect_bin(data)
+                if inner != None:
+                    fp["format"] = "bin"
+                    fp.update(inner)
+        finally:
+            data.close()
+    fp["sha256"] = sha256_file(path)
+    return fp
+
+def load_cache(cache_file):
+    if cache_file != None and os.path.isfile(cache_file):
+        cache = json.loads(open(cache_file, 'r').read())
+        if cache.get("version") == FINGERPRINT_VERSION:
+            return cache
+    return {"version": FINGERPRINT_VERSION, "paths": {}, "sha256": {}}
+
+def save_cache(cache_file, cache):
+    if cache_file == None:
+        return
+    tmp = "%s.%d.tmp" % (cache_file, os.getpid())
+    open(tmp, 'w').write(json.dumps(cache, indent=4))
+    os.rename(tmp, cache_file)
+
+def _cached(cache, path):
+    st = os.stat(path)
+    c = cache["paths"].get(os.path.abspath(path))
+    if c != None and c["size"] == st.st_size and c["mtime_ns"] == st.st_mtime_ns:
+        return cache["sha256"].get(c["sha256"])
+    return None
+
+def _remember(cache, path, fp):
+    st = os.stat(path)
+    cache["paths"][os.path.abspath(path)] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                                             "sha256": fp["sha256"]}
+    cache["sha256"][fp["sha256"]] = fp
+
+# Fingerprint several images, using and updating the cache. Returns a list of
+# (path, fingerprint)
+def fingerprint_all(paths, cache_file=None, jobs=None):
+    cache = load_cache(cache_file)
+    results = {}
+    todo = []
+    for path in paths:
+        fp = _cached(cache, path)
+        if fp != None:
+            results[path] = fp
+        else:
+            todo.append(path)
+    if len(todo) != 0:
+        if len(todo) == 1:
+            fps = [fingerprint_file(todo[0])]
+        else:
+            with multiprocessing.Pool(jobs) as pool:
+                fps = pool.map(fingerprint_file, todo)
+        for path, fp in zip(todo, fps):
+            _remember(cache, path, fp)
+            results[path] = fp
+        save_cache(cache_file, cache)
+    return [(path, results[path]) for path in paths]
+
+def fingerprint(path, cache_file=None):
+    return fingerprint_all([path], cache_file)[0][1]
+
+# Index of the target of the database matching a fingerprint, or None. The
+# version and arch must match. If several firmware do (e.g. asa962-7-smp-k8.bin
+# and asav962-7.qcow2), the qcow2 images go to the asav ones and the name of
+# the image is used as a hint for the rest
+def find_target(targets, fp, name=None):
+    if fp.get("version") == None:
+        return None
+    version = helper.version_key(fp["version"])
+    candidates = [i for i, t in enumerate(targets)
+                  if "version" in t and helper.version_key(t["version"]) == version and
+                  ("arch" not in t or "arch" not in fp or t["arch"] == fp["arch"])]
+    if len(candidates) > 1:
+        asav = fp["format"] == "qcow2" or (name != None and "asav" in os.path.basename(name))
+        same = [i for i in candidates if targets[i]["fw"].startswith("asav") == asav]
+        if len(same) != 0:
+            candidates = same
+    if len(candidates) > 1 and name != None:
+        base = os.path.basename(name)
+        same = [i for i in candidates if targets[i]["fw"] == base or
+                ("smp" in targets[i]["fw"]) == ("smp" in base)]
+        if len(same) != 0:
+            candidates = same
+    if len(candidates) == 0:
+        return None
+    if len(candidates) > 1:
+        logmsg("Warning: %s matches %s, using the first one" %
+               (fp["version"], ", ".join(targets[i]["fw"] for i in candidates)))
+    return candidates[0]
+
+# find_target() for an image, fingerprinted with the default cache
+def lookup(targets, image, name=None):
+    fp = fingerprint(image, default_cache_file())
+    logmsg("%s: %s %s, %s-bit, %s" % (image, fp["format"], fp.get("version", "unknown version"),
+                                     fp.get("arch", "?"), fp.get("build", "no build string")))
+    index = find_target(targets, fp, name or image)
+    if index != None:
+        logmsg("%s is %s in the db" % (image, targets[index]["fw"]))
+    return index
+
+def list_images(args):
+    paths = []
+    for arg in args:
+        if os.path.isdir(arg):
+            for name in sorted(os.listdir(arg)):
+                path = os.path.join(arg, name)
+                if os.path.isfile(path) and not name.endswith(".json"):
+                    paths.append(path)
+        else:
+            paths.append(arg)
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('images', nargs='+',
+                        help="Firmware images or folders of firmware images")
+    parser.add_argument('-d', dest='target_file', default=None,
+                        help="JSON database to look the images up in")
+    parser.add_argument('-C', '--cache', dest='cache_file', default=default_cache_file(),
+                        help="Cache file (default: %(default)s)")
+    parser.add_argument('--no-cache', dest='no_cache', default=False, action="store_true",
+                        help="Do not use the cache")
+    parser.add_argument('--json', dest='json', default=False, action="store_true",
+                        help="Output JSON")
+    parser.add_argument('-j', dest='jobs', type=int, default=None,
+                        help="Number of worker processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    paths = list_images(args.images)
+    for path in paths:
+        if not os.path.isfile(path):
+            logmsg("Error: %s not found" % path)
+            sys.exit(1)
+    results = fingerprint_all(paths, None if args.no_cache else args.cache_file, args.jobs)
+    targets = None
+    if args.target_file != None:
+        # keep stdout for the JSON output
+        with contextlib.redirect_stdout(sys.stderr if args.json else sys.stdout):
+            targets = helper.load_targets(args.target_file)
+        for path, fp in results:
+            index = find_target(targets, fp, path)
+            fp["target"] = None if index == None else targets[index]["fw"]
+
+    if args.json:
+        print(json.dumps(dict(results), indent=4))
+        return
+    for path, fp in results:
+        s = "%-40s %-7s %-10s %-3s %-32s %s" % (path, fp["format"], fp.get("version", "?"),
+                                                fp.get("arch", "?"), fp.get("layout", "?"),
+                                                fp["sha256"][:16])
+        if targets != None:
+            s += " %s" % fp["target"]
+        print(s)
+
+if __name__ == '__main__':
+    main()
@@ -85,6 +85,19 @@ def build_version(dirname):
 
     return version
 
+# Key to sort versions numerically, e.g. "9.2" < "9.12" and "9.1.6.4" <
+# "9.1.6.10". Parts starting with a number are compared by that number then
+# by what follows it, other parts come first
+def version_key(version):
+    key = []
+    for part in version.split("."):
+        match = re.match(r'(\d+)(.*)', part)
+        if match:
+            key.append((int(match.group(1)), match.group(2)))
+        else:
+            key.append((-1, part))
+    return tuple(key)
+
 # check if a firmware is new based on the firmware name
 def is_new(targets, new):
     for t in targets:
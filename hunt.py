@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+#
+# This file is part of asafw.
+# Copyright (c) 2017, Aaron Adams <aaron.adams(at)nccgroup(dot)trust>
+# Copyright (c) 2017, Cedric Halbronn <cedric.halbronn(at)nccgroup(dot)trust>
+#
+# Find the lina and lina_monitor symbols required by lina.py without IDA.
+#
+# lina.py needs the following entries in the JSON database:
+# - addresses: aaa_admin_authenticate, start_loopback_proxy or
+#   socks_proxy_server_start
+# - lm_addresses: jz_after_code_sign_verify_signature_image (ASAv only)
+#
+# For each symbol we try in this order:
+# 1. the ELF symbol tables (.symtab then .dynsym) for firmware that are not
+#    stripped or export symbols
+# 2. byte signatures with wildcards, all of them compiled into one regex and
+#    matched in one pass over the executable segments. Only lina_monitor has
+#    signatures for now, the lina functions change too much between versions
+# 3. cross-references to a string (typically the function name used in its
+#    log/assert messages), the function start being found with .eh_frame_hdr
+#    or by looking backward for a function prologue
+#
+# A result is only accepted if it is unique. Like the addresses from
+# asadbg/idahunt, the saved values are relative to the ELF image base which is
+# also the offset in the ELF file for the text segment. Results are cached per
+# binary (sha256) so running it again on a known lina is instant.
+
+import argparse
+import array
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+
+from helper import *
+import fingerprint
+
+# bump it when the signatures change so the cache is invalidated
+HUNT_VERSION = 2
+
+PT_LOAD         = 1
+PT_GNU_EH_FRAME = 0x6474e550
+PF_X            = 1
+SHT_SYMTAB      = 2
+SHT_DYNSYM      = 11
+
+# Signatures are hex strings where "??" matches any byte. The second element is
+# the offset of the symbol from the beginning of the match. "call_to" is an
+# optional symbol that the E8 call at the beginning of the match must target.
+LINA_SYMBOLS = {
+    "aaa_admin_authenticate": {
+        "strings": [b"aaa_admin_authenticate"],
+    },
+    "start_loopback_proxy": {
+        "strings": [b"start_loopback_proxy"],
+    },
+    "socks_proxy_server_start": {
+        "strings": [b"socks_proxy_server_start"],
+    },
+}
+
+# See patch_lina_signature_check() in lina.py for the code we are looking for
+LM_SYMBOLS = {
+    "jz_after_code_sign_verify_signature_image": {
+        "strings": [],
+        "signatures": [
+            # call code_sign_verify_signature_image; test eax, eax; mov ebx, eax; jz short
+            ("E8 ?? ?? ?? ?? 85 C0 89 C3 74 ??", 9),
+            # call code_sign_verify_signature_image; test eax, eax; mov ebx, eax; jnz near
+            ("E8 ?? ?? ?? ?? 85 C0 89 C3 0F 85 ?? ?? ?? ??", 9),
+        ],
+        "call_to": "code_sign_verify_signature_image",
+    },
+}
+
+# symbols we need at least one of
+LINA_REQUIRED = [
+    ["aaa_admin_authenticate"],
+    ["start_loopback_proxy", "socks_proxy_server_start"],
+]
+LM_REQUIRED = [
+    ["jz_after_code_sign_verify_signature_image"],
+]
+
+def logmsg(s, end=None):
+    if type(s) == str:
+        if end != None:
+            print("[hunt] " + s, end=end)
+        else:
+            print("[hunt] " + s)
+    else:
+        print(s)
+
+# Minimal ELF parser working on a mmap of the binary
+class ELF(object):
+    def __init__(self, data):
+        self.data = data
+        if data[:4] != b"\x7fELF":
+            raise ValueError("Not an ELF file")
+        if data[4] == 1:
+            self.arch = 32
+            hdr = struct.unpack_from("<HHIIIIIHHHHHH", data, 16)
+        elif data[4] == 2:
+            self.arch = 64
+            hdr = struct.unpack_from("<HHIQQQIHHHHHH", data, 16)
+        else:
+            raise ValueError("Unsupported ELF class %d" % data[4])
+        (_, _, _, _, phoff, shoff, _, _,
+         phentsize, phnum, shentsize, shnum, shstrndx) = hdr
+
+        self.segments = []
+        for i in range(phnum):
+            if self.arch == 32:
+                p_type, p_offset, p_vaddr, _, p_filesz, p_memsz, p_flags, _ = \
+                    struct.unpack_from("<IIIIIIII", data, phoff + i*phentsize)
+            else:
+                p_type, p_flags, p_offset, p_vaddr, _, p_filesz, p_memsz, _ = \
+                    struct.unpack_from("<IIQQQQQQ", data, phoff + i*phentsize)
+            self.segments.append({"type": p_type, "flags": p_flags,
+                                  "offset": p_offset, "vaddr": p_vaddr,
+                                  "filesz": p_filesz, "memsz": p_memsz})
+        loads = [s for s in self.segments if s["type"] == PT_LOAD]
+        self.imagebase = min(s["vaddr"] for s in loads) & ~0xfff if loads else 0
+
+        self.sections = []
+        if shoff != 0 and shoff + shnum*shentsize <= len(data):
+            for i in range(shnum):
+                if self.arch == 32:
+                    sh = struct.unpack_from("<IIIIIIIIII", data, shoff + i*shentsize)
+                else:
+                    sh = struct.unpack_from("<IIQQQQIIQQ", data, shoff + i*shentsize)
+                self.sections.append({"name_off": sh[0], "type": sh[1],
+                                      "addr": sh[3], "offset": sh[4],
+                                      "size": sh[5], "link": sh[6],
+                                      "entsize": sh[9]})
+            if shstrndx < len(self.sections):
+                strtab = self.sections[shstrndx]
+                for s in self.sections:
+                    s["name"] = self._cstring(strtab["offset"] + s["name_off"])
+
+    def _cstring(self, off):
+        end = self.data.find(b"\x00", off)
+        return self.data[off:end].decode("latin-1")
+
+    def exec_ranges(self):
+        return [(s["offset"], s["offset"] + s["filesz"]) for s in self.segments
+                if s["type"] == PT_LOAD and s["flags"] & PF_X]
+
+    def offset_to_vaddr(self, off):
+        for s in self.segments:
+            if s["type"] == PT_LOAD and s["offset"] <= off < s["offset"] + s["filesz"]:
+                return off - s["offset"] + s["vaddr"]
+        return None
+
+    def vaddr_to_offset(self, vaddr):
+        for s in self.segments:
+            if s["type"] == PT_LOAD and s["vaddr"] <= vaddr < s["vaddr"] + s["filesz"]:
+                return vaddr - s["vaddr"] + s["offset"]
+        return None
+
+    # look up the symbols in .symtab and .dynsym
+    def find_symbols(self, names):
+        found = {}
+        wanted = set(names)
+        for sh_type in [SHT_SYMTAB, SHT_DYNSYM]:
+            for sec in self.sections:
+                if sec["type"] != sh_type or sec["link"] >= len(self.sections):
+                    continue
+                strtab = self.sections[sec["link"]]
+                # resolve the string offsets first so we only compare integers
+                # while walking the (possibly huge) symbol table
+                name_offs = {}
+                for n in wanted - set(found):
+                    i = self.data.find(b"\x00" + n.encode() + b"\x00", strtab["offset"],
+                                       strtab["offset"] + strtab["size"])
+                    while i != -1:
+                        name_offs[i + 1 - strtab["offset"]] = n
+                        i = self.data.find(b"\x00" + n.encode() + b"\x00", i + 1,
+                                           strtab["offset"] + strtab["size"])
+                if len(name_offs) == 0:
+                    continue
+                if self.arch == 32:
+                    fmt = "<IIIBBH"
+                else:
+                    fmt = "<IBBHQQ"
+                entsize = struct.calcsize(fmt)
+                end = sec["offset"] + sec["size"] - sec["size"] % entsize
+                for sym in struct.iter_unpack(fmt, self.data[sec["offset"]:end]):
+                    if sym[0] not in name_offs:
+                        continue
+                    value = sym[1] if self.arch == 32 else sym[4]
+                    shndx = sym[5] if self.arch == 32 else sym[3]
+                    # skip undefined (imported) symbols
+                    if value == 0 or shndx == 0:
+                        continue
+                    found.setdefault(name_offs[sym[0]], value)
+        return found
+
+    # Function starts from the .eh_frame_hdr binary search table. Only the
+    # encodings emitted by gcc/binutils are supported.
+    def function_starts(self):
+        hdr = None
+        for s in self.segments:
+            if s["type"] == PT_GNU_EH_FRAME:
+                hdr = s
+        if hdr == None:
+            return None
+        off = hdr["offset"]
+        version, ptr_enc, count_enc, table_enc = struct.unpack_from("<BBBB", self.data, off)
+        # DW_EH_PE_udata4 fde count and DW_EH_PE_datarel|DW_EH_PE_sdata4 table
+        if version != 1 or count_enc != 0x03 or table_enc != 0x3b or ptr_enc & 0x0f not in [0x03, 0x0b]:
+            return None
+        count = struct.unpack_from("<I", self.data, off + 8)[0]
+        table = array.array("i")
+        table.frombytes(self.data[off + 12:off + 12 + count*8])
+        if sys.byteorder != "little":
+            table.byteswap()
+        return sorted(hdr["vaddr"] + v for v in table[0::2])
+
+def parse_signature(sig):
+    pattern = b""
+    for b in sig.split():
+        if b == "??":
+            pattern += b"."
+        else:
+            pattern += re.escape(bytes([int(b, 16)]))
+    return pattern
+
+# Match all signatures of all symbols in one pass over the executable segments
+def scan_signatures(elf, symbols):
+    groups = []
+    parts = []
+    for name, info in symbols.items():
+        for sig, delta in info.get("signatures", []):
+            groups.append((name, delta))
+            parts.append(b"(" + parse_signature(sig) + b")")
+    matches = dict((name, []) for name in symbols)
+    if len(parts) == 0:
+        return matches
+    regex = re.compile(b"|".join(parts), re.DOTALL)
+    for start, end in elf.exec_ranges():
+        for m in regex.finditer(elf.data, start, end):
+            name, delta = groups[m.lastindex - 1]
+            matches[name].append((m.start(), m.start() + delta))
+    return matches
+
+# All places in the executable segments referencing the given virtual address,
+# either as an absolute 32-bit immediate or as a RIP-relative lea (64-bit)
+def find_xrefs(elf, vaddr):
+    xrefs = []
+    if vaddr < (1 << 32):
+        needle = struct.pack("<I", vaddr)
+        for start, end in elf.exec_ranges():
+            i = elf.data.find(needle, start, end)
+            while i != -1:
+                xrefs.append(i)
+                i = elf.data.find(needle, i + 1, end)
+    if elf.arch == 64:
+        # lea r64, [rip+disp32]
+        lea = re.compile(b"[\x48\x4c]\x8d[\x05\x0d\x15\x1d\x25\x2d\x35\x3d]", re.DOTALL)
+        for s in elf.segments:
+            if s["type"] != PT_LOAD or not s["flags"] & PF_X:
+                continue
+            start, end = s["offset"], s["offset"] + s["filesz"] - 7
+            # disp32 = vaddr - (insn_vaddr + 7). The string is usually in
+            # another segment (.rodata) so compare virtual addresses
+            delta = s["vaddr"] - s["offset"] + 7
+            for m in lea.finditer(elf.data, start, end):
+                i = m.start()
+                if i + delta + struct.unpack_from("<i", elf.data, i + 3)[0] == vaddr:
+                    xrefs.append(i)
+    return xrefs
+
+def function_start(elf, off, starts):
+    vaddr = elf.offset_to_vaddr(off)
+    if starts:
+        i = bisect.bisect_right(starts, vaddr)
+        if i == 0:
+            return None
+        return elf.vaddr_to_offset(starts[i - 1])
+    if elf.arch == 32:
+        prologue = b"\x55\x89\xe5"
+    else:
+        prologue = b"\x55\x48\x89\xe5"
+    i = elf.data.rfind(prologue, max(0, off - 0x10000), off)
+    if i == -1:
+        return None
+    return i
+
+def find_by_strings(elf, strings, starts):
+    funcs = set()
+    for s in strings:
+        i = elf.data.find(b"\x00" + s + b"\x00")
+        while i != -1:
+            vaddr = elf.offset_to_vaddr(i + 1)
+            if vaddr != None:
+                for x in find_xrefs(elf, vaddr):
+                    f = function_start(elf, x, starts)
+                    if f != None:
+                        funcs.add(f)
+            i = elf.data.find(b"\x00" + s + b"\x00", i + 1)
+    return sorted(funcs)
+
+# Resolve the given symbols in an ELF. Returns two dicts: name -> offset
+# relative to the image base and name -> method used
+def hunt_elf(path, symbols):
+    results = {}
+    methods = {}
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            elf = ELF(data)
+            call_to = [i["call_to"] for i in symbols.values() if "call_to" in i]
+            syms = elf.find_symbols(list(symbols.keys()) + call_to)
+
+            for name in symbols:
+                if name in syms:
+                    results[name] = syms[name] - elf.imagebase
+                    methods[name] = "symbol"
+
+            todo = dict((n, i) for n, i in symbols.items() if n not in results)
+            for name, matches in scan_signatures(elf, todo).items():
+                info = symbols[name]
+                if "call_to" in info and info["call_to"] in syms:
+                    callee = syms[info["call_to"]]
+                    matches = [(m, s) for m, s in matches
+                               if elf.offset_to_vaddr(m) + 5 +
+                                  struct.unpack_from("<i", data, m + 1)[0] == callee]
+                if len(matches) == 1:
+                    results[name] = elf.offset_to_vaddr(matches[0][1]) - elf.imagebase
+                    methods[name] = "signature"
+                elif len(matches) > 1:
+                    logmsg("%s: %d signature matches, ignoring" % (name, len(matches)))
+
+            todo = dict((n, i) for n, i in symbols.items() if n not in results and i.get("strings"))
+            if len(todo) != 0:
+                starts = elf.function_starts()
+                for name, info in todo.items():
+                    funcs = find_by_strings(elf, info["strings"], starts)
+                    if len(funcs) == 1:
+                        results[name] = elf.offset_to_vaddr(funcs[0]) - elf.imagebase
+                        methods[name] = "xref"
+                    elif len(funcs) > 1:
+                        logmsg("%s: string referenced from %d functions, ignoring" % (name, len(funcs)))
+        finally:
+            data.close()
+    return results, methods
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(1024*1024)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+def load_cache(cache_file):
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file, "r") as tmp:
+            cache = json.loads(tmp.read())
+        if cache.get("version") == HUNT_VERSION:
+            return cache
+    return {"version": HUNT_VERSION, "binaries": {}}
+
+def save_cache(cache_file, cache):
+    if not cache_file:
+        return
+    tmp = cache_file + ".tmp"
+    open(tmp, "w").write(json.dumps(cache, indent=4, sort_keys=True))
+    os.rename(tmp, cache_file)
+
+# Hunt symbols in one binary using the cache when possible
+def hunt_binary(path, symbols, cache):
+    digest = sha256_file(path)
+    if digest in cache["binaries"]:
+        entry = cache["binaries"][digest]
+        logmsg("%s: using cached results" % path)
+    else:
+        results, methods = hunt_elf(path, symbols)
+        entry = {"addresses": results, "methods": methods}
+        cache["binaries"][digest] = entry
+    for name in sorted(entry["addresses"]):
+        logmsg("%s: %s = 0x%x (%s)" % (os.path.basename(path), name,
+               entry["addresses"][name], entry["methods"][name]))
+    return entry["addresses"]
+
+def missing(found, required):
+    return [r for r in required if not any(n in found for n in r)]
+
+# Hunt lina (and lina_monitor for ASAv) and merge the results into the target.
+# Existing addresses are kept unless force is set. Returns True if all the
+# symbols required by lina.py are now known.
+def hunt_target(target, lina, lina_monitor=None, cache=None, force=False):
+    if cache == None:
+        cache = load_cache(None)
+    ok = True
+    jobs = [(lina, "addresses", LINA_SYMBOLS, LINA_REQUIRED)]
+    if lina_monitor:
+        jobs.append((lina_monitor, "lm_addresses", LM_SYMBOLS, LM_REQUIRED))
+    for path, key, symbols, required in jobs:
+        found = hunt_binary(path, symbols, cache)
+        addresses = target.setdefault(key, {})
+        for name, value in found.items():
+            if force or name not in addresses:
+                addresses[name] = value
+        for r in missing(addresses, required):
+            logmsg("%s: could not find %s" % (target["fw"], " or ".join(r)))
+            ok = False
+    return ok
+
+def save_targets(dbname, targets):
+    open(dbname, "wb").write(bytes(json.dumps(targets, indent=4), encoding="UTF-8"))
+
+def default_cache(dbname):
+    return os.path.join(os.path.dirname(os.path.abspath(dbname)), "hunt_cache.json")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', dest='target_file', default=None,
+                        help='JSON db name')
+    parser.add_argument('-f', dest='lina_file', default=None,
+                        help="Input lina file")
+    parser.add_argument('-F', dest='lina_monitor_file', default=None,
+                        help="Input lina_monitor file (only in ASAv 64-bit)")
+    parser.add_argument('-b', dest='bin_name', default=None,
+                        help="Firmware bin name (default: guess from the lina path)")
+    parser.add_argument('-I', dest='image', default=None,
+                        help="Firmware image to identify the target from its content if the bin name is not in the db (see fingerprint.py)")
+    parser.add_argument('-r', dest='linabins_dir', default=None,
+                        help="Hunt all firmware from a linabins folder (<dir>/<bin name>/lina)")
+    parser.add_argument('-C', dest='cache_file', default=None,
+                        help="Cache file (default: hunt_cache.json next to the db)")
+    parser.add_argument('--force', dest='force', default=False, action="store_true",
+                        help="Overwrite addresses already in the db")
+    parser.add_argument('-n', dest='dry_run', default=False, action="store_true",
+                        help="Do not save anything to the db")
+    args = parser.parse_args()
+
+    if args.target_file == None:
+        logmsg("You need to specify a JSON database filename with -d")
+        sys.exit(1)
+    if args.lina_file == None and args.linabins_dir == None:
+        logmsg("You need to specify an input lina file with -f or a linabins folder with -r")
+        sys.exit(1)
+    if args.cache_file == None:
+        args.cache_file = default_cache(args.target_file)
+
+    jobs = []
+    if args.linabins_dir:
+        for bin_name in sorted(os.listdir(args.linabins_dir)):
+            lina = os.path.join(args.linabins_dir, bin_name, "lina")
+            lina_monitor = os.path.join(args.linabins_dir, bin_name, "lina_monitor")
+            if not os.path.isfile(lina):
+                continue
+            if not bin_name.startswith("asav") or not os.path.isfile(lina_monitor):
+                lina_monitor = None
+            jobs.append((bin_name, lina, lina_monitor))
+    else:
+        bin_name = args.bin_name
+        if bin_name == None and args.image != None:
+            bin_name = os.path.basename(args.image)
+        if bin_name == None:
+            logmsg("WARN: No firmware name specified. Will guess based on lina path...")
+            bin_name = build_bin_name(args.lina_file)
+            if not bin_name:
+                logmsg("[x] Failed to guess target")
+                sys.exit(1)
+        jobs.append((bin_name, args.lina_file, args.lina_monitor_file))
+
+    targets = load_targets(args.target_file)
+    cache = load_cache(args.cache_file)
+    failed = 0
+    for bin_name, lina, lina_monitor in jobs:
+        index = get_target_index(targets, bin_name)
+        if index == None and args.image != None:
+            index = fingerprint.lookup(targets, args.image, bin_name)
+        if index == None:
+            logmsg("[x] %s is not in the db, add it with info.sh first" % bin_name)
+            failed += 1
+            continue
+        if not hunt_target(targets[index], lina, lina_monitor, cache, args.force):
+            failed += 1
+    save_cache(args.cache_file, cache)
+    if not args.dry_run:
+        save_targets(args.target_file, targets)
+        logmsg("Saved %s" % args.target_file)
+    if failed:
+        logmsg("%d/%d firmware not completely supported" % (failed, len(jobs)))
+        sys.exit(1)
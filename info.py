@@ -11,6 +11,7 @@
 # in the asafw/README.md
 
 import argparse
+import csv
 import json
 import os
 import sys
@@ -38,96 +39,154 @@ def migitations_table_footer():
     print("| Can = Canary              ||||||||||||||                                                                                            |")
     print("| Sym = Exported symbols    ||||||||||||||                                                                                            |")
 
-# print info/mitigations for ASA firewalls in a markdown-formated table
-def print_mitigations(results):
-    if results == None:
-        logmsg("[!] Need actual results to print. Got none")
-        return
-    mitigations_table_header()
-    idx = 0
+def yes_no(v):
+    if v == None:
+        return "?"
+    return "Y" if v else "N"
 
-    for t in results:
-        # assume an entry we want to print has at least "stripped" otherwise we skip it
-        # XXX - print it so we remember to add its mitigations in the db
-        #if "stripped" not in t:
-        #    continue
-        line = "|"
-        line += " %.03d" % (idx) + ' |'
-        line += "% 10s" % t['version'] + ' |'
-        try:
-            arch = t["arch"]
-        except KeyError:
-            arch = "?"
-        try:
-            aslr = "Y" if t["ASLR"] else "N"
-        except KeyError:
-            aslr = "?"
-        try:
-            nx = "Y" if t["NX"] else "N"
-        except KeyError:
-            nx = "?"
-        try:
-            pie = "Y" if t["PIE"] else "N"
-        except KeyError:
-            pie = "?"
-        try:
-            canary = "Y" if t["Canary"] else "N"
-        except KeyError:
-            canary = "?"
-        try:
-            relro = "Y" if t["RELRO"] else "N"
-        except KeyError:
-            relro = "?"
-        try:
-            symb = "Y" if t["exported_symbols"] else "N"
-        except KeyError:
-            symb = "?"
-        try:
-            stripped = "Y" if t["stripped"] else "N"
-        except KeyError:
-            stripped = "?"
-        try:
-            glibc_version = t["glibc_version"]
-        except KeyError:
-            glibc_version = "?"
-        try:
-            match = re.search(r'Linux version ([0-9.]*)', t["uname"])
-            uname = match.group(1)
-        except KeyError:
-            uname = "?"
-        try:
-            heap_alloc = t["heap_alloc"]
-        except KeyError:
-            heap_alloc = "?"
+def linux_version(uname):
+    if uname == None:
+        return None
+    match = re.search(r'Linux version ([0-9.]*)', uname)
+    if not match:
+        return None
+    return match.group(1)
+
+# Columns of the index: name, DB key or function computing the value from a
+# DB entry, header and format of the markdown table cells. The header and the
+# cells of a column have the same width
+COLUMNS = [
+    ("id",         None,                                  " ID  ",             " %.03d"),
+    ("version",    "version",                             " Version   ",       "% 10s"),
+    ("arch",       "arch",                                "Arch",              " % 2s"),
+    ("aslr",       "ASLR",                                "ASLR",              " % 2s"),
+    ("nx",         "NX",                                  " NX ",              " % 2s"),
+    ("pie",        "PIE",                                 "PIE",               " % 1s"),
+    ("canary",     "Canary",                              "Can",               " % 1s"),
+    ("relro",      "RELRO",                               "RELRO",             " % 3s"),
+    ("symbols",    "exported_symbols",                    "Sym",               " % 1s"),
+    ("stripped",   "stripped",                            "Strip",             " % 2s "),
+    ("linux",      lambda t: linux_version(t.get("uname")), "    Linux ",       " % 8s"),
+    ("glibc",      "glibc_version",                       " Glibc ",           " % 5s"),
+    ("heap",       "heap_alloc",                          " Heap allocator ",  " % 14s"),
+    ("build_date", "build_date",                          " Build date ",      " % 10s"),
+    ("fw",         "fw",                                  " Firmware                  ", "% 26s"),
+]
+COLUMN_NAMES = [c[0] for c in COLUMNS]
+BOOL_COLUMNS = ["aslr", "nx", "pie", "canary", "relro", "symbols", "stripped"]
+
+# The index is saved next to the DB and rebuilt when the DB changes
+INDEX_VERSION = 1
+
+def index_file(dbname):
+    return os.path.splitext(dbname)[0] + "-columns.json"
+
+# Build the columns from the DB entries. "id" is the position in the DB
+# which is what lina.py uses
+def build_index(results):
+    columns = {}
+    for name, key, _, _ in COLUMNS:
+        if name == "id":
+            columns[name] = list(range(len(results)))
+        elif callable(key):
+            columns[name] = [key(t) for t in results]
+        else:
+            columns[name] = [t.get(key) for t in results]
+    columns["version_key"] = [version_key(t.get("version", "")) for t in results]
+    return columns
+
+def load_index(dbname):
+    st = os.stat(dbname)
+    source = {"mtime": st.st_mtime_ns, "size": st.st_size}
+    cache = index_file(dbname)
+    if os.path.isfile(cache):
         try:
-            build_date = t["build_date"]
-        except KeyError:
-            build_date = "?"
-        line += " % 2s" % arch + ' |'
-        line += " % 2s" % aslr + ' |'
-        line += " % 2s" % nx + ' |'
-        line += " % 1s" % pie + ' |'
-        line += " % 1s" % canary + ' |'
-        line += " % 3s" % relro + ' |'
-        line += " % 1s" % symb + ' |'
-        line += " % 2s" % stripped + '  |'
-        line += " % 8s" % uname + ' |'
-        line += " % 5s" % glibc_version + ' |'
-        line += " % 14s" % heap_alloc + ' |'
-        line += " % 10s" % build_date + ' |'
-        line += "% 26s" % t['fw'] + ' |'
+            index = json.loads(open(cache, "r").read())
+            if index.get("version") == INDEX_VERSION and index.get("source") == source:
+                columns = index["columns"]
+                columns["version_key"] = [tuple(tuple(p) for p in k) for k in columns["version_key"]]
+                return columns
+        except ValueError:
+            pass
+    with open(dbname, "r") as tmp:
+        columns = build_index(json.loads(tmp.read()))
+    try:
+        open(cache, "w").write(json.dumps({"version": INDEX_VERSION, "source": source, "columns": columns}))
+    except OSError as e:
+        logmsg("Warning: Could not save the index: %s" % e)
+    return columns
+
+# Row numbers matching all the filters. Version bounds are inclusive and
+# "9.12" as a maximum includes 9.12.x
+def query(columns, arch=None, glibc=None, heap=None, aslr=None, pie=None,
+          min_version=None, max_version=None, fw=None):
+    rows = range(len(columns["id"]))
+    if arch != None:
+        rows = [i for i in rows if columns["arch"][i] == arch]
+    if glibc != None:
+        rows = [i for i in rows if columns["glibc"][i] == glibc]
+    if heap != None:
+        rows = [i for i in rows if columns["heap"][i] != None and heap in columns["heap"][i]]
+    if aslr != None:
+        rows = [i for i in rows if columns["aslr"][i] == aslr]
+    if pie != None:
+        rows = [i for i in rows if columns["pie"][i] == pie]
+    if fw != None:
+        rows = [i for i in rows if fw in columns["fw"][i]]
+    if min_version != None:
+        key = version_key(min_version)
+        rows = [i for i in rows if columns["version_key"][i] >= key]
+    if max_version != None:
+        key = version_key(max_version)
+        rows = [i for i in rows if columns["version_key"][i][:len(key)] <= key]
+    return list(rows)
+
+def cell(columns, name, i):
+    v = columns[name][i]
+    if name in BOOL_COLUMNS:
+        return yes_no(v)
+    if v == None:
+        return "?"
+    return v
+
+# print info/mitigations for ASA firewalls in a markdown-formated table
+def print_mitigations(columns, rows, names=None):
+    if names == None:
+        names = COLUMN_NAMES
+    specs = [c for c in COLUMNS if c[0] in names]
+    if names == COLUMN_NAMES:
+        mitigations_table_header()
+    else:
+        print("|" + "|".join(c[2] for c in specs) + "|")
+        print("|" + "|".join("-" * len(c[2]) for c in specs) + "|")
+    for i in rows:
+        line = "|"
+        for name, _, _, fmt in specs:
+            line += fmt % cell(columns, name, i) + ' |'
         print(line)
-        idx += 1
-    migitations_table_footer()
+    if names == COLUMN_NAMES:
+        migitations_table_footer()
+
+def print_csv(columns, rows, names):
+    w = csv.writer(sys.stdout)
+    w.writerow(names)
+    for i in rows:
+        w.writerow([cell(columns, name, i) for name in names])
+
+def print_json(columns, rows, names):
+    print(json.dumps([{name: columns[name][i] for name in names} for i in rows], indent=4))
 
 # List info/mitigations in a table or directly the JSON (verbose=True)
-def list_mitigations(dbname, bin_name, verbose=True):
-    results = None
-    logmsg("Using dbname %s" % dbname)
-    if os.path.isfile(dbname):
+def list_mitigations(dbname, bin_name, verbose=True, filters={}, names=None, fmt="md"):
+    # keep the CSV/JSON output clean
+    if fmt == "md":
+        logmsg("Using dbname %s" % dbname)
+    if not os.path.isfile(dbname):
+        logmsg("[!] %s not found" % dbname)
+        return
+    if verbose:
         with open(dbname, "r") as tmp:
             results = json.loads(tmp.read())
-    if verbose:
         if bin_name == None:
             print(json.dumps(results, indent=4))
         else:
@@ -135,8 +194,15 @@ def list_mitigations(dbname, bin_name, verbose=True):
                 if r["fw"] == bin_name:
                     print(json.dumps(r, indent=4))
                     break
+        return
+    columns = load_index(dbname)
+    rows = query(columns, **filters)
+    if fmt == "csv":
+        print_csv(columns, rows, names or COLUMN_NAMES)
+    elif fmt == "json":
+        print_json(columns, rows, names or COLUMN_NAMES)
     else:
-        print_mitigations(results)
+        print_mitigations(columns, rows, names)
 
 # Parse some info passed from info.sh so we can save them in a database
 def parse_info2(new_r, info, build_date=None):
@@ -286,7 +352,7 @@ def update_db(dbname, bin_name, info, build_date=None):
         logmsg("Adding new element:")
         print(new_r)
         results.append(new_r)
-    results = sorted(results, key=lambda k: k["version"].split("."))
+    results = sorted(results, key=lambda k: version_key(k["version"]))
     open(dbname, "wb").write(bytes(json.dumps(results, indent=4), encoding="UTF-8"))
 
 if __name__ == "__main__":
@@ -297,6 +363,16 @@ if __name__ == "__main__":
     parser.add_argument('-i', dest='bin_name', help='firmware bin name to update or display')
     parser.add_argument('-v', dest='verbose', help='display more info')
     parser.add_argument('-d', dest='dbname', default=None, help='json database name to read/list info from')
+    parser.add_argument('--arch', dest='arch', type=int, choices=[32, 64], default=None, help='-l: only list this arch')
+    parser.add_argument('--glibc', dest='glibc', default=None, help='-l: only list this glibc version')
+    parser.add_argument('--heap', dest='heap', default=None, help='-l: only list heap allocators containing this string')
+    parser.add_argument('--aslr', dest='aslr', choices=["Y", "N"], default=None, help='-l: only list with/without ASLR')
+    parser.add_argument('--pie', dest='pie', choices=["Y", "N"], default=None, help='-l: only list with/without PIE')
+    parser.add_argument('--min-version', dest='min_version', default=None, help='-l: only list versions >= this one')
+    parser.add_argument('--max-version', dest='max_version', default=None, help='-l: only list versions <= this one (9.12 includes 9.12.x)')
+    parser.add_argument('--fw', dest='fw', default=None, help='-l: only list firmware names containing this string')
+    parser.add_argument('-c', dest='columns', default=None, help='-l: comma separated columns to display (%s)' % ",".join(COLUMN_NAMES))
+    parser.add_argument('-f', dest='format', choices=["md", "csv", "json"], default="md", help='-l: output format')
     args = parser.parse_args()
 
     if args.dbname == None:
@@ -304,7 +380,24 @@ if __name__ == "__main__":
         sys.exit(1)
 
     if args.list_mitigations:
-        list_mitigations(args.dbname, args.bin_name, args.verbose)
+        names = None
+        if args.columns:
+            names = args.columns.split(",")
+            for name in names:
+                if name not in COLUMN_NAMES:
+                    logmsg("Unknown column: %s" % name)
+                    sys.exit(1)
+        filters = {
+            "arch":        args.arch,
+            "glibc":       args.glibc,
+            "heap":        args.heap,
+            "aslr":        None if args.aslr == None else args.aslr == "Y",
+            "pie":         None if args.pie == None else args.pie == "Y",
+            "min_version": args.min_version,
+            "max_version": args.max_version,
+            "fw":          args.fw,
+        }
+        list_mitigations(args.dbname, args.bin_name, args.verbose, filters, names, args.format)
         sys.exit()
 
     if args.update_info:
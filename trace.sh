@@ -0,0 +1,74 @@
+#!/bin/bash
+#
+# This file is part of asafw.
+# Copyright (c) 2017, Aaron Adams <aaron.adams(at)nccgroup(dot)trust>
+# Copyright (c) 2017, Cedric Halbronn <cedric.halbronn(at)nccgroup(dot)trust>
+#
+# Tracing helpers shared by unpack_repack_bin.sh and unpack_repack_qcow2.sh.
+# Usage: source trace.sh
+#
+# The records are written by tracelog.py, see its header for the format.
+
+# tracecmd()
+#
+# Arguments:
+#  $1 (required) - stage name
+#  $2 (required) - input file of the stage or "-"
+#  $3 (required) - output file of the stage or "-"
+#  $@            - command to run
+#
+# Required Globals:
+#  TRACETOOL
+#
+# Description:
+#  Runs a command. If tracing is enabled (--trace or ASAFW_TRACE), the wall
+#  time, CPU time, peak RSS and bytes in/out of the command are recorded in
+#  the ${ASAFW_TRACE} file. Redirections given to tracecmd apply to the
+#  command.
+##
+tracecmd()
+{
+    TRACE_STAGE="${1}"
+    TRACE_ARGS=
+    if [[ "${2}" != "-" ]]; then
+        TRACE_ARGS="${TRACE_ARGS} -i ${2}"
+    fi
+    if [[ "${3}" != "-" ]]; then
+        TRACE_ARGS="${TRACE_ARGS} -o ${3}"
+    fi
+    shift 3
+    if [ -z "${ASAFW_TRACE}" ]; then
+        "$@"
+    else
+        ${TRACETOOL} -s ${TRACE_STAGE} ${TRACE_ARGS} -- "$@"
+    fi
+}
+
+# tracefn()
+#
+# Arguments:
+#  $1 (required) - stage name
+#  $@            - shell function to run and its arguments
+#
+# Required Globals:
+#  TRACETOOL
+#
+# Description:
+#  Runs a shell function. If tracing is enabled, its wall time is recorded in
+#  the ${ASAFW_TRACE} file. CPU time and peak RSS are not available for shell
+#  functions but the external commands they run can use tracecmd.
+##
+tracefn()
+{
+    TRACE_STAGE="${1}"
+    shift
+    if [ -z "${ASAFW_TRACE}" ]; then
+        "$@"
+        return $?
+    fi
+    TRACE_START=$(date +%s.%N)
+    "$@"
+    TRACE_STATUS=$?
+    ${TRACETOOL} -s ${TRACE_STAGE} --start ${TRACE_START} --status ${TRACE_STATUS}
+    return ${TRACE_STATUS}
+}
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+#
+# This file is part of asafw.
+# Copyright (c) 2017, Aaron Adams <aaron.adams(at)nccgroup(dot)trust>
+# Copyright (c) 2017, Cedric Halbronn <cedric.halbronn(at)nccgroup(dot)trust>
+#
+# Per-stage timing and resource tracing for the unpack/modify/repack pipeline.
+#
+# Tracing is enabled by pointing the ASAFW_TRACE environment variable to a
+# file (unpack_repack_bin.sh and unpack_repack_qcow2.sh do it with --trace).
+# Every stage then appends one JSON line to that file:
+#
+# {"stage": "repack.gzip", "fw": "asa924-k8.bin", "batch": "...", "ts": ...,
+#  "wall": 12.3, "cpu_user": 12.1, "cpu_sys": 0.2, "maxrss_kb": 1024,
+#  "bytes_in": ..., "bytes_out": ..., "status": 0, "pid": ...}
+#
+# It is used in 3 different ways:
+# - from Python (bin.py, lina.py, ...) with the stage() context manager
+# - from shell scripts to run and trace an external command:
+#   tracelog.py -s unpack.gunzip -i in.gz -o out.cpio -- gunzip -c in.gz
+# - from shell scripts to record a shell function that already ran:
+#   tracelog.py -s modify.enable_gdb --start <epoch>
+#
+# The collected events can then be summarized per firmware and per batch with
+# -r or converted into the Chrome trace format (chrome://tracing, Perfetto)
+# with -C.
+
+import argparse
+import fcntl
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+def logmsg(s, end=None):
+    if type(s) == str:
+        if end != None:
+            print("[tracelog] " + s, end=end)
+        else:
+            print("[tracelog] " + s)
+    else:
+        print(s)
+
+def trace_file():
+    return os.environ.get("ASAFW_TRACE")
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+def sum_sizes(paths):
+    if not paths:
+        return None
+    sizes = [file_size(p) for p in paths]
+    sizes = [s for s in sizes if s != None]
+    if len(sizes) == 0:
+        return None
+    return sum(sizes)
+
+# Append one event to the trace file. Several processes (shell wrappers,
+# bin.py, lina.py) may write at the same time so we lock the file.
+def emit(event, path=None):
+    if path == None:
+        path = trace_file()
+    if not path:
+        return
+    event.setdefault("fw", os.environ.get("ASAFW_TRACE_FW", ""))
+    event.setdefault("batch", os.environ.get("ASAFW_TRACE_BATCH", ""))
+    event.setdefault("pid", os.getpid())
+    line = json.dumps(event, sort_keys=True) + "\n"
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(line)
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+# Trace a stage running inside the current Python process
+#
+# with stage("bin.repack", inputs=[firmwarefile, gzipfile]) as s:
+#     ...
+#     s.outputs.append(out_bin_name)
+#
+# Note that ru_maxrss is the peak of the whole process so far, not only the
+# peak reached during the stage.
+class stage(object):
+    def __init__(self, name, inputs=None, outputs=None, bytes_in=None, bytes_out=None):
+        self.name       = name
+        self.inputs     = list(inputs) if inputs else []
+        self.outputs    = list(outputs) if outputs else []
+        self.bytes_in   = bytes_in
+        self.bytes_out  = bytes_out
+        self.enabled    = bool(trace_file())
+
+    def __enter__(self):
+        if self.enabled:
+            self._ts = time.time()
+            self._wall = time.perf_counter()
+            self._ru = resource.getrusage(resource.RUSAGE_SELF)
+            if self.bytes_in == None:
+                self.bytes_in = sum_sizes(self.inputs)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.enabled:
+            return False
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        if self.bytes_out == None:
+            self.bytes_out = sum_sizes(self.outputs)
+        status = 0
+        if exc_type == SystemExit:
+            status = exc.code if type(exc.code) == int else 1
+        elif exc_type != None:
+            status = 1
+        emit({
+            "stage":        self.name,
+            "ts":           self._ts,
+            "wall":         time.perf_counter() - self._wall,
+            "cpu_user":     ru.ru_utime - self._ru.ru_utime,
+            "cpu_sys":      ru.ru_stime - self._ru.ru_stime,
+            "maxrss_kb":    ru.ru_maxrss,
+            "bytes_in":     self.bytes_in,
+            "bytes_out":    self.bytes_out,
+            "status":       status,
+        })
+        return False
+
+# Run an external command and trace it. We reap the child ourselves with
+# wait4() so we get its own CPU time and peak RSS (which include the
+# processes it waited for, e.g. all the commands of a "sh -c" pipeline)
+def run(name, cmd, inputs=None, outputs=None):
+    if not trace_file():
+        return subprocess.call(cmd)
+    bytes_in = sum_sizes(inputs)
+    ts = time.time()
+    start = time.perf_counter()
+    try:
+        p = subprocess.Popen(cmd)
+    except OSError as e:
+        logmsg("Error: Could not execute %s: %s" % (cmd[0], e))
+        return 127
+    while True:
+        try:
+            _, waitstatus, ru = os.wait4(p.pid, 0)
+            break
+        except InterruptedError:
+            continue
+    wall = time.perf_counter() - start
+    if os.WIFSIGNALED(waitstatus):
+        status = 128 + os.WTERMSIG(waitstatus)
+    else:
+        status = os.WEXITSTATUS(waitstatus)
+    p.returncode = status
+    emit({
+        "stage":        name,
+        "ts":           ts,
+        "wall":         wall,
+        "cpu_user":     ru.ru_utime,
+        "cpu_sys":      ru.ru_stime,
+        "maxrss_kb":    ru.ru_maxrss,
+        "bytes_in":     bytes_in,
+        "bytes_out":    sum_sizes(outputs),
+        "status":       status,
+    })
+    return status
+
+# Record a stage that ran in a shell function, so we only know its wall time
+def record(name, start, status=0, inputs=None, outputs=None):
+    emit({
+        "stage":        name,
+        "ts":           start,
+        "wall":         time.time() - start,
+        "cpu_user":     None,
+        "cpu_sys":      None,
+        "maxrss_kb":    None,
+        "bytes_in":     sum_sizes(inputs),
+        "bytes_out":    sum_sizes(outputs),
+        "status":       status,
+    })
+
+def load_events(path):
+    events = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                logmsg("Warning: Skipping bad trace line: %s" % line)
+    return events
+
+def fmt_float(v):
+    return "?" if v == None else "%.2f" % v
+
+def fmt_int(v):
+    return "?" if v == None else "%d" % v
+
+def add(a, b):
+    if a == None:
+        return b
+    if b == None:
+        return a
+    return a + b
+
+def summary_table(events):
+    stages = {}
+    order = []
+    for e in events:
+        s = e["stage"]
+        if s not in stages:
+            stages[s] = {"count": 0, "wall": 0.0, "cpu": None, "maxrss_kb": None,
+                         "bytes_in": None, "bytes_out": None, "failed": 0}
+            order.append(s)
+        r = stages[s]
+        r["count"] += 1
+        r["wall"] += e["wall"]
+        r["cpu"] = add(r["cpu"], add(e.get("cpu_user"), e.get("cpu_sys")))
+        if e.get("maxrss_kb") != None:
+            r["maxrss_kb"] = max(r["maxrss_kb"] or 0, e["maxrss_kb"])
+        r["bytes_in"] = add(r["bytes_in"], e.get("bytes_in"))
+        r["bytes_out"] = add(r["bytes_out"], e.get("bytes_out"))
+        if e.get("status"):
+            r["failed"] += 1
+    return order, stages
+
+# print a markdown table of stages sorted by start time
+def print_summary(events, title):
+    order, stages = summary_table(events)
+    # stages can be nested (e.g. modify.inject_debugshell runs lina.py) so
+    # we use the first to last timestamp for the total rather than the sum
+    start = min(e["ts"] for e in events)
+    end = max(e["ts"] + e["wall"] for e in events)
+    total = end - start
+    print("")
+    print("## %s (%.2f s)" % (title, total))
+    print("")
+    print("| Stage                      | Runs |   Wall (s) |    % |    CPU (s) | Peak RSS (KB) |     Bytes in |    Bytes out | Failed |")
+    print("|----------------------------|------|------------|------|------------|---------------|--------------|--------------|--------|")
+    for s in order:
+        r = stages[s]
+        pct = 100.0 * r["wall"] / total if total > 0 else 0.0
+        line = "|"
+        line += " %-26s" % s + ' |'
+        line += " % 4d" % r["count"] + ' |'
+        line += " % 10s" % fmt_float(r["wall"]) + ' |'
+        line += " % 4d" % pct + ' |'
+        line += " % 10s" % fmt_float(r["cpu"]) + ' |'
+        line += " % 13s" % fmt_int(r["maxrss_kb"]) + ' |'
+        line += " % 12s" % fmt_int(r["bytes_in"]) + ' |'
+        line += " % 12s" % fmt_int(r["bytes_out"]) + ' |'
+        line += " % 6d" % r["failed"] + ' |'
+        print(line)
+
+# Summary per firmware, then per batch
+def report(path, batch=None):
+    events = load_events(path)
+    if batch:
+        events = [e for e in events if e.get("batch") == batch]
+    if len(events) == 0:
+        logmsg("No trace events found in %s" % path)
+        return
+    events = sorted(events, key=lambda e: e["ts"])
+    batches = []
+    for e in events:
+        if e.get("batch") not in batches:
+            batches.append(e.get("batch"))
+    for b in batches:
+        bevents = [e for e in events if e.get("batch") == b]
+        fws = []
+        for e in bevents:
+            if e.get("fw") not in fws:
+                fws.append(e.get("fw"))
+        for fw in fws:
+            print_summary([e for e in bevents if e.get("fw") == fw],
+                          "Firmware %s" % (fw if fw else "?"))
+        print_summary(bevents, "Batch %s (%d firmware)" % (b if b else "?", len(fws)))
+
+# Convert to the Chrome trace event format ("X" complete events)
+def export_chrome(path, out):
+    trace = []
+    for e in load_events(path):
+        args = dict((k, v) for k, v in e.items() if k not in ["stage", "ts", "wall", "pid"])
+        trace.append({
+            "name": e["stage"],
+            "cat":  e["stage"].split(".")[0],
+            "ph":   "X",
+            "ts":   int(e["ts"] * 1000000),
+            "dur":  int(e["wall"] * 1000000),
+            "pid":  e.get("fw") or "asafw",
+            "tid":  e.get("pid", 0),
+            "args": args,
+        })
+    with open(out, "w") as f:
+        f.write(json.dumps({"traceEvents": trace}))
+    logmsg("Wrote %d events to %s" % (len(trace), out))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--trace-file', dest='trace_file', default=None,
+                        help="Trace file (default: $ASAFW_TRACE)")
+    parser.add_argument('-s', '--stage', dest='stage', default=None,
+                        help="Stage name to record")
+    parser.add_argument('-i', '--input', dest='inputs', action='append', default=[],
+                        help="Input file of the stage (can be repeated)")
+    parser.add_argument('-o', '--output', dest='outputs', action='append', default=[],
+                        help="Output file of the stage (can be repeated)")
+    parser.add_argument('--start', dest='start', type=float, default=None,
+                        help="Start time (epoch) of a shell stage that already ran")
+    parser.add_argument('--status', dest='status', type=int, default=0,
+                        help="Exit status of a shell stage that already ran")
+    parser.add_argument('-r', '--report', dest='report', default=False, action="store_true",
+                        help="Print a summary per firmware and per batch")
+    parser.add_argument('-b', '--batch', dest='batch', default=None,
+                        help="Only report this batch")
+    parser.add_argument('-C', '--chrome', dest='chrome', default=None,
+                        help="Export the trace in Chrome trace format to this file")
+    parser.add_argument('cmd', nargs=argparse.REMAINDER,
+                        help="-- command to run and trace")
+    args = parser.parse_args()
+
+    if args.trace_file:
+        os.environ["ASAFW_TRACE"] = os.path.abspath(args.trace_file)
+
+    if args.report or args.chrome:
+        if not trace_file():
+            parser.error("[tracelog] Error: Provide a trace file with -t or $ASAFW_TRACE")
+        if args.report:
+            report(trace_file(), args.batch)
+        if args.chrome:
+            export_chrome(trace_file(), args.chrome)
+        sys.exit()
+
+    if not args.stage:
+        parser.error("[tracelog] Error: Provide a stage name with -s")
+
+    cmd = args.cmd
+    if cmd and cmd[0] == "--":
+        cmd = cmd[1:]
+    if cmd:
+        sys.exit(run(args.stage, cmd, args.inputs, args.outputs))
+    if args.start == None:
+        parser.error("[tracelog] Error: Provide either a command to run or --start")
+    if trace_file():
+        record(args.stage, args.start, args.status, args.inputs, args.outputs)
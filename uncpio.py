@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+#
+# This file is part of asafw.
+# Copyright (c) 2017, Aaron Adams <aaron.adams(at)nccgroup(dot)trust>
+# Copyright (c) 2017, Cedric Halbronn <cedric.halbronn(at)nccgroup(dot)trust>
+#
+# Extract a newc cpio rootfs (gzip compressed or not), like
+# "cpio -id --no-absolute-filenames" but writing the files from a pool of
+# threads (see newc.extract()). Creating thousands of small files one after
+# the other is what makes cpio slow on network and overlay filesystems.
+#
+# The rootfs can also be read directly from an asa*.bin.
+
+import argparse
+import mmap
+import os
+import sys
+
+from tracelog import stage
+import bin
+import newc
+
+def logmsg(s, end=None):
+    if type(s) == str:
+        if end != None:
+            print("[uncpio] " + s, end=end)
+        else:
+            print("[uncpio] " + s)
+    else:
+        print(s)
+    sys.stdout.flush()
+
+# Extract the cpio (or gzip cpio) "infile" to "root"
+def extract_file(infile, root, jobs=None, preserve_mtime=False):
+    with open(infile, 'rb') as f:
+        magic = f.read(2)
+        f.seek(0)
+        if magic == b"\x1f\x8b":
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                count, skipped = newc.extract(newc.GzipStream(data, 0, len(data)), root, jobs=jobs,
+                                              preserve_mtime=preserve_mtime)
+            finally:
+                data.close()
+        else:
+            count, skipped = newc.extract(f, root, jobs=jobs, preserve_mtime=preserve_mtime)
+    return count, skipped
+
+# Extract the rootfs of an asa*.bin to "root"
+def extract_firmware(firmwarefile, root, jobs=None, preserve_mtime=False):
+    with open(firmwarefile, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        gz_size, _, idx_gz, _ = bin.find_offsets(data)
+        count, skipped = newc.extract(newc.GzipStream(data, idx_gz, gz_size), root, jobs=jobs,
+                                      preserve_mtime=preserve_mtime)
+    finally:
+        data.close()
+    return count, skipped
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', dest='infile', default=None,
+                        help="cpio or gzip compressed cpio archive to extract")
+    parser.add_argument('-f', dest='firmwarefile', default=None,
+                        help="asa*.bin to extract the rootfs of")
+    parser.add_argument('-d', dest='outdir', default=".",
+                        help="Where to extract the files (default: current folder)")
+    parser.add_argument('-j', dest='jobs', type=int, default=None,
+                        help="Number of writing threads (default: 4 x number of CPUs)")
+    parser.add_argument('-m', dest='preserve_mtime', default=False, action="store_true",
+                        help="Keep the modification times of the archive (like cpio -m)")
+    args = parser.parse_args()
+
+    if (args.infile == None) == (args.firmwarefile == None):
+        logmsg("Error: Use one of -i or -f")
+        sys.exit(1)
+    os.makedirs(args.outdir, exist_ok=True)
+    try:
+        if args.infile != None:
+            with stage("uncpio.extract", inputs=[args.infile]):
+                count, skipped = extract_file(args.infile, args.outdir, args.jobs, args.preserve_mtime)
+        else:
+            with stage("uncpio.extract", inputs=[args.firmwarefile]):
+                count, skipped = extract_firmware(args.firmwarefile, args.outdir, args.jobs,
+                                                  args.preserve_mtime)
+    except (newc.NewcError, OSError) as e:
+        logmsg("Error: %s" % e)
+        sys.exit(1)
+    if skipped != 0:
+        logmsg("Warning: Could not create %d device nodes (not root?)" % skipped)
+    logmsg("Extracted %d entries to %s" % (count, args.outdir))
+
+if __name__ == '__main__':
+    main()
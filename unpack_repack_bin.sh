@@ -51,6 +51,8 @@ dbglog()
     fi
 }
 
+source "$(dirname "$(readlink -f "${BASH_SOURCE[0]}")")/trace.sh"
+
 usage()
 {
     echo "Usage:"
@@ -64,6 +66,7 @@ usage()
     echo "      -a, --enable-aslr            Turn on ASLR"
     echo "      -A, --disable-aslr           Turn off ASLR"
     echo "      -m, --inject-gdb             Inject gdbserver for firmware lacking this file"
+    echo "      --gdb-tcp <port>             gdbserver listens on this TCP port instead of the serial port (at boot with -g and in ldebug.sh/lattach.sh)"
     echo "      -b, --debug-shell            Inject ssh-triggered debug shell"
     echo "      -B, --serial-shell           Configure a serial shell on ASA 2nd serial port"
     echo "      -H, --lina-hook              Inject hooks for monitor lina heap (requires -b)"
@@ -81,6 +84,13 @@ usage()
     echo "      --replace-linamonitor <path> Use a simple name for the output .bin with just appended '-repacked'"
     echo "      --original-firmware <name>   Name of original firmware file. for use with --repack-only"
     echo "      --bin-with-asa-to-inject <firmware_file>    Additional firmware bin file to take /asa folder from and inject into the one specified with -i"
+    echo "      --trace <trace_file>         Record per-stage timing and resource usage to <trace_file> and print a summary"
+    echo "      --verify                     Check that only the rootfs changed in the repacked firmware and list the changed files"
+    echo "      --delta                      Also save the delta from the original firmware as <output>.delta (see delta.py). Implies compressing the rootfs with cpiogz.py"
+    echo "      --pristine-rootfs <dir>      Start from a copy of this already extracted rootfs of the firmware (used by asafwd.py)"
+    echo "      --gz-cache <dir>             Compress the rootfs with cpiogz.py, reusing the compressed segments cached in <dir>"
+    echo "      --deterministic              Create the rootfs with cpiogz.py so the same content always gives the same firmware (mtimes set to \$SOURCE_DATE_EPOCH or 0)"
+    echo "      --extract-jobs <n>           Extract the rootfs with uncpio.py writing files from <n> threads instead of cpio"
     echo "      -v, --verbose                Display debug messages"
     echo "Examples:"
     echo " # Unpack and repack a firmware file, freeing space, enabling gdb, and injecting gdbserver bin. Output modifications to firmware_repacked dir"
@@ -95,6 +105,8 @@ usage()
     echo " ./unpack_repack_bin.sh --repack-only -i _asa924-smp-k8.bin.extracted --output-bin asa924-smp-k8-repacked.bin --original-firmware /home/user/firmware/asa924-smp-k8.bin --free-space --replace-linamonitor /home/user/firmware/lina_monitor_patched"
     echo " # Unpack and repack a firmware file, freeing space, enabling gdb, debug shell and linahook"
     echo " ./unpack_repack_bin.sh -i asa924-smp-k8.bin -f -g -b -H hat"
+    echo " # Same as above but find out which stage is the slowest"
+    echo " ./unpack_repack_bin.sh -i asa924-smp-k8.bin -f -g -b -H hat --trace /tmp/asafw-trace.jsonl"
     exit 1
 }
 
@@ -137,6 +149,7 @@ determine_rootfs_name()
 #
 # Required Globals:
 #  FWFILE
+#  UNCPIOTOOL (if EXTRACT_JOBS is set)
 #
 # Notes:
 #  Expects current folder being the dirname of $FWFILE
@@ -151,9 +164,9 @@ extract_bin()
 {
     log "extract_bin: $FWFILE"
     if [ -z ${DEBUG} ]; then
-        ${BINWALK} -e ${FWFILE} > /dev/null
+        tracecmd extract.binwalk ${FWFILE} - ${BINWALK} -e ${FWFILE} > /dev/null
     else
-        ${BINWALK} -e ${FWFILE}
+        tracecmd extract.binwalk ${FWFILE} - ${BINWALK} -e ${FWFILE}
     fi
     if [ $? != 0 ];
     then
@@ -186,7 +199,11 @@ extract_bin()
     log "Extracting ${FWFOLDER}/rootfs/${ROOTFS} into $(pwd)"
     # We really need --no-absolute-filenames as otherwise we may corrupt
     # our own filesystem...
-    ${CPIO} -id --no-absolute-filenames > /dev/null 2>&1 < ../${ROOTFS}
+    if [ ! -z "${EXTRACT_JOBS}" ]; then
+        tracecmd extract.uncpio ../${ROOTFS} - ${UNCPIOTOOL} -i ../${ROOTFS} -d . -j ${EXTRACT_JOBS} > /dev/null
+    else
+        tracecmd extract.cpio ../${ROOTFS} - ${CPIO} -id --no-absolute-filenames > /dev/null 2>&1 < ../${ROOTFS}
+    fi
     LINA=${FWFOLDER}/rootfs/asa/bin/lina
     LINA_MONITOR=${FWFOLDER}/rootfs/asa/bin/lina_monitor
     if [[ ! -z $LINABINDIR && -d $LINABINDIR ]]
@@ -243,6 +260,7 @@ extract_bin()
 ##
 unpack_repack_bin()
 {
+    export ASAFW_TRACE_FW=${FWFILE}
     if [[ "${UNPACK_ONLY}" == "YES" ]]
     then
         extract_bin
@@ -268,9 +286,12 @@ unpack_repack_bin()
 #
 # Required Globals:
 #  FWFILE
+#  UNCPIOTOOL (if EXTRACT_JOBS is set)
 #
 # Notes:
 #  Expects current folder being the dirname of $FWFILE
+#  With EXTRACT_JOBS, the gzip rootfs is extracted by uncpio.py without
+#  gunzip and cpio
 #
 # Description:
 #  Extracts a .bin using our asafw bin.py script. Creates a 'work/' directory
@@ -318,6 +339,10 @@ unpack_bin()
     then
         OUTFILE_SUFFIX=$OUTFILE_SUFFIX-gdbserver
     fi
+    if [ ! -z "${GDB_TCP_PORT}" ]
+    then
+        OUTFILE_SUFFIX=$OUTFILE_SUFFIX-gdbtcp${GDB_TCP_PORT}
+    fi
     OUTFILE_SUFFIX=$OUTFILE_SUFFIX.${EXTFILE}
     OUTFILE=${OUTDIR}/${OUTFILE_PREFIX}${OUTFILE_SUFFIX}
 
@@ -336,13 +361,38 @@ unpack_bin()
     GZIP_MODIFIED=${FOLDERFWFILE}/rootfs.img.gz
     VMLINUZ_ORIGINAL=${FOLDERFWFILE}/${BASEFWFILE_NOEXT}-vmlinuz
 
-    ${FWTOOL} -u -f "$INFILE"
+    if [ ! -z "${PRISTINE_ROOTFS}" ]
+    then
+        # The rootfs of this firmware was already extracted so we don't need
+        # bin.py, gunzip and cpio. bin.py -r only needs the original .bin
+        log "Using pristine rootfs ${PRISTINE_ROOTFS}"
+        rm -Rf work
+        tracecmd unpack.copy_pristine - - cp -a --reflink=auto "${PRISTINE_ROOTFS}" work
+        if [ $? != 0 ];
+        then
+            log "ERROR: cp -a ${PRISTINE_ROOTFS} work failed"
+            exit 1
+        fi
+        return
+    fi
+
+    tracecmd unpack.bin_py "$INFILE" - ${FWTOOL} -u -f "$INFILE"
     if [ $? != 0 ];
     then
         log "ERROR: ${FWTOOL} -u -f "$INFILE" failed"
         exit 1
     fi
-    ${GUNZIP} -c "$GZIP_ORIGINAL" > "$CPIO_ORIGINAL"
+    if [ ! -z "${EXTRACT_JOBS}" ]; then
+        rm -Rf work
+        tracecmd unpack.uncpio "$GZIP_ORIGINAL" - ${UNCPIOTOOL} -i "$GZIP_ORIGINAL" -d work -j ${EXTRACT_JOBS} > /dev/null
+        if [ $? != 0 ];
+        then
+            log "ERROR: ${UNCPIOTOOL} -i $GZIP_ORIGINAL -d work failed"
+            exit 1
+        fi
+        return
+    fi
+    tracecmd unpack.gunzip "$GZIP_ORIGINAL" "$CPIO_ORIGINAL" ${GUNZIP} -c "$GZIP_ORIGINAL" > "$CPIO_ORIGINAL"
     if [ $? != 0 ];
     then
         log "ERROR: ${GUNZIP} -c $GZIP_ORIGINAL > $CPIO_ORIGINAL failed"
@@ -353,7 +403,7 @@ unpack_bin()
     cd work
     # We really need --no-absolute-filenames as otherwise we may corrupt
     # our own filesystem...
-    ${CPIO} -id --no-absolute-filenames > /dev/null 2>&1 < "$CPIO_ORIGINAL"
+    tracecmd unpack.cpio "$CPIO_ORIGINAL" - ${CPIO} -id --no-absolute-filenames > /dev/null 2>&1 < "$CPIO_ORIGINAL"
     cd .. # leave work
 }
 
@@ -457,6 +507,18 @@ enable_gdb()
             # XXX - untested - do we need to patch lina_monitor too?
             log "Using asa804 ASA gdb patching method"
             sed -i 's/\(\/asa\/bin\/lina_monitor\)/\1 -g -s \/dev\/ttyS0 -d/' asa/scripts/rcS
+        elif [ ! -z "${GDB_TCP_PORT}" ]
+        then
+            log "Using recent ASA gdb patching method, gdbserver listening on TCP port ${GDB_TCP_PORT}"
+            if grep -q '#.*gdbserver.*/dev/ttyUSB0' asa/scripts/rcS
+            then
+                sed -i "s/#\(.*gdbserver.*\)\/dev\/ttyUSB0\(.*\)/\1:${GDB_TCP_PORT}\2/" asa/scripts/rcS
+            else
+                log "WARNING: gdbserver line not found in rcS, falling back to the serial port"
+                sed -i 's/#\(.*\)ttyUSB0\(.*\)/\1ttyS0\2/' asa/scripts/rcS
+                sed -i 's/ttyS0::once:\/tmp\/run_cmd/tty0::once:\/tmp\/run_cmd/' etc/inittab
+            fi
+            # the serial console is not used by gdb so we keep it in inittab
         else
             log "Using recent ASA gdb patching method"
             sed -i 's/#\(.*\)ttyUSB0\(.*\)/\1ttyS0\2/' asa/scripts/rcS
@@ -466,6 +528,53 @@ enable_gdb()
     fi
 }
 
+# setup_gdb_tcp()
+#
+# Arguments:
+#  None
+#
+# Required Globals:
+#   GDB_TCP_PORT - TCP port for gdbserver
+#   TOOLDIR - asafw folder holding binfs/
+#
+# Notes:
+#  Expects $PWD to be an extracted rootfs directory
+#
+# Description:
+#  Saves the gdbserver TCP port in asa/scripts/asafw_gdb.conf and injects the
+#  scripts to (re)start lina under gdbserver or attach gdbserver to it. They
+#  use the port from asafw_gdb.conf instead of the serial port, so gdb can be
+#  used from the debug shell (-b) after boot, or on the forwarded port.
+##
+setup_gdb_tcp()
+{
+    if [ ! -z "${GDB_TCP_PORT}" ]
+    then
+        log "Saving gdbserver TCP port ${GDB_TCP_PORT} in asa/scripts/asafw_gdb.conf"
+        echo "GDB_TCP_PORT=${GDB_TCP_PORT}" > asa/scripts/asafw_gdb.conf
+
+        declare -a scripts_list=("ldebug.sh" "lattach.sh" "lkill.sh" "lclean.sh")
+        for file in "${scripts_list[@]}"
+        do
+            log "Copying ${file} script"
+            CMD="cp ${TOOLDIR}/binfs/${file} asa/scripts/${file}"
+            ${CMD}
+            if [ $? != 0 ];
+            then
+                log "ERROR: '${CMD}' failed"
+                exit 1
+            fi
+            CMD="chmod +x asa/scripts/${file}"
+            ${CMD}
+            if [ $? != 0 ];
+            then
+                log "ERROR: '${CMD}' failed"
+                exit 1
+            fi
+        done
+    fi
+}
+
 # disable_gdb()
 #
 # Arguments:
@@ -523,12 +632,14 @@ fix_gns3_interface()
 # Required Globals:
 #  FWFILE      - name of current firmware being worked on
 #  FIRMWAREDIR - directory holding collection of firmware
+#  DONORTOOL   - donors.py indexing the firmware of FIRMWAREDIR
 #
 # Notes:
 #  Expects $PWD to be an extracted rootfs directory
-#  XXX - Makes undocumented assumptions about FIRMWAREDIR layout that will
-#        sometimes break. We should include those gdb files in asafw repo and
-#        copy them from somewhere static
+#  The donor firmware is picked by ${DONORTOOL} among the firmware of
+#  FIRMWAREDIR having the files, with the same architecture as the current
+#  firmware and not needing a more recent glibc. The files are read from the
+#  donor without extracting it
 #
 # Description:
 #  Injects a gdbserver binary from a separate firmware in FIRMWAREDIR into the
@@ -548,33 +659,19 @@ inject_gdb()
             read CMD
         fi
         log "INJECT OTHER GDB"
-        if [[ "$FWFILE" == *"asa803"* ]]; then
-            FIRMWARE_WITH_GDB="asa924-k8.bin"
-        else
-            FIRMWARE_WITH_GDB="asa931-smp-k8.bin"
-        fi
-        log "Using gdbserver from ${FIRMWARE_WITH_GDB}"
-        if [ ! -d "${FIRMWAREDIR}/_${FIRMWARE_WITH_GDB}.extracted" ]; then
-            log "Didn't find ${FIRMWAREDIR}/_${FIRMWARE_WITH_GDB}.extracted"
-            log "Need to binwalk ${FIRMWARE_WITH_GDB} to allow file stealing"
-            if [ ! -e "${FIRMWAREDIR}/${FIRMWARE_WITH_GDB}" ]; then
-                log "ERROR: Can't find ${FIRMWAREDIR}/${FIRMWARE_WITH_GDB} so can't binwalk it"
-                exit 1
-            fi
-            LASTDIR=$(pwd)
-            cd ${FIRMWAREDIR}
-            ${BINWALK} -e ${FIRMWARE_WITH_GDB}
-            cd ${LASTDIR}
-        fi
         if [[ "$FWFILE" == *"asa803"* ]]; then
             # On ASA803, the gdbserver is not able to "info proc cmdline" or "info proc mappings"
             # The gdbserver from ASA924 is better in that we can at least "info proc cmdline"....
-            cp ${FIRMWAREDIR}/_${FIRMWARE_WITH_GDB}.extracted/rootfs/usr/bin/gdbserver bin/
+            DONOR_FILES="-g usr/bin/gdbserver:bin/gdbserver"
         else
-            cp ${FIRMWAREDIR}/_${FIRMWARE_WITH_GDB}.extracted/rootfs/usr/bin/gdbserver usr/bin/
-            cp ${FIRMWAREDIR}/_${FIRMWARE_WITH_GDB}.extracted/rootfs/lib64/libthread_db-1.0.so lib64/
-            # we should copy the symlink instead of copying the file but does the job for now
-            cp ${FIRMWAREDIR}/_${FIRMWARE_WITH_GDB}.extracted/rootfs/lib64/libthread_db.so.1 lib64/
+            DONOR_FILES="-g usr/bin/gdbserver -g lib64/libthread_db-1.0.so -g lib64/libthread_db.so.1"
+        fi
+        CMD="${DONORTOOL} -d ${FIRMWAREDIR} -r . -o . -X ${FWFILE} ${DONOR_FILES}"
+        ${CMD}
+        if [ $? != 0 ];
+        then
+            log "ERROR: '${CMD}' failed"
+            exit 1
         fi
     fi
 }
@@ -588,9 +685,11 @@ inject_gdb()
 #  FWFILE_WITH_ASA_TO_INJECT - custom firmware to take /asa from
 #  FWFILE      - name of current firmware being worked on to inject new /asa (needs to be asa921-*.bin)
 #  FIRMWAREDIR - directory holding collection of firmware
+#  DONORTOOL   - donors.py
 #
 # Notes:
 #  Expects $PWD to be an extracted rootfs directory
+#  Only /asa is extracted from FWFILE_WITH_ASA_TO_INJECT
 #
 # Description:
 #  Injects an /asa/ folder from a separate firmware in FIRMWAREDIR into the
@@ -612,21 +711,13 @@ inject_asa_folder()
             exit 1
         fi
         log "Checking ${FWFILE_WITH_ASA_TO_INJECT}"
-        if [ ! -d "${FIRMWAREDIR}/_${FWFILE_WITH_ASA_TO_INJECT}.extracted" ]; then
-            log "Didn't find ${FIRMWAREDIR}/_${FWFILE_WITH_ASA_TO_INJECT}.extracted"
-            log "Need to binwalk ${FWFILE_WITH_ASA_TO_INJECT} to allow file stealing"
-            if [ ! -e "${FIRMWAREDIR}/${FWFILE_WITH_ASA_TO_INJECT}" ]; then
-                log "ERROR: Can't find ${FIRMWAREDIR}/${FWFILE_WITH_ASA_TO_INJECT} so can't binwalk it"
-                exit 1
-            fi
-            LASTDIR=$(pwd)
-            cd ${FIRMWAREDIR}
-            ${BINWALK} -e ${FWFILE_WITH_ASA_TO_INJECT}
-            cd ${LASTDIR}
+        if [ ! -e "${FIRMWAREDIR}/${FWFILE_WITH_ASA_TO_INJECT}" ]; then
+            log "ERROR: Can't find ${FIRMWAREDIR}/${FWFILE_WITH_ASA_TO_INJECT}"
+            exit 1
         fi
         log "Using /asa from ${FWFILE_WITH_ASA_TO_INJECT}"
         rm -Rf ./asa
-        CMD="cp -Rf ${FIRMWAREDIR}/_${FWFILE_WITH_ASA_TO_INJECT}.extracted/rootfs/asa ."
+        CMD="${DONORTOOL} -F ${FIRMWAREDIR}/${FWFILE_WITH_ASA_TO_INJECT} -e asa -o ."
         ${CMD}
         if [ $? != 0 ];
         then
@@ -661,9 +752,14 @@ replace_lina_monitor()
 #  None
 #
 # Required Globals:
+#  INFILE - the firmware being repacked (set by unpack_bin), passed to lina.py -I
+#  ORIGINAL_FIRMWARE - the original firmware, used instead with --repack-only
+#  FWFILE_WITH_ASA_TO_INJECT - custom firmware to take /asa from
 #
 # Notes:
 #  Expects $PWD to be an extracted rootfs directory
+#  The target is looked up by bin name in ${ASADBG_DB} first. If the firmware
+#  was renamed, lina.py identifies it from the image itself (fingerprint.py)
 ##
 inject_debugshell()
 {
@@ -672,11 +768,26 @@ inject_debugshell()
     if [[ "$DEBUGSHELL" == "YES" ]]
     then
         FWFILE_WITH_ASA=${FWFILE}
+        IMAGE_WITH_ASA=${INFILE}
+        if [[ ${REPACK_ONLY} == "YES" ]]
+        then
+            # unpack_bin was not called, the rootfs comes from the original
+            # firmware
+            FWFILE_WITH_ASA=$(basename "${ORIGINAL_FIRMWARE}")
+            IMAGE_WITH_ASA=$(cd ${ORIGDIR} && readlink -f "${ORIGINAL_FIRMWARE}")
+        fi
         if [ ! -z ${FWFILE_WITH_ASA_TO_INJECT} ]
         then
             FWFILE_WITH_ASA=${FWFILE_WITH_ASA_TO_INJECT}
+            IMAGE_WITH_ASA=${FIRMWAREDIR}/${FWFILE_WITH_ASA_TO_INJECT}
             log "debug shell: overriding firmware with ${FWFILE_WITH_ASA} to patch lina correctly"
         fi
+        # only if we have the image, lina.py then relies on the bin name
+        IMAGEARGS=
+        if [ -f "${IMAGE_WITH_ASA}" ]
+        then
+            IMAGEARGS="-I ${IMAGE_WITH_ASA}"
+        fi
 
         ADDITIONAL_ARGS=""
         if [[ ! -z "${LINAHOOK}" ]]
@@ -702,10 +813,9 @@ inject_debugshell()
         fi
         # NOTE: we pass as many arguments as possible to LINA_LINUXSHELL and it is up to that script to know
         #       if libc is used for malloc()/etc. and if lina_monitor needs to be patched.
-        CMD="${LINA_LINUXSHELL} -b ${FWFILE_WITH_ASA} -F ${PWD}/asa/bin/lina_monitor -O ${PWD}/asa/bin/lina_monitor -f ${PWD}/asa/bin/lina -o ${PWD}/asa/bin/lina -c $CBHOST -p $CBPORT -d ${ASADBG_DB} ${ADDITIONAL_ARGS} --libc-input ${LIBC} --libc-output ${LIBC}"
+        CMD="${LINA_LINUXSHELL} -b ${FWFILE_WITH_ASA} ${IMAGEARGS} -F ${PWD}/asa/bin/lina_monitor -O ${PWD}/asa/bin/lina_monitor -f ${PWD}/asa/bin/lina -o ${PWD}/asa/bin/lina -c $CBHOST -p $CBPORT -d ${ASADBG_DB} ${ADDITIONAL_ARGS} --libc-input ${LIBC} --libc-output ${LIBC} --callback-config ${PWD}/asa/scripts/asafw_cb.conf"
 
         log "Using command: '${CMD}'"
-        # XXX - fix fact that we use -b to specify the bin_name but it would not work if the name is not one of the original Cisco ones (such as asa924-k8.bin)
         ${CMD}
 
         if [ $? != 0 ];
@@ -713,6 +823,18 @@ inject_debugshell()
             log "ERROR: '${CMD}' failed"
             exit 1
         fi
+
+        # The callback IP/port can then be changed at boot with asafw_cb=IP:PORT
+        # in the kernel command line (bin.py --callback) or in asafw_cb.conf
+        cp ${TOOLDIR}/binfs/asafw_cb.sh asa/scripts/asafw_cb.sh
+        chmod +x asa/scripts/asafw_cb.sh
+        if grep -q 'echo "$CGEXEC /asa/bin/lina_monitor' asa/scripts/rcS
+        then
+            log "debug shell: setting the callback from asafw_cb.sh before lina starts"
+            sed -i '/echo "$CGEXEC \/asa\/bin\/lina_monitor/i \/asa\/scripts\/asafw_cb.sh' asa/scripts/rcS
+        else
+            log "WARNING: lina_monitor start not found in rcS, run /asa/scripts/asafw_cb.sh before lina to change the callback"
+        fi
     fi
 }
 
@@ -871,7 +993,7 @@ cleanup()
     then
         log "CLEANUP"
         dbglog "Removing $GZIP_ORIGINAL $CPIO_ORIGINAL $GZIP_MODIFIED $VMLINUZ_ORIGINAL"
-        rm $GZIP_ORIGINAL $CPIO_ORIGINAL $GZIP_MODIFIED $VMLINUZ_ORIGINAL
+        rm -f $GZIP_ORIGINAL $CPIO_ORIGINAL $GZIP_MODIFIED $VMLINUZ_ORIGINAL
     fi
 }
 
@@ -897,17 +1019,18 @@ modify_bin()
     OLDDIR=${PWD}
     cd ${1}
 
-    inject_asa_folder # early so all other modifications are done on the right /asa files
-    disable_aslr
-    enable_gdb
-    disable_gdb
-    fix_gns3_interface
-    free_space
-    inject_gdb
-    replace_lina_monitor
-    inject_debugshell
-    setup_serialshell
-    custom
+    tracefn modify.inject_asa_folder inject_asa_folder # early so all other modifications are done on the right /asa files
+    tracefn modify.disable_aslr disable_aslr
+    tracefn modify.enable_gdb enable_gdb
+    tracefn modify.setup_gdb_tcp setup_gdb_tcp
+    tracefn modify.disable_gdb disable_gdb
+    tracefn modify.fix_gns3_interface fix_gns3_interface
+    tracefn modify.free_space free_space
+    tracefn modify.inject_gdb inject_gdb
+    tracefn modify.replace_lina_monitor replace_lina_monitor
+    tracefn modify.inject_debugshell inject_debugshell
+    tracefn modify.setup_serialshell setup_serialshell
+    tracefn modify.custom custom
 
     # Return to original folder
     dbglog "Returning to ${OLDDIR}"
@@ -923,9 +1046,16 @@ modify_bin()
 #
 # Globals Required:
 #   CPIO
+#   CPIOGZTOOL (if GZ_CACHE, DETERMINISTIC or DELTA is set)
 #
 # Notes:
 #  If $2 is specified, then $3 must also be specified.
+#  With DETERMINISTIC, the rootfs only depends on its content: entries are
+#  sorted, inode numbers derived from the names, all the modification times
+#  set to SOURCE_DATE_EPOCH (0 if unset) and the gzip header is fixed
+#  With DELTA, the rootfs is also compressed with cpiogz.py as delta.py can
+#  only save it as a small rebuild recipe if zlib reproduces its compression,
+#  which is not the case with gzip -9
 #
 # TODO:
 #  - It would be nice if we just derive $3 from $1
@@ -950,7 +1080,30 @@ repack_bin()
     fi
 
     log "repack_bin: $FWFILE"
-    find . | ${CPIO} -o -H newc 2>/dev/null | gzip -9 > "$GZIP_MODIFIED"
+    if [ ! -z "${GZ_CACHE}" ] || [[ "${DETERMINISTIC}" == "YES" ]] || [[ "${DELTA}" == "YES" ]]; then
+        # With a cache, only compress the parts of the rootfs that changed
+        # since the previous builds
+        if [ ! -z "${GZ_CACHE}" ]; then
+            CPIOGZARGS="-C ${GZ_CACHE}"
+        else
+            CPIOGZARGS="--no-cache"
+        fi
+        if [[ "${DETERMINISTIC}" == "YES" ]]; then
+            CPIOGZARGS="${CPIOGZARGS} --mtime ${SOURCE_DATE_EPOCH:-0}"
+        fi
+        # the segments make the rootfs a bit bigger than with gzip -9, so let
+        # cpiogz.py fall back to a single stream if it doesn't fit anymore
+        CPIOGZARGS="${CPIOGZARGS} -f $(cd ${OLDDIR} && readlink -f "${FWFILE}")"
+        tracecmd repack.cpiogz - "$GZIP_MODIFIED" ${CPIOGZTOOL} -d . -o "$GZIP_MODIFIED" ${CPIOGZARGS}
+        if [ $? != 0 ];
+        then
+            log "ERROR: ${CPIOGZTOOL} -d . -o "$GZIP_MODIFIED" ${CPIOGZARGS} failed"
+            exit 1
+        fi
+    else
+        tracecmd repack.cpio - - sh -c "find . | ${CPIO} -o -H newc 2>/dev/null" | \
+            tracecmd repack.gzip - "$GZIP_MODIFIED" gzip -9 > "$GZIP_MODIFIED"
+    fi
 
     # Leave working directory
     dbglog "Returning to ${OLDDIR}"
@@ -964,16 +1117,32 @@ repack_bin()
     else
         ROOTARGS=
     fi
-    dbglog ${FWTOOL} -r -f "$FWFILE" -g "$GZIP_MODIFIED" -o "$OUTFILE" $ROOTARGS $DISABLE_ASLR_ARGS
-    ${FWTOOL} -r -f "$FWFILE" -g "$GZIP_MODIFIED" -o "$OUTFILE" $ROOTARGS $DISABLE_ASLR_ARGS
+    if [[ "${DELTA}" == "YES" ]]
+    then
+        DELTAARGS="-D ${OUTFILE}.delta"
+    else
+        DELTAARGS=
+    fi
+    dbglog ${FWTOOL} -r -f "$FWFILE" -g "$GZIP_MODIFIED" -o "$OUTFILE" $ROOTARGS $DISABLE_ASLR_ARGS $DELTAARGS
+    tracecmd repack.bin_py "$GZIP_MODIFIED" "$OUTFILE" ${FWTOOL} -r -f "$FWFILE" -g "$GZIP_MODIFIED" -o "$OUTFILE" $ROOTARGS $DISABLE_ASLR_ARGS $DELTAARGS
     if [ $? != 0 ];
     then
-        log "${FWTOOL} -r -f "$FWFILE" -g "$GZIP_MODIFIED" -o "$OUTFILE" $ROOTARGS $DISABLE_ASLR_ARGS failed"
+        log "${FWTOOL} -r -f "$FWFILE" -g "$GZIP_MODIFIED" -o "$OUTFILE" $ROOTARGS $DISABLE_ASLR_ARGS $DELTAARGS failed"
         exit 1
     fi
 
+    if [[ "${VERIFY}" == "YES" ]]
+    then
+        tracecmd repack.verify "$OUTFILE" - ${FWTOOL} -V "$FWFILE" -f "$OUTFILE"
+        if [ $? != 0 ];
+        then
+            log "ERROR: ${FWTOOL} -V "$FWFILE" -f "$OUTFILE" failed"
+            exit 1
+        fi
+    fi
+
     echo -n "[unpack_repack_bin] MD5: "
-    md5sum "${OUTFILE}"
+    tracecmd repack.md5sum "${OUTFILE}" - md5sum "${OUTFILE}"
     cleanup
 }
 
@@ -1006,6 +1175,7 @@ DISABLE_GDB="NO"
 ENABLE_ASLR="NO"
 DISABLE_ASLR="NO"
 INJECT_GDB="NO"
+GDB_TCP_PORT=
 CUSTOM="NO"
 NO_CLEANUP="NO"
 DEBUGSHELL="NO"
@@ -1023,6 +1193,13 @@ ORIGINAL_FIRMWARE=
 REPLACE_LINAMONITORITOR=
 DEBUG=
 FWFILE_WITH_ASA_TO_INJECT=
+TRACE_OWNER="NO"
+PRISTINE_ROOTFS=
+GZ_CACHE=
+EXTRACT_JOBS=
+DETERMINISTIC="NO"
+VERIFY="NO"
+DELTA="NO"
 while [[ $# -gt 0 ]]
 do
     key="$1"
@@ -1062,6 +1239,15 @@ do
         -m|--inject-gdb)
             INJECT_GDB="YES"
             ;;
+        --gdb-tcp)
+            GDB_TCP_PORT="$2"
+            if ! [[ "${GDB_TCP_PORT}" =~ ^[0-9]+$ ]] || [ "${GDB_TCP_PORT}" -lt 1 ] || [ "${GDB_TCP_PORT}" -gt 65535 ]
+            then
+                log "ERROR: --gdb-tcp requires a TCP port"
+                exit 1
+            fi
+            shift # past argument
+            ;;
         --bin-with-asa-to-inject)
             FWFILE_WITH_ASA_TO_INJECT="$2"
             shift
@@ -1132,6 +1318,36 @@ do
             fi
             shift # past argument
             ;;
+        --trace)
+            ASAFW_TRACE="$2"
+            shift # past argument
+            ;;
+        --verify)
+            VERIFY="YES"
+            ;;
+        --delta)
+            DELTA="YES"
+            ;;
+        --pristine-rootfs)
+            PRISTINE_ROOTFS=$(readlink -f "$2")
+            shift # past argument
+            ;;
+        --gz-cache)
+            GZ_CACHE=$(readlink -f "$2")
+            shift # past argument
+            ;;
+        --deterministic)
+            DETERMINISTIC="YES"
+            ;;
+        --extract-jobs)
+            EXTRACT_JOBS="$2"
+            if ! [[ "${EXTRACT_JOBS}" =~ ^[0-9]+$ ]] || [ "${EXTRACT_JOBS}" -lt 1 ]
+            then
+                log "ERROR: --extract-jobs requires a number of threads"
+                exit 1
+            fi
+            shift # past argument
+            ;;
         -v|--verbose)
             DEBUG="-v"
             ;;
@@ -1147,6 +1363,20 @@ do
     shift # past argument or value
 done
 
+# The trace file can also be inherited from the environment, e.g. when we are
+# called from unpack_repack_qcow2.sh. Only the script starting the batch prints
+# the summary at the end
+if [ ! -z "${ASAFW_TRACE}" ]
+then
+    export ASAFW_TRACE=$(readlink -f "${ASAFW_TRACE}")
+    if [ -z "${ASAFW_TRACE_BATCH}" ]
+    then
+        export ASAFW_TRACE_BATCH="${SCRIPTNAME}-$(date +%Y%m%d-%H%M%S)-$$"
+        TRACE_OWNER="YES"
+    fi
+    log "Tracing stages to ${ASAFW_TRACE} (batch ${ASAFW_TRACE_BATCH})"
+fi
+
 if [[ -z $INPUTFW || ! -e $INPUTFW ]]
 then
     log "ERROR: You must specify at least a valid --input (-i) argument"
@@ -1177,6 +1407,12 @@ then
     usage
 fi
 
+if [[ ! -z "${PRISTINE_ROOTFS}" && ( ! -f $INPUTFW || ! -d "${PRISTINE_ROOTFS}" ) ]]
+then
+    log "ERROR: --pristine-rootfs requires an extracted rootfs directory and --input (-i) to be a firmware file"
+    usage
+fi
+
 if [[ ! -z "${LINAHOOK}" && "${DEBUGSHELL}" == "NO" ]]
 then
     log "ERROR: Use of --lina-hook (-H) currently requires --debug-shell (-b)"
@@ -1233,6 +1469,7 @@ then
     fi
 
     ORIGDIR=${PWD}
+    export ASAFW_TRACE_FW=$(basename "${ORIGINAL_FIRMWARE}")
     modify_bin ${ROOTFS_DIR}
     repack_bin ${ROOTFS_DIR} ${OUTBIN} ${ORIGINAL_FIRMWARE}
 
@@ -1243,3 +1480,8 @@ then
     fi
     cd ${ORIGDIR}
 fi
+
+if [[ "${TRACE_OWNER}" == "YES" ]]
+then
+    ${TRACETOOL} -r -b ${ASAFW_TRACE_BATCH}
+fi
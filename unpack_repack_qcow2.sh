@@ -30,6 +30,8 @@ dbglog()
     fi
 }
 
+source "$(dirname "$(readlink -f "${BASH_SOURCE[0]}")")/trace.sh"
+
 usage()
 {
     echo "Usage:"
@@ -57,6 +59,8 @@ usage()
     echo "      --unmount-qcow2                     Unmount qcow2 (debug)"
     echo "      --partition <num>                   Partition to mount (debug)"
     echo "      -M, --multi-bin                     Indicates if the input qcow2 file is a multi-bin, so we inject the modified asa*.bin in the right partition"
+    echo "      --trace <trace_file>                Record per-stage timing and resource usage to <trace_file> and print a summary"
+    echo "      --delta                             Also save the delta from the input QCOW2 as <out_qcow2_file>.delta (see delta.py)"
     echo "      -v, --verbose                       Display debug messages"
     echo "Examples:"
     echo " unpack_repack_qcow2.sh -i asav962-7.qcow2 -A -g -b -H hat"
@@ -156,7 +160,7 @@ extract_bin()
        DEST="${2}"
     fi
 
-    cp "${BINPATH}" "${DEST}"
+    tracecmd qcow2.copy_bin "${BINPATH}" "${DEST}" cp "${BINPATH}" "${DEST}"
     if [ $? != 0 ]; then
         log "[!] Couldn't not copy .bin"
         exit
@@ -360,7 +364,7 @@ repackage_qcow2()
         log "Mounted /dev/nbd0p2 to ${4}"
     fi
 
-    cp ${2} ${DEST}
+    tracecmd qcow2.inject_bin ${2} ${DEST} cp ${2} ${DEST}
     if [ $? != 0 ]; then
         log "[!] Couldn't not find repacked name: ${2}"
         exit
@@ -382,7 +386,7 @@ extract_one()
 
     log "extract_one: $QCOW2FILE"
 
-    extract_qcow2 ${QCOW2FILE} ${QCOW2MNT} ${BINFILE}
+    tracefn qcow2.extract extract_qcow2 ${QCOW2FILE} ${QCOW2MNT} ${BINFILE}
 
     # XXX - we generally want to avoid using -k as we want to keep the kernel to get the kernel version
     # but we may want to support it in case we want to only keep the rootfs for debugging
@@ -411,7 +415,7 @@ extract_repack_one()
 
     log "extract_repack_one: $QCOW2FILE"
 
-    extract_qcow2 ${QCOW2FILE} ${QCOW2MNT} ${BINFILE}
+    tracefn qcow2.extract extract_qcow2 ${QCOW2FILE} ${QCOW2MNT} ${BINFILE}
 
     ${UNPACK_REPACK_BIN} -i ${BINFILE} ${BIN_CMDLINE} -s ${DEBUG}
     if [ $? != 0 ];
@@ -430,7 +434,7 @@ extract_repack_one()
     then
         log "ENABLE ROOT"
         BINFILE_REPACKED2=${QCOWDIR}/bin/${BASEQCOW2FILE_NOEXT}-repacked-rooted.qcow2
-        ${FWTOOL} -t -f ${BINFILE_REPACKED} -o ${BINFILE_REPACKED2}
+        tracecmd qcow2.bin_py_root ${BINFILE_REPACKED} ${BINFILE_REPACKED2} ${FWTOOL} -t -f ${BINFILE_REPACKED} -o ${BINFILE_REPACKED2}
         if [ $? != 0 ];
         then
             log ${FWTOOL} -t -f ${BINFILE_REPACKED} -o ${BINFILE_REPACKED2} failed
@@ -440,7 +444,7 @@ extract_repack_one()
     then
         log "DISABLE ROOT"
         BINFILE_REPACKED2=${QCOWDIR}/${BASEQCOW2FILE_NOEXT}-repacked-rooted.bin
-        ${FWTOOL} -T -f ${BINFILE_REPACKED} -o ${BINFILE_REPACKED2}
+        tracecmd qcow2.bin_py_unroot ${BINFILE_REPACKED} ${BINFILE_REPACKED2} ${FWTOOL} -T -f ${BINFILE_REPACKED} -o ${BINFILE_REPACKED2}
         if [ $? != 0 ];
         then
             log ${FWTOOL} -T -f ${BINFILE_REPACKED} -o ${BINFILE_REPACKED_ROOTED} failed
@@ -448,12 +452,22 @@ extract_repack_one()
         fi
     fi
 
-    cp ${QCOW2FILE} ${OUTQCOW2FILE}
+    tracecmd qcow2.copy_qcow2 ${QCOW2FILE} ${OUTQCOW2FILE} cp ${QCOW2FILE} ${OUTQCOW2FILE}
     if [[ "${MULTI_BIN}" == "YES" ]]
     then
-        repackage_qcow2 ${BINFILE} ${BINFILE_REPACKED2} ${OUTQCOW2FILE} ${QCOW2MNT} 1
+        tracefn qcow2.repackage repackage_qcow2 ${BINFILE} ${BINFILE_REPACKED2} ${OUTQCOW2FILE} ${QCOW2MNT} 1
     else
-        repackage_qcow2 ${BINFILE} ${BINFILE_REPACKED2} ${OUTQCOW2FILE} ${QCOW2MNT}
+        tracefn qcow2.repackage repackage_qcow2 ${BINFILE} ${BINFILE_REPACKED2} ${OUTQCOW2FILE} ${QCOW2MNT}
+    fi
+
+    if [[ "${DELTA}" == "YES" ]]
+    then
+        tracecmd qcow2.delta ${OUTQCOW2FILE} ${OUTQCOW2FILE}.delta ${DELTATOOL} -c -i ${QCOW2FILE} -t ${OUTQCOW2FILE} -d ${OUTQCOW2FILE}.delta
+        if [ $? != 0 ];
+        then
+            log ${DELTATOOL} -c -i ${QCOW2FILE} -t ${OUTQCOW2FILE} -d ${OUTQCOW2FILE}.delta failed
+            exit
+        fi
     fi
 
     if [ -z ${DEBUG} ]
@@ -513,6 +527,8 @@ GRUB_TIMEOUT=
 INJECT_GRUBCONFIG="NO"
 INJECT_MULTIBIN="NO"
 MULTI_BIN="NO"
+DELTA="NO"
+TRACE_OWNER="NO"
 while [[ $# -gt 0 ]]
 do
     key="$1"
@@ -599,6 +615,13 @@ do
         -M|--multi-bin)
         MULTI_BIN="YES"
         ;;
+        --trace)
+        ASAFW_TRACE="${2}"
+        shift # past argument
+        ;;
+        --delta)
+        DELTA="YES"
+        ;;
         -v|--verbose)
         DEBUG="-v"
         ;;
@@ -652,6 +675,19 @@ then
     OUTQCOW2FILE=${QCOWDIR}/${BASEQCOW2FILE_NOEXT}-repacked.qcow2
 fi
 
+# unpack_repack_bin.sh inherits these so all stages end up in the same batch
+if [ ! -z "${ASAFW_TRACE}" ]
+then
+    export ASAFW_TRACE=$(readlink -f "${ASAFW_TRACE}")
+    if [ -z "${ASAFW_TRACE_BATCH}" ]
+    then
+        export ASAFW_TRACE_BATCH="${SCRIPTNAME}-$(date +%Y%m%d-%H%M%S)-$$"
+        TRACE_OWNER="YES"
+    fi
+    export ASAFW_TRACE_FW=${BASEQCOW2FILE}
+    log "Tracing stages to ${ASAFW_TRACE} (batch ${ASAFW_TRACE_BATCH})"
+fi
+
 if [ ! -z "${ENABLE_SERIAL}" ]; then
     # We exit immediately because this is used for patching a flash qcow2 and
     # not the same qcow2 for enabling gdb, etc.
@@ -710,3 +746,8 @@ else
         extract_repack_one
     fi
 fi
+
+if [[ "${TRACE_OWNER}" == "YES" ]]
+then
+    ${TRACETOOL} -r -b ${ASAFW_TRACE_BATCH}
+fi
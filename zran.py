@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+#
+# This file is part of asafw.
+# Copyright (c) 2017, Aaron Adams <aaron.adams(at)nccgroup(dot)trust>
+# Copyright (c) 2017, Cedric Halbronn <cedric.halbronn(at)nccgroup(dot)trust>
+#
+# Random access into the gzip rootfs of a firmware, based on zran.c from the
+# zlib examples.
+#
+# While decompressing the rootfs once, we save access points every "span"
+# bytes of output: the position in the compressed data (at a deflate block
+# boundary, so possibly in the middle of a byte), and the last 32KB of output
+# which is the dictionary needed to restart decompression from there. Reading
+# any offset of the uncompressed rootfs then only requires decompressing from
+# the access point before it.
+#
+# Python's zlib does not give access to the deflate block boundaries nor
+# allows restarting in the middle of a byte, so we use libz with ctypes.
+
+import base64
+import ctypes
+import ctypes.util
+import zlib
+
+WINSIZE = 32768
+CHUNK = 16384
+
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+Z_OK = 0
+Z_STREAM_END = 1
+Z_NEED_DICT = 2
+Z_DATA_ERROR = -3
+Z_MEM_ERROR = -4
+Z_BUF_ERROR = -5
+
+class ZranError(Exception):
+    pass
+
+class ZStream(ctypes.Structure):
+    _fields_ = [
+        ("next_in",   ctypes.c_void_p),
+        ("avail_in",  ctypes.c_uint),
+        ("total_in",  ctypes.c_ulong),
+        ("next_out",  ctypes.c_void_p),
+        ("avail_out", ctypes.c_uint),
+        ("total_out", ctypes.c_ulong),
+        ("msg",       ctypes.c_char_p),
+        ("state",     ctypes.c_void_p),
+        ("zalloc",    ctypes.c_void_p),
+        ("zfree",     ctypes.c_void_p),
+        ("opaque",    ctypes.c_void_p),
+        ("data_type", ctypes.c_int),
+        ("adler",     ctypes.c_ulong),
+        ("reserved",  ctypes.c_ulong),
+    ]
+
+_libz = None
+def libz():
+    global _libz
+    if _libz == None:
+        name = ctypes.util.find_library("z") or "libz.so.1"
+        try:
+            _libz = ctypes.CDLL(name)
+        except OSError:
+            raise ZranError("Could not load libz (%s)" % name)
+        _libz.zlibVersion.restype = ctypes.c_char_p
+        _libz.inflateInit2_.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        _libz.inflate.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int]
+        _libz.inflateEnd.argtypes = [ctypes.POINTER(ZStream)]
+        _libz.inflatePrime.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int, ctypes.c_int]
+        _libz.inflateSetDictionary.argtypes = [ctypes.POINTER(ZStream), ctypes.c_char_p, ctypes.c_uint]
+    return _libz
+
+class Inflater(object):
+    # wbits: 47 to decompress a gzip (or zlib) stream, -15 for raw deflate
+    def __init__(self, wbits):
+        self.z = libz()
+        self.strm = ZStream()
+        ret = self.z.inflateInit2_(ctypes.byref(self.strm), wbits, self.z.zlibVersion(),
+                                   ctypes.sizeof(ZStream))
+        if ret != Z_OK:
+            raise ZranError("inflateInit2 failed: %d" % ret)
+        self.inbuf = ctypes.create_string_buffer(CHUNK)
+
+    def feed(self, buf):
+        ctypes.memmove(self.inbuf, buf, len(buf))
+        self.strm.next_in = ctypes.addressof(self.inbuf)
+        self.strm.avail_in = len(buf)
+
+    def prime(self, bits, value):
+        ret = self.z.inflatePrime(ctypes.byref(self.strm), bits, value)
+        if ret != Z_OK:
+            raise ZranError("inflatePrime failed: %d" % ret)
+
+    def set_dictionary(self, window):
+        ret = self.z.inflateSetDictionary(ctypes.byref(self.strm), window, len(window))
+        if ret != Z_OK:
+            raise ZranError("inflateSetDictionary failed: %d" % ret)
+
+    def inflate(self, flush):
+        ret = self.z.inflate(ctypes.byref(self.strm), flush)
+        if ret == Z_NEED_DICT:
+            ret = Z_DATA_ERROR
+        if ret in [Z_DATA_ERROR, Z_MEM_ERROR]:
+            raise ZranError("inflate failed: %d (%s)" % (ret, self.strm.msg))
+        return ret
+
+    def close(self):
+        self.z.inflateEnd(ctypes.byref(self.strm))
+
+# Decompress the gzip stream at data[off:off+size], yielding the output in
+# chunks and appending an access point to "points" every "span" bytes of
+# output. Each point is a dict with "in" (offset in the gzip stream), "bits"
+# (number of bits of the byte before "in" to use), "out" (offset in the
+# output) and "window" (32KB preceding "out")
+def inflate_with_points(data, off, size, points, span=512*1024):
+    inf = Inflater(47)
+    window = ctypes.create_string_buffer(WINSIZE)
+    pos = off
+    end = off + size
+    totin = 0
+    totout = 0
+    last = 0
+    inf.strm.avail_out = 0
+    try:
+        while True:
+            if pos >= end:
+                raise ZranError("Truncated gzip stream")
+            n = min(CHUNK, end - pos)
+            inf.feed(data[pos:pos+n])
+            pos += n
+            while True:
+                if inf.strm.avail_out == 0:
+                    inf.strm.avail_out = WINSIZE
+                    inf.strm.next_out = ctypes.addressof(window)
+                start = WINSIZE - inf.strm.avail_out
+                totin += inf.strm.avail_in
+                totout += inf.strm.avail_out
+                ret = inf.inflate(Z_BLOCK)
+                totin -= inf.strm.avail_in
+                totout -= inf.strm.avail_out
+                produced = WINSIZE - inf.strm.avail_out
+                if produced > start:
+                    yield window.raw[start:produced]
+                if ret == Z_STREAM_END:
+                    return
+                # end of a deflate block that is not the last one
+                if inf.strm.data_type & 128 and not inf.strm.data_type & 64 and \
+                   (totout == 0 or totout - last > span):
+                    left = inf.strm.avail_out
+                    raw = window.raw
+                    points.append({
+                        "in":     totin,
+                        "bits":   inf.strm.data_type & 7,
+                        "out":    totout,
+                        "window": raw[WINSIZE-left:] + raw[:WINSIZE-left],
+                    })
+                    last = totout
+                if inf.strm.avail_in == 0:
+                    break
+    finally:
+        inf.close()
+
+# Offsets in the output of the gzip stream at data[off:off+size] where the
+# compressor did a full (or sync) flush, i.e. where an empty stored block
+# follows the end of another block. This is how cpiogz.py separates its
+# segments
+def flush_offsets(data, off, size):
+    inf = Inflater(47)
+    outbuf = ctypes.create_string_buffer(WINSIZE)
+    pos = off
+    end = off + size
+    totout = 0
+    last_block_out = None
+    offsets = []
+    try:
+        while True:
+            if pos >= end:
+                raise ZranError("Truncated gzip stream")
+            n = min(CHUNK, end - pos)
+            inf.feed(data[pos:pos+n])
+            pos += n
+            while True:
+                inf.strm.next_out = ctypes.addressof(outbuf)
+                inf.strm.avail_out = WINSIZE
+                ret = inf.inflate(Z_BLOCK)
+                totout += WINSIZE - inf.strm.avail_out
+                if ret == Z_STREAM_END:
+                    return offsets
+                if inf.strm.data_type & 128:
+                    # the first stop is at the end of the gzip header
+                    if last_block_out != None and totout == last_block_out and \
+                       inf.strm.data_type & 7 == 0 and totout != 0 and \
+                       (len(offsets) == 0 or offsets[-1] != totout):
+                        offsets.append(totout)
+                    last_block_out = totout
+                if inf.strm.avail_in == 0:
+                    break
+    finally:
+        inf.close()
+
+# File-like object over inflate_with_points() so the output can be parsed
+# while the points are collected
+class IndexingReader(object):
+    def __init__(self, data, off, size, span=512*1024):
+        self.points = []
+        self.gen = inflate_with_points(data, off, size, self.points, span)
+        self.buf = b""
+        self.pos = 0
+
+    def read(self, n):
+        while len(self.buf) < n:
+            try:
+                self.buf += next(self.gen)
+            except StopIteration:
+                break
+        ret = self.buf[:n]
+        self.buf = self.buf[n:]
+        self.pos += len(ret)
+        return ret
+
+    def tell(self):
+        return self.pos
+
+    # Decompress whatever is left so all the points are collected
+    def finish(self):
+        for _ in self.gen:
+            pass
+
+# Read "length" bytes at "offset" of the uncompressed output of the gzip
+# stream at data[off:off+size], starting from the closest access point
+def extract(data, off, size, points, offset, length):
+    point = None
+    for p in points:
+        if p["out"] > offset:
+            break
+        point = p
+    if point == None:
+        raise ZranError("No access point before offset 0x%x" % offset)
+    inf = Inflater(-15)
+    try:
+        pos = off + point["in"]
+        if point["bits"]:
+            pos -= 1
+            inf.prime(point["bits"], data[pos] >> (8 - point["bits"]))
+            pos += 1
+        inf.set_dictionary(point["window"])
+        skip = offset - point["out"]
+        out = []
+        outlen = 0
+        outbuf = ctypes.create_string_buffer(WINSIZE)
+        ret = Z_OK
+        while outlen < length and ret != Z_STREAM_END:
+            if inf.strm.avail_in == 0:
+                n = min(CHUNK, off + size - pos)
+                if n <= 0:
+                    raise ZranError("Truncated gzip stream")
+                inf.feed(data[pos:pos+n])
+                pos += n
+            while inf.strm.avail_in != 0 and outlen < length:
+                inf.strm.next_out = ctypes.addressof(outbuf)
+                inf.strm.avail_out = WINSIZE
+                ret = inf.inflate(Z_NO_FLUSH)
+                chunk = outbuf.raw[:WINSIZE - inf.strm.avail_out]
+                if skip >= len(chunk):
+                    skip -= len(chunk)
+                else:
+                    chunk = chunk[skip:]
+                    skip = 0
+                    out.append(chunk)
+                    outlen += len(chunk)
+                if ret == Z_STREAM_END:
+                    break
+        if outlen < length:
+            raise ZranError("Offset 0x%x+0x%x is past the end of the stream" % (offset, length))
+        return b"".join(out)[:length]
+    finally:
+        inf.close()
+
+# Points in a JSON friendly form (compressed base64 windows)
+def points_to_json(points):
+    return [{
+        "in":     p["in"],
+        "bits":   p["bits"],
+        "out":    p["out"],
+        "window": base64.b64encode(zlib.compress(p["window"], 9)).decode(),
+    } for p in points]
+
+def points_from_json(points):
+    return [{
+        "in":     p["in"],
+        "bits":   p["bits"],
+        "out":    p["out"],
+        "window": zlib.decompress(base64.b64decode(p["window"])),
+    } for p in points]